@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Benchmark the old future_next() polling loop against the CompletionQueue,
+on slices of blocks whose processing has three dependent stages 
+(block hash, then block, then the block's transactions), like
+get_nulldata_txs_in_blocks().  RPC latencies are uneven:  most are
+fast, but a few stragglers are slow.
+
+Usage: python benchmarks/completion_queue.py [num_blocks] [slice_len] [num_workers]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), ".." ) )
+
+from multiprocessing.pool import ThreadPool
+from virtualchain.lib.workpool import CompletionQueue
+
+NUM_STAGES = 3
+
+
+def fake_rpc( delay, value ):
+   """
+   Stand-in for an RPC that takes delay seconds.
+   """
+   time.sleep( delay )
+   return value
+
+
+def future_next( fut_records, fut_inspector ):
+   """
+   The polling scheduler the indexer used to use.
+   """
+   for fut_record in fut_records:
+      fut = fut_inspector( fut_record )
+      if fut.ready():
+         fut_records.remove( fut_record )
+         return fut_record
+
+   for fut_record in fut_records:
+      fut = fut_inspector( fut_record )
+      fut.wait( 10000000000000000L )
+      fut_records.remove( fut_record )
+      return fut_record
+
+
+def run_polling( workpool, delays, slice_len ):
+   """
+   Stage-at-a-time, with future_next().
+   Returns (wall time, time spent waiting or scheduling).
+   """
+   start = time.time()
+   sched_time = 0
+
+   for slice_start in xrange(0, len(delays[0]), slice_len):
+
+      futures = []
+      for i in xrange(slice_start, min(slice_start + slice_len, len(delays[0]))):
+         futures.append( (i, workpool.apply_async( fake_rpc, (delays[0][i], i) )) )
+
+      for stage in xrange(1, NUM_STAGES + 1):
+
+         next_futures = []
+         for j in xrange(0, len(futures)):
+            t = time.time()
+            block_number, fut = future_next( futures, lambda f: f[1] )
+            sched_time += time.time() - t
+
+            fut.get()
+            if stage < NUM_STAGES:
+               next_futures.append( (block_number, workpool.apply_async( fake_rpc, (delays[stage][block_number], block_number) )) )
+
+         futures = next_futures
+
+   return (time.time() - start, sched_time)
+
+
+def run_completion_queue( workpool, delays, slice_len ):
+   """
+   Completion-driven, with a CompletionQueue.
+   Returns (wall time, time spent waiting or scheduling).
+   """
+   start = time.time()
+   sched_time = 0
+
+   for slice_start in xrange(0, len(delays[0]), slice_len):
+
+      completions = CompletionQueue( workpool )
+      for i in xrange(slice_start, min(slice_start + slice_len, len(delays[0]))):
+         completions.submit( fake_rpc, (delays[0][i], i), 1 )
+
+      while len(completions) > 0:
+         t = time.time()
+         stage, block_number = completions.next()
+         sched_time += time.time() - t
+
+         if stage < NUM_STAGES:
+            completions.submit( fake_rpc, (delays[stage][block_number], block_number), stage + 1 )
+
+   return (time.time() - start, sched_time)
+
+
+if __name__ == "__main__":
+
+   num_blocks = 5000
+   slice_len = 200
+   num_workers = 32
+
+   if len(sys.argv) > 1:
+      num_blocks = int(sys.argv[1])
+
+   if len(sys.argv) > 2:
+      slice_len = int(sys.argv[2])
+
+   if len(sys.argv) > 3:
+      num_workers = int(sys.argv[3])
+
+   random.seed( 0 )
+
+   # mostly-fast RPCs, with the occasional slow one
+   delays = []
+   for stage in xrange(0, NUM_STAGES):
+      stage_delays = []
+      for i in xrange(0, num_blocks):
+         if random.random() < 0.02:
+            stage_delays.append( 0.05 )
+         else:
+            stage_delays.append( random.expovariate( 1000.0 ) )
+
+      delays.append( stage_delays )
+
+   workpool = ThreadPool( num_workers )
+
+   for name, runner in [("future_next", run_polling), ("CompletionQueue", run_completion_queue)]:
+      total_time, sched_time = runner( workpool, delays, slice_len )
+      print "%-16s %s tasks: %.3fs total, %.3fs waiting or scheduling" % (name, NUM_STAGES * num_blocks, total_time, sched_time)
+
+   workpool.terminate()
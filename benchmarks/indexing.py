@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Benchmark StateEngine.build() end-to-end, against a mock bitcoind
+serving a synthetic (or recorded) chain.
+
+Each configuration (workpool backend x number of workers, plus any
+--opt options) is built from scratch in a process of its own, so peak
+RSS and the fetch-layer caches are per run.  For each one, we report
+blocks/sec, ops/sec, RPC requests (and calls, counting each call in
+a batch) per block, peak RSS, and the time spent in each stage:
+
+* fetch:  get_nulldata_txs_in_blocks() (in the background, if the build is pipelined)
+* parse:  StateEngine.parse_block()
+* check_commit:  db_check() and db_commit(), via StateEngine.process_ops()
+* snapshot:  StateEngine.snapshot()
+* save:  StateEngine.save()
+
+Results are written as JSON (to stdout, or to --output), so they can be
+compared between releases.  consensus_agrees is true if every build that
+succeeded got the same consensus hash, and null if none succeeded.
+
+Usage: python benchmarks/indexing.py [--blocks N] [--nulldata-rate R] [--max-inputs N]
+                                     [--backends process,thread,inline] [--workers 1,4,8]
+                                     [--opt key=value ...] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import functools
+import binascii
+import resource
+import tempfile
+import platform
+import multiprocessing
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), ".." ) )
+
+import virtualchain
+from virtualchain.lib import indexer
+from virtualchain.lib.blockchain import get_fetch_metrics, reset_fetch_metrics
+from virtualchain.lib.blockchain.mockbitcoind import MockChain, MockBitcoindServer, SYNTHETIC_OPCODES
+
+BENCHMARK_FORMAT_VERSION = 1
+BUILD_STAGES = ["fetch", "parse", "check_commit", "snapshot", "save"]
+
+
+class BenchmarkImpl( object ):
+   """
+   Virtual chain implementation to benchmark with.  It accepts the first
+   operation with each payload, and rejects the rest, so db_check() and
+   db_commit() have some state to consult.
+   """
+
+   def __init__( self, working_dir, magic_bytes ):
+      self.working_dir = working_dir
+      self.magic_bytes = magic_bytes
+
+   def get_virtual_chain_name( self, testset=False ):
+      return "virtualchain-benchmark"
+
+   def get_virtual_chain_version( self ):
+      return "0.0.1"
+
+   def get_first_block_id( self ):
+      # block 0 only has a coinbase
+      return 1
+
+   def get_db_state( self ):
+      return {"payloads": set(), "accepted": 0}
+
+   def get_opcodes( self ):
+      return list(SYNTHETIC_OPCODES)
+
+   def get_magic_bytes( self ):
+      return self.magic_bytes
+
+   def get_op_processing_order( self ):
+      return self.get_opcodes()
+
+   def db_parse( self, block_id, opcode, op_payload, senders, inputs, outputs, fee, db_state=None ):
+      return {
+         "payload": binascii.hexlify( op_payload ),
+         "sender": senders[0]['script_pubkey'] if len(senders) > 0 else None,
+         "num_senders": len(senders),
+         "fee": fee
+      }
+
+   def db_check( self, block_id, checked_ops, opcode, op, txid, vtxindex, db_state=None ):
+      return op['payload'] not in db_state['payloads']
+
+   def db_commit( self, block_id, opcode, op, txid, vtxindex, db_state=None ):
+      if opcode == "virtualchain_final":
+         return None
+
+      db_state['payloads'].add( op['payload'] )
+      db_state['accepted'] += 1
+      return op
+
+   def db_save( self, block_id, consensus_hash, pending_ops, filename, db_state=None ):
+      with open(filename, "w") as f:
+         f.write( json.dumps( {"block_id": block_id, "consensus_hash": consensus_hash, "accepted": db_state['accepted']} ) )
+
+      return True
+
+   def db_serialize( self, opcode, opdata, db_state=None ):
+      return ",".join( [opcode, opdata['payload'], str(opdata['sender']), str(opdata['num_senders']), str(opdata['fee'])] )
+
+
+class TimedStateEngine( indexer.StateEngine ):
+   """
+   StateEngine that adds up the time spent in each stage of build(),
+   and counts the operations it parses and accepts.
+   """
+
+   def __init__( self, *args, **kw ):
+      super( TimedStateEngine, self ).__init__( *args, **kw )
+      self.stage_times = dict( [(stage, 0.0) for stage in BUILD_STAGES] )
+      self.num_parsed = 0
+      self.num_accepted = 0
+
+   def timed( self, stage, method, *args, **kw ):
+      start = time.time()
+      try:
+         return method( *args, **kw )
+      finally:
+         self.stage_times[stage] += time.time() - start
+
+   def fetch_block_range_group( self, bitcoind_opts, range_group, **kw ):
+      return self.timed( "fetch", super( TimedStateEngine, self ).fetch_block_range_group, bitcoind_opts, range_group, **kw )
+
+   def parse_block( self, block_id, txs ):
+      ops = self.timed( "parse", super( TimedStateEngine, self ).parse_block, block_id, txs )
+      self.num_parsed += len(ops)
+      return ops
+
+   def process_ops( self, block_id, ops ):
+      new_ops = self.timed( "check_commit", super( TimedStateEngine, self ).process_ops, block_id, ops )
+      self.num_accepted += len( [op for op in new_ops['virtualchain_ordered'] if op['virtualchain_opcode'] != 'final'] )
+      return new_ops
+
+   def snapshot( self, block_id, pending_ops ):
+      return self.timed( "snapshot", super( TimedStateEngine, self ).snapshot, block_id, pending_ops )
+
+   def save( self, block_id, consensus_hash, pending_ops, backup=False ):
+      return self.timed( "save", super( TimedStateEngine, self ).save, block_id, consensus_hash, pending_ops, backup=backup )
+
+
+def json_safe_metrics( fetch_metrics ):
+   """
+   Replace the infinite upper bound of the last latency bucket
+   in get_fetch_metrics()'s output, which JSON can't represent.
+   """
+   for rpc_metrics in fetch_metrics["rpc"].values():
+      rpc_metrics["latency"]["buckets"] = [(bound if bound != float("inf") else "+Inf", count) for (bound, count) in rpc_metrics["latency"]["buckets"]]
+
+   return fetch_metrics
+
+
+class MockBitcoindProcess( object ):
+   """
+   A MockBitcoindServer running in a process of its own, so that
+   neither its chain nor its work shows up in the builds' measurements.
+   """
+
+   def __init__( self, make_chain, **server_args ):
+      self.conn, child_conn = multiprocessing.Pipe()
+      self.proc = multiprocessing.Process( target=self.serve, args=(make_chain, server_args, child_conn) )
+      self.proc.daemon = True
+      self.proc.start()
+
+      # so we get EOFError, instead of waiting forever, if the server dies
+      child_conn.close()
+
+      # {"port", "blocks", "transactions", "network", "build_seconds"}
+      self.info = self.conn.recv()
+
+
+   @classmethod
+   def serve( cls, make_chain, server_args, conn ):
+      start = time.time()
+      chain = make_chain()
+      build_time = time.time() - start
+
+      server = MockBitcoindServer( chain, **server_args ).start()
+      conn.send( {
+         "port": server.get_port(),
+         "blocks": chain.get_height() + 1,
+         "transactions": len(chain.tx_locations),
+         "network": chain.network,
+         "build_seconds": build_time
+      } )
+
+      while conn.recv() == "stats":
+         conn.send( server.get_stats() )
+
+      server.stop()
+
+
+   def get_stats( self ):
+      self.conn.send( "stats" )
+      return self.conn.recv()
+
+
+   def get_bitcoind_opts( self, bitcoind_opts ):
+      opts = dict(bitcoind_opts)
+      opts.update( {
+         "bitcoind_server": "127.0.0.1",
+         "bitcoind_port": self.info["port"],
+         "bitcoind_user": "mock",
+         "bitcoind_passwd": "mock",
+         "bitcoind_use_https": False
+      } )
+
+      if self.info["network"] != "mainnet":
+         opts["bitcoin_network"] = self.info["network"]
+
+      return opts
+
+
+   def stop( self ):
+      self.conn.send( "stop" )
+      self.proc.join()
+
+
+def run_build( magic_bytes, bitcoind_opts, end_block_id, results ):
+   """
+   Build the chain from scratch with the given options, and
+   put what we measured into results (a multiprocessing queue).
+   Runs in a process of its own.
+   """
+   working_dir = tempfile.mkdtemp( prefix="virtualchain-benchmark-" )
+
+   try:
+      impl = BenchmarkImpl( working_dir, magic_bytes )
+      virtualchain.setup_virtualchain( impl )
+      reset_fetch_metrics()
+
+      engine = TimedStateEngine( impl.get_magic_bytes(), impl.get_opcodes(), impl=impl, state=impl.get_db_state(), initial_snapshots={} )
+      start_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+
+      start = time.time()
+      rc = engine.build( bitcoind_opts, end_block_id )
+      elapsed = time.time() - start
+
+      results.put( {
+         "success": rc,
+         "elapsed": elapsed,
+         "blocks": engine.lastblock - impl.get_first_block_id() + 1,
+         "ops_parsed": engine.num_parsed,
+         "ops_accepted": engine.num_accepted,
+         "consensus_hash": engine.get_current_consensus() if rc else None,
+         "stages": engine.stage_times,
+         "fetch_metrics": json_safe_metrics( get_fetch_metrics() ),
+
+         # in KB, on Linux.  Workers have been reaped by the time build() returns.
+         "start_rss": start_rss,
+         "peak_rss": resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss,
+         "peak_worker_rss": resource.getrusage( resource.RUSAGE_CHILDREN ).ru_maxrss
+      } )
+
+   except Exception, e:
+      logging.exception( e )
+      results.put( {"success": False, "error": repr(e)} )
+
+   finally:
+      shutil.rmtree( working_dir, True )
+
+
+def benchmark_build( server, magic_bytes, bitcoind_opts, end_block_id ):
+   """
+   Benchmark one build of blocks [1, end_block_id) against server (a MockBitcoindProcess)
+   with the given options.  Return a dict with what we measured.
+   """
+   stats_before = server.get_stats()
+   results = multiprocessing.Queue()
+
+   proc = multiprocessing.Process( target=run_build, args=(magic_bytes, server.get_bitcoind_opts( bitcoind_opts ), end_block_id, results) )
+   proc.start()
+   result = results.get()
+   proc.join()
+
+   stats_after = server.get_stats()
+   requests = stats_after.get("requests", 0) - stats_before.get("requests", 0)
+   calls = stats_after.get("calls", 0) - stats_before.get("calls", 0)
+
+   result["opts"] = bitcoind_opts
+   if not result.get("success", False):
+      return result
+
+   elapsed = max( result["elapsed"], 1e-6 )
+   num_blocks = max( result["blocks"], 1 )
+
+   result.update( {
+      "blocks_per_second": result["blocks"] / elapsed,
+      "ops_per_second": result["ops_parsed"] / elapsed,
+      "rpc_requests": requests,
+      "rpc_calls": calls,
+      "rpc_requests_per_block": float(requests) / num_blocks,
+      "rpc_calls_per_block": float(calls) / num_blocks,
+      "bytes_sent": stats_after.get("bytes_sent", 0) - stats_before.get("bytes_sent", 0)
+   } )
+
+   return result
+
+
+def parse_opt( opt ):
+   """
+   Parse a key=value option.  Values are JSON if they can be, and strings if not.
+   """
+   if "=" not in opt:
+      raise argparse.ArgumentTypeError( "Expected key=value, got '%s'" % opt )
+
+   key, value = opt.split("=", 1)
+   try:
+      value = json.loads( value )
+   except ValueError:
+      pass
+
+   return (key, value)
+
+
+def main( argv ):
+   parser = argparse.ArgumentParser( description="Benchmark StateEngine.build() against a mock bitcoind" )
+   parser.add_argument( "--blocks", type=int, default=500, help="number of synthetic blocks" )
+   parser.add_argument( "--txs-per-block", type=int, default=50, help="transactions per synthetic block" )
+   parser.add_argument( "--nulldata-rate", type=float, default=0.3, help="fraction of synthetic transactions with nulldata" )
+   parser.add_argument( "--max-inputs", type=int, default=2, help="most inputs per synthetic transaction (senders to look up)" )
+   parser.add_argument( "--magic", default="id", help="magic bytes of the virtual chain" )
+   parser.add_argument( "--seed", type=int, default=0, help="seed for the synthetic chain" )
+   parser.add_argument( "--chain", help="benchmark against this JSON chain fixture (see MockChain.save()) instead of a synthetic chain" )
+   parser.add_argument( "--latency", type=float, default=0, help="seconds the mock bitcoind waits before answering each request" )
+   parser.add_argument( "--rpc-threads", type=int, default=None, help="most requests the mock bitcoind works on at once" )
+   parser.add_argument( "--backends", default="process,thread", help="comma-separated workpool backends to compare" )
+   parser.add_argument( "--workers", default="4", help="comma-separated numbers of workers to compare" )
+   parser.add_argument( "--worker-blocks", type=int, default=10, help="blocks per worker per slice (multiprocessing_num_blocks)" )
+   parser.add_argument( "--opt", type=parse_opt, action="append", default=[], help="other bitcoind option to set, as key=value (repeatable)" )
+   parser.add_argument( "--repeat", type=int, default=1, help="times to run each configuration" )
+   parser.add_argument( "--output", help="write JSON results here instead of to stdout" )
+   args = parser.parse_args( argv )
+
+   logging.getLogger().setLevel( logging.ERROR )
+
+   if args.chain is not None:
+      make_chain = functools.partial( MockChain.load, args.chain )
+   else:
+      make_chain = functools.partial( MockChain.synthetic, args.blocks, txs_per_block=args.txs_per_block, nulldata_rate=args.nulldata_rate,
+                                      magic=args.magic, max_inputs=args.max_inputs, seed=args.seed )
+
+   server = MockBitcoindProcess( make_chain, latency=args.latency, rpc_threads=args.rpc_threads )
+
+   report = {
+      "format_version": BENCHMARK_FORMAT_VERSION,
+      "timestamp": int(time.time()),
+      "host": {
+         "python": platform.python_version(),
+         "platform": platform.platform(),
+         "cpus": multiprocessing.cpu_count()
+      },
+      "chain": {
+         "fixture": args.chain,
+         "blocks": server.info["blocks"],
+         "transactions": server.info["transactions"],
+         "txs_per_block": args.txs_per_block,
+         "nulldata_rate": args.nulldata_rate,
+         "max_inputs": args.max_inputs,
+         "seed": args.seed,
+         "build_seconds": server.info["build_seconds"]
+      },
+      "server": {
+         "latency": args.latency,
+         "rpc_threads": args.rpc_threads
+      },
+      "runs": []
+   }
+
+   try:
+      for backend in args.backends.split(","):
+         for num_workers in [int(w) for w in args.workers.split(",")]:
+
+            bitcoind_opts = {
+               "workpool_backend": backend,
+               "multiprocessing_num_procs": num_workers,
+               "multiprocessing_num_blocks": args.worker_blocks
+            }
+            bitcoind_opts.update( dict(args.opt) )
+
+            for i in xrange(0, args.repeat):
+               result = benchmark_build( server, args.magic, bitcoind_opts, server.info["blocks"] )
+               report["runs"].append( result )
+
+               if result.get("success", False):
+                  print >> sys.stderr, "%-8s x%-3s %8.1f blocks/s %8.1f ops/s %6.2f RPCs/block  peak RSS %s KB" % \
+                        (backend, num_workers, result["blocks_per_second"], result["ops_per_second"], result["rpc_requests_per_block"], result["peak_rss"])
+               else:
+                  print >> sys.stderr, "%-8s x%-3s failed: %s" % (backend, num_workers, result.get("error", "build() returned False"))
+
+   finally:
+      server.stop()
+
+   # every configuration should agree on the consensus hash (and there's nothing to agree on if none of them got one)
+   consensus_hashes = set( [run["consensus_hash"] for run in report["runs"] if run.get("success", False)] )
+   report["consensus_agrees"] = len(consensus_hashes) == 1 if len(consensus_hashes) > 0 else None
+
+   output = json.dumps( report, indent=2, sort_keys=True )
+   if args.output is not None:
+      with open(args.output, "w") as f:
+         f.write( output )
+   else:
+      print output
+
+   if not report["consensus_agrees"] or len( [run for run in report["runs"] if not run.get("success", False)] ) > 0:
+      return 1
+
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
@@ -41,6 +41,9 @@ setup(
         'Twisted>=15.3.0',
         'txJSON-RPC>=0.3.1'
     ],
+    extras_require={
+        'zmq': ['pyzmq']
+    },
     classifiers=[
         'Intended Audience :: Developers',
         'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""
+Tests for indexing and reading blocks from bitcoind's block files.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import os
+import struct
+import shutil
+import tempfile
+import unittest
+
+from virtualchain.lib.blockchain import blockfiles
+from virtualchain.lib.blockchain.blockfiles import BlockFileIndex, BLOCK_FILE_MAGIC, get_block_file_index, getblock_from_file, read_xor_key, xor_bytes
+from virtualchain.lib.blockchain.rawblock import deserialize_block
+from virtualchain.lib.blockchain.mockbitcoind import MockChain
+
+XOR_KEY = "\x3a\x91\x07\xc4\x5e\x00\xf2\x1b"
+
+
+def block_record( raw_block, network="mainnet" ):
+   """
+   Get a block as bitcoind writes it to a block file.
+   """
+   return BLOCK_FILE_MAGIC[network] + struct.pack( "<I", len(raw_block) ) + raw_block
+
+
+class BlockFileTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.blocks_dir = tempfile.mkdtemp()
+      self.bitcoind_opts = {"bitcoind_blocks_dir": self.blocks_dir, "bitcoind_network": "mainnet"}
+
+      chain = MockChain.synthetic( 6, txs_per_block=4, seed=1 )
+      self.block_hashes = chain.block_hashes[:]
+      self.raw_blocks = [chain.raw_blocks[block_hash] for block_hash in self.block_hashes]
+
+      blockfiles.process_local_block_file_index = None
+
+
+   def tearDown( self ):
+      blockfiles.unmap_block_files()
+      blockfiles.process_local_block_file_index = None
+      shutil.rmtree( self.blocks_dir )
+
+
+   def write_block_file( self, name, data, xor_key=None, mtime=None ):
+      """
+      Write a block file, obfuscating it if need be.
+      """
+      path = os.path.join( self.blocks_dir, name )
+      with open( path, "wb" ) as f:
+         f.write( xor_bytes( data, xor_key, 0 ) )
+
+      if mtime is not None:
+         os.utime( path, (mtime, mtime) )
+
+
+   def check_blocks( self, block_file_index, indexes ):
+      """
+      Verify that the given blocks are indexed, and decode to what bitcoind would give.
+      """
+      for i in indexes:
+         location = block_file_index.locate( self.block_hashes[i] )
+         self.assertNotEqual( location, None )
+         self.assertEqual( location[2], len(self.raw_blocks[i]) )
+
+         block = getblock_from_file( self.bitcoind_opts, self.block_hashes[i], location )
+         self.assertEqual( block, deserialize_block( self.raw_blocks[i] ) )
+
+
+   def test_scan_and_locate( self ):
+      self.write_block_file( "blk00000.dat", "".join( block_record( raw_block ) for raw_block in self.raw_blocks[:4] ) )
+      self.write_block_file( "blk00001.dat", "".join( block_record( raw_block ) for raw_block in self.raw_blocks[4:] ) )
+
+      # not block files
+      self.write_block_file( "rev00000.dat", "\x00" * 100 )
+      self.write_block_file( "blk0000.dat", "\x00" * 100 )
+
+      block_file_index = get_block_file_index( self.bitcoind_opts )
+      self.assertEqual( block_file_index.list_block_files(), ["blk00000.dat", "blk00001.dat"] )
+      self.assertEqual( block_file_index.scan(), 6 )
+      self.assertEqual( block_file_index.scan(), 0 )
+
+      self.assertEqual( block_file_index.locate( self.block_hashes[0] ), ("blk00000.dat", 8, len(self.raw_blocks[0])) )
+      self.assertEqual( block_file_index.locate( self.block_hashes[4] ), ("blk00001.dat", 8, len(self.raw_blocks[4])) )
+      self.assertEqual( block_file_index.locate( "00" * 32 ), None )
+      self.check_blocks( block_file_index, range(6) )
+
+
+   def test_appended_blocks( self ):
+      self.write_block_file( "blk00000.dat", "".join( block_record( raw_block ) for raw_block in self.raw_blocks[:3] ) )
+
+      block_file_index = get_block_file_index( self.bitcoind_opts )
+      self.assertEqual( block_file_index.scan(), 3 )
+      self.assertEqual( block_file_index.locate( self.block_hashes[3] ), None )
+
+      # bitcoind appends a block; locate() picks it up without an explicit scan
+      self.write_block_file( "blk00000.dat", "".join( block_record( raw_block ) for raw_block in self.raw_blocks[:4] ) )
+      self.assertNotEqual( block_file_index.locate( self.block_hashes[3] ), None )
+      self.check_blocks( block_file_index, range(4) )
+
+
+   def test_truncated_record( self ):
+      data = "".join( block_record( raw_block ) for raw_block in self.raw_blocks[:3] )
+      last_record = block_record( self.raw_blocks[3] )
+
+      # bitcoind has only written part of the last block
+      for partial_size in [4, 8, 50, len(last_record) - 1]:
+         blockfiles.unmap_block_files()
+         block_file_index = BlockFileIndex( self.blocks_dir )
+
+         self.write_block_file( "blk00000.dat", data + last_record[:partial_size] )
+         self.assertEqual( block_file_index.scan(), 3 )
+         self.assertEqual( block_file_index.scanned["blk00000.dat"], len(data) )
+
+      # once the block is finished, it is picked up from where the scan stopped
+      self.write_block_file( "blk00000.dat", data + last_record, mtime=1000000000 )
+      self.assertEqual( block_file_index.scan(), 1 )
+      self.assertEqual( block_file_index.locate( self.block_hashes[3] ), ("blk00000.dat", len(data) + 8, len(self.raw_blocks[3])) )
+
+
+   def test_preallocated_file( self ):
+      data = "".join( block_record( raw_block ) for raw_block in self.raw_blocks[:3] )
+      size = len(data) + 4096
+
+      self.write_block_file( "blk00000.dat", data + "\x00" * (size - len(data)), mtime=1000000000 )
+
+      block_file_index = get_block_file_index( self.bitcoind_opts )
+      self.assertEqual( block_file_index.scan(), 3 )
+      self.assertEqual( block_file_index.scanned["blk00000.dat"], len(data) )
+
+      # bitcoind writes more blocks into the preallocated space, without changing the file's size
+      more_data = data + "".join( block_record( raw_block ) for raw_block in self.raw_blocks[3:] )
+      self.assertTrue( len(more_data) < size )
+      self.write_block_file( "blk00000.dat", more_data + "\x00" * (size - len(more_data)), mtime=1000000001 )
+
+      self.assertEqual( block_file_index.scan(), 3 )
+      self.assertEqual( block_file_index.scanned["blk00000.dat"], len(more_data) )
+      self.check_blocks( block_file_index, range(6) )
+
+
+   def test_other_network( self ):
+      self.write_block_file( "blk00000.dat", "".join( block_record( raw_block, network="regtest" ) for raw_block in self.raw_blocks ) )
+
+      # mainnet's magic bytes don't match
+      self.assertEqual( BlockFileIndex( self.blocks_dir ).scan(), 0 )
+      self.assertEqual( BlockFileIndex( self.blocks_dir, network="regtest" ).scan(), 6 )
+
+
+   def test_xor_bytes( self ):
+      data = "".join( chr(i % 256) for i in xrange(1000) )
+      obfuscated = xor_bytes( data, XOR_KEY, 0 )
+
+      self.assertNotEqual( obfuscated, data )
+      self.assertEqual( xor_bytes( obfuscated, XOR_KEY, 0 ), data )
+
+      for i in xrange(len(data)):
+         self.assertEqual( ord(obfuscated[i]), ord(data[i]) ^ ord(XOR_KEY[i % len(XOR_KEY)]) )
+
+      # reads from the middle of a file, including ones with leading zeros
+      for (start, end) in [(3, 17), (8, 9), (1, 1000), (0, 0), (256, 265)]:
+         self.assertEqual( xor_bytes( obfuscated[start:end], XOR_KEY, start ), data[start:end] )
+
+      self.assertEqual( xor_bytes( data, None, 5 ), data )
+
+
+   def test_xor_key( self ):
+      self.assertEqual( read_xor_key( self.blocks_dir ), None )
+
+      # bitcoind writes an all-zero key when obfuscation is off
+      with open( os.path.join( self.blocks_dir, "xor.dat" ), "wb" ) as f:
+         f.write( "\x00" * 8 )
+
+      self.assertEqual( read_xor_key( self.blocks_dir ), None )
+
+      with open( os.path.join( self.blocks_dir, "xor.dat" ), "wb" ) as f:
+         f.write( XOR_KEY )
+
+      self.assertEqual( read_xor_key( self.blocks_dir ), XOR_KEY )
+
+
+   def test_obfuscated_block_files( self ):
+      with open( os.path.join( self.blocks_dir, "xor.dat" ), "wb" ) as f:
+         f.write( XOR_KEY )
+
+      data = "".join( block_record( raw_block ) for raw_block in self.raw_blocks )
+      self.write_block_file( "blk00000.dat", data + "\x00" * 1000, xor_key=XOR_KEY )
+
+      block_file_index = get_block_file_index( self.bitcoind_opts )
+      self.assertEqual( block_file_index.xor_key, XOR_KEY )
+      self.assertEqual( block_file_index.scan(), 6 )
+      self.assertEqual( block_file_index.scanned["blk00000.dat"], len(data) )
+      self.check_blocks( block_file_index, range(6) )
+
+      # without the key, nothing looks like a block
+      os.unlink( os.path.join( self.blocks_dir, "xor.dat" ) )
+      self.assertEqual( BlockFileIndex( self.blocks_dir ).scan(), 0 )
+
+
+   def test_mismatched_block( self ):
+      self.write_block_file( "blk00000.dat", "".join( block_record( raw_block ) for raw_block in self.raw_blocks ) )
+
+      block_file_index = get_block_file_index( self.bitcoind_opts )
+      block_file_index.scan()
+
+      name, offset, size = block_file_index.locate( self.block_hashes[1] )
+
+      # the wrong block
+      self.assertRaises( Exception, getblock_from_file, self.bitcoind_opts, self.block_hashes[0], (name, offset, size) )
+
+      # the right block, but the wrong size
+      self.assertRaises( Exception, getblock_from_file, self.bitcoind_opts, self.block_hashes[1], (name, offset, size - 1) )
+
+      try:
+         getblock_from_file( self.bitcoind_opts, self.block_hashes[0], (name, offset, size) )
+         self.fail("Read the wrong block")
+      except Exception, e:
+         self.assertTrue( self.block_hashes[0] in str(e) )
+         self.assertTrue( self.block_hashes[1] in str(e) )
+
+      self.assertEqual( getblock_from_file( self.bitcoind_opts, self.block_hashes[1], (name, offset, size) ), deserialize_block( self.raw_blocks[1] ) )
+
+
+if __name__ == "__main__":
+   unittest.main()
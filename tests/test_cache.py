@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""
+Tests for the on-disk RPC cache's size accounting and eviction.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from virtualchain.lib.blockchain.cache import RPCCache, RPC_CACHE_INDEX
+
+
+class CountingRPCCache( RPCCache ):
+   """
+   An RPC cache that counts how often it measures itself.
+   """
+
+   def __init__( self, cache_dir, max_size ):
+      RPCCache.__init__( self, cache_dir, max_size )
+      self.walks = 0
+
+
+   def list_entries( self ):
+      self.walks += 1
+      return RPCCache.list_entries( self )
+
+
+class RPCCacheTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.cache_dir = tempfile.mkdtemp()
+
+
+   def tearDown( self ):
+      shutil.rmtree( self.cache_dir )
+
+
+   def get_index( self ):
+      with open( os.path.join( self.cache_dir, RPC_CACHE_INDEX ), "r" ) as f:
+         return int(f.read())
+
+
+   def test_size_index( self ):
+      cache = CountingRPCCache( self.cache_dir, 10**6 )
+      for i in xrange(0, 20):
+         self.assertTrue( cache.put( "tx", "%064x-1" % i, {"txid": "%064x" % i} ) )
+
+      # measured once, to make the index, and never again
+      self.assertEqual( cache.walks, 1 )
+      self.assertEqual( self.get_index(), cache.get_size() )
+      self.assertEqual( cache.cur_size, cache.get_size() )
+
+      # overwriting an entry doesn't count it twice
+      cache.put( "tx", "%064x-1" % 0, {"txid": "%064x" % 0} )
+      self.assertEqual( self.get_index(), cache.get_size() )
+
+      # and discarding a corrupt one takes it out
+      with open( cache.entry_path( "tx", "%064x-1" % 1 ), "r+b" ) as f:
+         f.seek( -1, os.SEEK_END )
+         last = f.read( 1 )
+         f.seek( -1, os.SEEK_END )
+         f.write( chr( ord(last) ^ 0xff ) )
+
+      self.assertEqual( cache.get( "tx", "%064x-1" % 1 ), None )
+      self.assertEqual( cache.corrupt, 1 )
+      self.assertEqual( self.get_index(), cache.get_size() )
+
+
+   def test_shared_index( self ):
+      first = CountingRPCCache( self.cache_dir, 10**6 )
+      first.put( "tx", "%064x-1" % 0, {"txid": "%064x" % 0} )
+
+      # another process picks up the size from the index, instead of measuring the cache
+      second = CountingRPCCache( self.cache_dir, 10**6 )
+      for i in xrange(1, 10):
+         second.put( "tx", "%064x-1" % i, {"txid": "%064x" % i} )
+
+      self.assertEqual( second.walks, 0 )
+      self.assertEqual( self.get_index(), first.get_size() )
+
+
+   def test_garbled_index( self ):
+      cache = CountingRPCCache( self.cache_dir, 10**6 )
+      cache.put( "tx", "%064x-1" % 0, {"txid": "%064x" % 0} )
+
+      with open( os.path.join( self.cache_dir, RPC_CACHE_INDEX ), "w" ) as f:
+         f.write( "garbage" )
+
+      cache.put( "tx", "%064x-1" % 1, {"txid": "%064x" % 1} )
+      self.assertEqual( cache.walks, 2 )
+      self.assertEqual( self.get_index(), cache.get_size() )
+
+
+   def test_evict( self ):
+      cache = CountingRPCCache( self.cache_dir, 2000 )
+
+      for i in xrange(0, 100):
+         self.assertTrue( cache.put( "tx", "%064x-1" % i, {"txid": "%064x" % i} ) )
+         self.assertTrue( self.get_index() <= 2000 )
+
+      # measured only to make the index and to evict
+      self.assertTrue( cache.walks < 20, "measured %s times" % cache.walks )
+      self.assertEqual( self.get_index(), cache.get_size() )
+
+      # the index survives
+      self.assertTrue( os.path.exists( os.path.join( self.cache_dir, RPC_CACHE_INDEX ) ) )
+
+      # the most recent entry survives, and the oldest doesn't
+      self.assertEqual( cache.get( "tx", "%064x-1" % 99 ), {"txid": "%064x" % 99} )
+      self.assertEqual( cache.get( "tx", "%064x-1" % 0 ), None )
+
+
+if __name__ == "__main__":
+   unittest.main()
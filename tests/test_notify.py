@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Tests for the block notifiers:  long-polling a mock bitcoind
+(see mockbitcoind.py), and subscribing to a local ZMQ publisher.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import time
+import threading
+import unittest
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from virtualchain.lib import config
+from virtualchain.lib.blockchain import mockbitcoind, notify, session
+from virtualchain.lib.blockchain.notify import LongPollBlockNotifier, ZMQBlockNotifier
+
+try:
+   import zmq
+except ImportError:
+   zmq = None
+
+# how long to poll for, instead of config.REINDEX_FREQUENCY
+TEST_REINDEX_FREQUENCY = 0.1
+
+
+class OldBitcoind( object ):
+   """
+   A bitcoind from before waitforblockheight.
+   """
+
+   def __init__( self ):
+      self.calls = 0
+
+
+   def waitforblockheight( self, height, timeout ):
+      self.calls += 1
+      raise JSONRPCException( {"code": notify.RPC_METHOD_NOT_FOUND, "message": "Method not found"} )
+
+
+class LongPollBlockNotifierTest( unittest.TestCase ):
+
+   def setUp( self ):
+      # a chain we can add one more block to
+      full_chain = mockbitcoind.MockChain.synthetic( 6, seed=1 )
+      raw_blocks = [full_chain.raw_blocks[block_hash] for block_hash in full_chain.block_hashes]
+      self.chain = mockbitcoind.MockChain( raw_blocks[:-1] )
+      self.next_block = raw_blocks[-1]
+
+      self.server = mockbitcoind.MockBitcoindServer( self.chain ).start()
+      self.bitcoind = session.connect_bitcoind( self.server.get_bitcoind_opts() )
+
+      self.reindex_frequency = config.REINDEX_FREQUENCY
+      config.REINDEX_FREQUENCY = TEST_REINDEX_FREQUENCY
+
+
+   def tearDown( self ):
+      config.REINDEX_FREQUENCY = self.reindex_frequency
+      self.server.stop()
+
+
+   def test_new_block( self ):
+      notifier = LongPollBlockNotifier( self.bitcoind, 10 )
+      tip = self.chain.get_height()
+
+      # already have one
+      self.assertTrue( notifier.wait( tip - 1 ) )
+      self.assertTrue( notifier.supported )
+
+      # returns as soon as the next one arrives
+      threading.Timer( 0.2, self.chain.append_block, (self.next_block,) ).start()
+
+      start = time.time()
+      self.assertTrue( notifier.wait( tip ) )
+      self.assertTrue( time.time() - start < 2.0 )
+      self.assertEqual( self.chain.get_height(), tip + 1 )
+
+
+   def test_timeout( self ):
+      notifier = LongPollBlockNotifier( self.bitcoind, 0.5 )
+
+      start = time.time()
+      self.assertFalse( notifier.wait( self.chain.get_height() ) )
+
+      elapsed = time.time() - start
+      self.assertTrue( elapsed >= 0.4 and elapsed < 2.0, "waited %s seconds" % elapsed )
+      self.assertTrue( notifier.supported )
+
+
+   def test_falls_back_to_polling( self ):
+      bitcoind = OldBitcoind()
+      notifier = LongPollBlockNotifier( bitcoind, 10 )
+
+      start = time.time()
+      self.assertFalse( notifier.wait( self.chain.get_height() ) )
+      self.assertFalse( notifier.supported )
+      self.assertTrue( time.time() - start >= TEST_REINDEX_FREQUENCY )
+
+      # doesn't ask again
+      self.assertFalse( notifier.wait( self.chain.get_height() ) )
+      self.assertEqual( bitcoind.calls, 1 )
+
+
+class ZMQBlockNotifierTest( unittest.TestCase ):
+
+   def setUp( self ):
+      if zmq is None:
+         self.skipTest( "pyzmq is not installed" )
+
+      self.context = zmq.Context()
+      self.publisher = self.context.socket( zmq.PUB )
+      self.publisher.setsockopt( zmq.LINGER, 0 )
+      port = self.publisher.bind_to_random_port( "tcp://127.0.0.1" )
+
+      self.notifier = ZMQBlockNotifier( "tcp://127.0.0.1:%s" % port, 0.5 )
+      self.sequence = 0
+
+      # ZMQ drops what's published before the subscription reaches the publisher,
+      # so publish until the notifier hears something
+      for i in xrange(0, 50):
+         self.publish()
+         if self.notifier.wait( None ):
+            break
+      else:
+         self.fail( "Notifier never subscribed" )
+
+
+   def tearDown( self ):
+      self.notifier.close()
+      self.publisher.close()
+      self.context.term()
+
+
+   def publish( self ):
+      """
+      Publish a hashblock message, as bitcoind does.
+      """
+      self.publisher.send_multipart( ["hashblock", "%064x" % self.sequence, str(self.sequence)] )
+      self.sequence += 1
+
+
+   def test_drains_backlog( self ):
+      for i in xrange(0, 10):
+         self.publish()
+
+      time.sleep( 0.2 )
+      self.assertTrue( self.notifier.wait( None ) )
+
+      # nothing left over:  the next wait times out
+      start = time.time()
+      self.assertFalse( self.notifier.wait( None ) )
+      self.assertTrue( time.time() - start >= 0.4 )
+
+
+   def test_timeout( self ):
+      start = time.time()
+      self.assertFalse( self.notifier.wait( None ) )
+
+      elapsed = time.time() - start
+      self.assertTrue( elapsed >= 0.4 and elapsed < 2.0, "waited %s seconds" % elapsed )
+
+
+   def test_ignores_other_topics( self ):
+      self.publisher.send_multipart( ["rawtx", "00"] )
+      self.assertFalse( self.notifier.wait( None ) )
+
+      self.publish()
+      self.assertTrue( self.notifier.wait( None ) )
+
+
+if __name__ == "__main__":
+   unittest.main()
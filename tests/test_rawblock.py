@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""
+Tests for decoding raw blocks and transactions, and classifying
+scripts and encoding addresses as bitcoind does, against known
+blocks, transactions, and the BIP173 and BIP350 address vectors.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import hashlib
+import binascii
+import decimal
+import unittest
+
+import pybitcoin
+
+from virtualchain.lib.blockchain import rawblock
+from virtualchain.lib.blockchain.rawblock import deserialize_block_hex, deserialize_transaction_hex, classify_script_pubkey, bech32_encode_address, \
+        BlockDeserializeError, BITCOIN_NETWORK_PARAMS
+
+# mainnet's genesis block
+GENESIS_BLOCK = "0100000000000000000000000000000000000000000000000000000000000000000000003ba3edfd7a7b12b27ac72c3e67768f617fc81bc3888a51323a9fb8aa4b1e5e4a29ab5f49ffff001d1dac2b7c" + \
+                "0101000000010000000000000000000000000000000000000000000000000000000000000000ffffffff4d04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73ffffffff0100f2052a01000000434104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac00000000"
+GENESIS_BLOCK_HASH = "000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f"
+GENESIS_COINBASE_TXID = "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b"
+GENESIS_COINBASE_SCRIPT = "04ffff001d0104455468652054696d65732030332f4a616e2f32303039204368616e63656c6c6f72206f6e206272696e6b206f66207365636f6e64206261696c6f757420666f722062616e6b73"
+GENESIS_PUBKEY = "04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f"
+
+# the first transaction between people (mainnet block 170)
+BLOCK_170_TX = "0100000001c997a5e56e104102fa209c6a852dd90660a20b2d9c352423edce25857fcd3704000000004847304402204e45e16932b8af514961a1d3a1a25fdf3f4f7732e9d624c6c61548ab5fb8cd410220181522ec8eca07de4860a4acdd12909d831cc56cbbac4622082221a8768d1d0901ffffffff" + \
+               "0200ca9a3b00000000434104ae1a62fe09c5f51b13905f07f06b99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f142c21c1b7303b8a0626f1baded5c72a704f7e6cd84cac00286bee0000000043410411db93e1dcdb8a016b49840f8c53bc1eb68a382e97b1482ecad7b148a6909a5cb2e0eaddfb84ccf9744464f82e160bfa9b8b64f9d4c03f999b8643f656b412a3ac00000000"
+BLOCK_170_TXID = "f4184fc596403b9d638783cf57adfe4c75c605f6356fbc91338530e9831e9e16"
+HAL_PUBKEY = "04ae1a62fe09c5f51b13905f07f06b99a2f7159b2225f374cd378d71302fa28414e7aab37397f554a7df5f142c21c1b7303b8a0626f1baded5c72a704f7e6cd84c"
+
+# BIP143's signed native P2WPKH example:  the first input is P2PK, and the second is P2WPKH
+SEGWIT_TX_PARTS = [
+   "01000000",      # version
+   "0001",          # segwit marker and flag
+   "02fff7f7881a8099afa6940d42d1e7f6362bec38171ea3edf433541db4e4ad969f00000000494830450221008b9d1dc26ba6a9cb62127b02742fa9d754cd3bebf337f7a55d114c8e5cdd30be022040529b194ba3f9281a99f2b1c0a19c0489bc22ede944ccf4ecbab4cc618ef3ed01eeffffff" + \
+         "ef51e1b804cc89d182d279655c3aa89e815b1b309fe287d9b2b55d57b90ec68a0100000000ffffffff",      # inputs
+   "02202cb206000000001976a9148280b37df378db99f66f85c95a783a76ac7a6d5988ac9093510d000000001976a9143bde42dbee7e4dbe6a21b2d50ce2f0167faa815988ac",      # outputs
+   "00" + "0247304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c4518331561406f90300e8f3358f51928d43c212a8caed02de67eebee0121025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357",     # witnesses
+   "11000000"       # locktime
+]
+SEGWIT_TX = "".join( SEGWIT_TX_PARTS )
+SEGWIT_TX_WITNESS = [
+   "304402203609e17b84f6a7d30c80bfa610b5b4542f32a8a0d5447a12fb1366d7f01cc44a0220573a954c4518331561406f90300e8f3358f51928d43c212a8caed02de67eebee01",
+   "025476c2e83188368da1ff3e292e7acafcdb3566bb0ad253f62fc70f07aeee6357"
+]
+
+# (address, scriptPubKey) from BIP173 and BIP350
+SEGWIT_ADDRESSES = [
+   ("bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4", "0014751e76e8199196d454941c45d1b3a323f1433bd6"),
+   ("tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7", "00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262"),
+   ("bc1pw508d6qejxtdg4y5r3zarvary0c5xw7kw508d6qejxtdg4y5r3zarvary0c5xw7kt5nd6y", "5128751e76e8199196d454941c45d1b3a323f1433bd6751e76e8199196d454941c45d1b3a323f1433bd6"),
+   ("bc1sw50qgdz25j", "6002751e"),
+   ("bc1zw508d6qejxtdg4y5r3zarvaryvaxxpcs", "5210751e76e8199196d454941c45d1b3a323"),
+   ("tb1qqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesrxh6hy", "0020000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433"),
+   ("tb1pqqqqp399et2xygdj5xreqhjjvcmzhxw4aywxecjdzew6hylgvsesf3hn0c", "5120000000c4a5cad46221b2a187905e5266362b99d5e91c6ce24d165dab93e86433"),
+   ("bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0", "512079be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798")
+]
+
+
+def sha256d( data ):
+   return hashlib.sha256( hashlib.sha256( data ).digest() ).digest()
+
+
+def classify( script_hex, network="mainnet" ):
+   return classify_script_pubkey( binascii.unhexlify( script_hex ), BITCOIN_NETWORK_PARAMS[network] )
+
+
+class DeserializeTest( unittest.TestCase ):
+
+   def test_genesis_block( self ):
+      block = deserialize_block_hex( GENESIS_BLOCK )
+
+      self.assertEqual( block['hash'], GENESIS_BLOCK_HASH )
+      self.assertEqual( block['previousblockhash'], "00" * 32 )
+      self.assertEqual( block['merkleroot'], GENESIS_COINBASE_TXID )
+      self.assertEqual( block['time'], 1231006505 )
+      self.assertEqual( block['bits'], "1d00ffff" )
+      self.assertEqual( block['nonce'], 2083236893 )
+      self.assertEqual( block['size'], 285 )
+
+      self.assertEqual( len(block['tx']), 1 )
+      coinbase = block['tx'][0]
+      self.assertEqual( coinbase['txid'], GENESIS_COINBASE_TXID )
+      self.assertEqual( coinbase['hash'], GENESIS_COINBASE_TXID )
+      self.assertEqual( coinbase['size'], 204 )
+      self.assertEqual( coinbase['vin'], [{"coinbase": GENESIS_COINBASE_SCRIPT, "sequence": 0xffffffff}] )
+      self.assertEqual( coinbase['vout'], [{
+         "value": decimal.Decimal("50.00000000"),
+         "n": 0,
+         "scriptPubKey": {"hex": "41" + GENESIS_PUBKEY + "ac", "type": "pubkey", "addresses": ["1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"]}
+      }] )
+      self.assertEqual( coinbase['nulldata'], None )
+
+
+   def test_block_170_tx( self ):
+      tx = deserialize_transaction_hex( BLOCK_170_TX )
+
+      self.assertEqual( tx['txid'], BLOCK_170_TXID )
+      self.assertEqual( tx['hash'], BLOCK_170_TXID )
+      self.assertEqual( tx['size'], 275 )
+      self.assertEqual( tx['locktime'], 0 )
+      self.assertEqual( [(input['txid'], input['vout']) for input in tx['vin']], [("0437cd7f8525ceed2324359c2d0ba26006d92d856a9c20fa0241106ee5a597c9", 0)] )
+      self.assertFalse( 'txinwitness' in tx['vin'][0] )
+
+      # to Hal Finney, and the change back to Satoshi
+      self.assertEqual( [output['value'] for output in tx['vout']], [decimal.Decimal("10.00000000"), decimal.Decimal("40.00000000")] )
+      self.assertEqual( [str(output['value']) for output in tx['vout']], ["10.00000000", "40.00000000"] )
+      self.assertEqual( [output['scriptPubKey']['addresses'] for output in tx['vout']], [["1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3"], ["12cbQLTFMXRnSzktFkuoG3eHoMeFtpTu3S"]] )
+
+
+   def test_segwit_tx( self ):
+      tx = deserialize_transaction_hex( SEGWIT_TX )
+
+      # the txid covers the transaction without its marker, flag, and witnesses; the hash covers all of it
+      stripped = SEGWIT_TX_PARTS[0] + SEGWIT_TX_PARTS[2] + SEGWIT_TX_PARTS[3] + SEGWIT_TX_PARTS[5]
+      self.assertEqual( tx['txid'], binascii.hexlify( sha256d( binascii.unhexlify( stripped ) )[::-1] ) )
+      self.assertEqual( tx['hash'], binascii.hexlify( sha256d( binascii.unhexlify( SEGWIT_TX ) )[::-1] ) )
+      self.assertNotEqual( tx['txid'], tx['hash'] )
+      self.assertEqual( tx['size'], len(SEGWIT_TX) / 2 )
+      self.assertEqual( tx['locktime'], 17 )
+
+      self.assertEqual( [(input['txid'], input['vout'], input['sequence']) for input in tx['vin']], [
+         ("9f96ade4b41d5433f4eda31e1738ec2b36f6e7d1420d94a6af99801a88f7f7ff", 0, 0xffffffee),
+         ("8ac60eb9575db5b2d987e29f301b5b819ea83a5c6579d282d189cc04b8e151ef", 1, 0xffffffff)
+      ] )
+
+      # the P2PK input has no witness, and the P2WPKH one has a signature and a public key
+      self.assertFalse( 'txinwitness' in tx['vin'][0] )
+      self.assertEqual( tx['vin'][1]['scriptSig'], {"hex": ""} )
+      self.assertEqual( tx['vin'][1]['txinwitness'], SEGWIT_TX_WITNESS )
+
+      self.assertEqual( [str(output['value']) for output in tx['vout']], ["1.12340000", "2.23450000"] )
+      self.assertEqual( [output['scriptPubKey']['type'] for output in tx['vout']], ["pubkeyhash", "pubkeyhash"] )
+
+
+   def test_block_with_segwit_tx( self ):
+      # the genesis block's header and coinbase, followed by the segwit transaction
+      coinbase = GENESIS_BLOCK[162:]
+      block = deserialize_block_hex( GENESIS_BLOCK[:160] + "02" + coinbase + SEGWIT_TX )
+
+      self.assertEqual( len(block['tx']), 2 )
+      self.assertEqual( block['tx'][0]['txid'], GENESIS_COINBASE_TXID )
+      self.assertEqual( block['tx'][1]['txid'], deserialize_transaction_hex( SEGWIT_TX )['txid'] )
+      self.assertEqual( block['size'], 80 + 1 + len(coinbase) / 2 + len(SEGWIT_TX) / 2 )
+
+
+   def test_nulldata( self ):
+      # the coinbase of the genesis block, paying to a nulldata output instead
+      tx_hex = GENESIS_BLOCK[162:].replace( "0100f2052a01000000" + "43" + "41" + GENESIS_PUBKEY + "ac", "01" + "0000000000000000" + "07" + "6a0569642b6869" )
+      tx = deserialize_transaction_hex( tx_hex )
+
+      self.assertEqual( tx['vout'][0]['scriptPubKey'], {"hex": "6a0569642b6869", "type": "nulldata"} )
+      self.assertEqual( str(tx['vout'][0]['value']), "0E-8" )
+      self.assertEqual( tx['nulldata'], "69642b6869" )
+      self.assertEqual( tx['nulldata_bin'], "id+hi" )
+
+
+   def test_truncated( self ):
+      self.assertRaises( BlockDeserializeError, deserialize_block_hex, GENESIS_BLOCK[:-10] )
+      self.assertRaises( BlockDeserializeError, deserialize_block_hex, GENESIS_BLOCK[:150] )
+      self.assertRaises( BlockDeserializeError, deserialize_transaction_hex, SEGWIT_TX[:-20] )
+
+
+class ScriptTest( unittest.TestCase ):
+
+   def test_segwit_addresses( self ):
+      for (address, script_hex) in SEGWIT_ADDRESSES:
+         script = binascii.unhexlify( script_hex )
+         witness_version = 0 if ord(script[0]) == 0 else ord(script[0]) - 0x50
+         self.assertEqual( bech32_encode_address( address[:2], witness_version, script[2:] ), address )
+
+         network = "mainnet" if address.startswith("bc") else "testnet"
+         script_type, addresses = classify( script_hex, network=network )
+         self.assertEqual( addresses, [address] )
+
+
+   def test_segwit_types( self ):
+      self.assertEqual( classify( SEGWIT_ADDRESSES[0][1] )[0], "witness_v0_keyhash" )
+      self.assertEqual( classify( SEGWIT_ADDRESSES[1][1], network="testnet" )[0], "witness_v0_scripthash" )
+      self.assertEqual( classify( SEGWIT_ADDRESSES[7][1] )[0], "witness_v1_taproot" )
+      self.assertEqual( classify( SEGWIT_ADDRESSES[2][1] )[0], "witness_unknown" )
+      self.assertEqual( classify( SEGWIT_ADDRESSES[3][1] )[0], "witness_unknown" )
+
+      # version 0 programs must be 20 or 32 bytes
+      self.assertEqual( classify( "0010751e76e8199196d454941c45d1b3a323" ), ("nonstandard", None) )
+
+      # regtest addresses
+      self.assertTrue( classify( SEGWIT_ADDRESSES[0][1], network="regtest" )[1][0].startswith( "bcrt1q" ) )
+
+
+   def test_base58_types( self ):
+      self.assertEqual( classify( "76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac" ), ("pubkeyhash", ["1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"]) )
+
+      script_type, addresses = classify( "a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1887" )
+      self.assertEqual( script_type, "scripthash" )
+      self.assertTrue( addresses[0].startswith( "3" ) )
+      self.assertEqual( pybitcoin.b58check_decode( addresses[0] ), binascii.unhexlify( "62e907b15cbf27d5425399ebf6f0fb50ebb88f18" ) )
+
+      script_type, addresses = classify( "76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac", network="testnet" )
+      self.assertTrue( addresses[0][0] in "mn" )
+
+
+   def test_multisig( self ):
+      script_hex = "51" + "41" + GENESIS_PUBKEY + "41" + HAL_PUBKEY + "52" + "ae"
+      self.assertEqual( classify( script_hex ), ("multisig", ["1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa", "1Q2TWHE3GMdB6BZKafqwxXtWAWgFt5Jvm3"]) )
+
+      # 3 required, but only 2 keys
+      self.assertEqual( classify( "53" + "41" + GENESIS_PUBKEY + "41" + HAL_PUBKEY + "52" + "ae" ), ("nonstandard", None) )
+
+
+   def test_nulldata_and_nonstandard( self ):
+      self.assertEqual( classify( "6a" ), ("nulldata", None) )
+      self.assertEqual( classify( "6a0369642b" ), ("nulldata", None) )
+      self.assertEqual( classify( "6a0369642b0102" ), ("nulldata", None) )
+
+      # not push-only, or a push that runs off the end
+      self.assertEqual( classify( "6a0369642bac" ), ("nonstandard", None) )
+      self.assertEqual( classify( "6a0569642b" ), ("nonstandard", None) )
+
+      self.assertEqual( classify( "" ), ("nonstandard", None) )
+      self.assertEqual( classify( "51" ), ("nonstandard", None) )
+
+
+if __name__ == "__main__":
+   unittest.main()
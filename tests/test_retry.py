@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Tests for call_bitcoind()'s retries, hedging, deadlines and circuit
+breaker, against a mock bitcoind that injects faults (see mockbitcoind.py).
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import time
+import threading
+import unittest
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+import virtualchain
+from virtualchain.lib.blockchain import retry, mockbitcoind, get_fetch_metrics, reset_fetch_metrics
+from virtualchain.lib.blockchain.retry import call_bitcoind, get_circuit_breaker, CircuitBreaker, CircuitOpen, RPCDeadlineExceeded
+from virtualchain.lib.workpool import multiprocess_bitcoind
+
+# retry quickly, and don't hedge or break unless a test asks to
+TEST_OPTS = {
+   "bitcoind_rpc_max_attempts": 3,
+   "bitcoind_rpc_deadline": 10,
+   "bitcoind_rpc_retry_delay": 0.01,
+   "bitcoind_rpc_retry_max_delay": 0.02,
+   "bitcoind_rpc_hedge_percentile": 0,
+   "bitcoind_rpc_breaker_failures": 0
+}
+
+
+def getblockcount( bitcoind ):
+   return bitcoind.getblockcount()
+
+
+class CallBitcoindTest( unittest.TestCase ):
+
+   @classmethod
+   def setUpClass( cls ):
+      cls.chain = mockbitcoind.MockChain.synthetic( 5, seed=1 )
+      cls.server = mockbitcoind.MockBitcoindServer( cls.chain, seed=1 ).start()
+      virtualchain.setup_virtualchain( virtualchain.impl_ref.reference, bitcoind_connection_factory=cls.server.connect_bitcoind )
+
+
+   @classmethod
+   def tearDownClass( cls ):
+      cls.server.stop()
+
+
+   def setUp( self ):
+      self.server.latency = 0
+      self.server.error_rate = 0
+      self.server.drop_rate = 0
+
+      # fresh breakers and latency histories, and a fresh connection
+      retry.process_local_retry_state = None
+      reset_fetch_metrics()
+      multiprocess_bitcoind( self.get_opts(), reset=True )
+
+
+   def get_opts( self, **overrides ):
+      opts = dict(TEST_OPTS)
+      opts.update( overrides )
+      return self.server.get_bitcoind_opts( opts )
+
+
+   def get_calls( self, method ):
+      return self.server.get_stats().get( "calls.%s" % method, 0 )
+
+
+   def warm_up( self, opts, kind, count=retry.MIN_LATENCY_SAMPLES ):
+      """
+      Make enough fast queries of a kind that they get hedged.
+      """
+      for i in xrange(0, count):
+         call_bitcoind( opts, "getblockcount", getblockcount, kind=kind )
+
+
+   def test_retries_errors( self ):
+      opts = self.get_opts()
+      self.server.error_rate = 1.0
+
+      before = self.get_calls( "getblockcount" )
+      self.assertRaises( JSONRPCException, call_bitcoind, opts, "getblockcount", getblockcount )
+      self.assertEqual( self.get_calls( "getblockcount" ) - before, TEST_OPTS["bitcoind_rpc_max_attempts"] )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["retries"], TEST_OPTS["bitcoind_rpc_max_attempts"] - 1 )
+
+      self.server.error_rate = 0
+      self.assertEqual( call_bitcoind( opts, "getblockcount", getblockcount ), self.chain.get_height() )
+
+
+   def test_give_up( self ):
+      opts = self.get_opts()
+      self.server.error_rate = 1.0
+      given_up = []
+
+      def give_up( e ):
+         given_up.append( e )
+         return isinstance( e, JSONRPCException ) and e.error['code'] == mockbitcoind.INJECTED_ERROR['code']
+
+      before = self.get_calls( "getblockcount" )
+      self.assertRaises( JSONRPCException, call_bitcoind, opts, "getblockcount", getblockcount, give_up=give_up )
+
+      # no retries
+      self.assertEqual( self.get_calls( "getblockcount" ) - before, 1 )
+      self.assertEqual( len(given_up), 1 )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["retries"], 0 )
+
+
+   def test_breaker( self ):
+      opts = self.get_opts( bitcoind_rpc_breaker_failures=2, bitcoind_rpc_breaker_timeout=0.5, bitcoind_rpc_max_attempts=2 )
+      breaker = get_circuit_breaker( opts )
+
+      # bitcoind stops answering:  two failures in a row open the breaker
+      self.server.drop_rate = 1.0
+      self.assertRaises( Exception, call_bitcoind, opts, "getblockcount", getblockcount )
+      self.assertEqual( breaker.state, CircuitBreaker.OPEN )
+      self.assertEqual( get_fetch_metrics()["connections"]["breaker_opened"], 1 )
+
+      # while it's open, queries that can't wait it out fail without being sent
+      before = self.server.get_stats().get( "requests", 0 )
+      self.assertRaises( CircuitOpen, call_bitcoind, self.get_opts( bitcoind_rpc_breaker_failures=2, bitcoind_rpc_breaker_timeout=0.5, bitcoind_rpc_deadline=0.1 ), "getblockcount", getblockcount )
+      self.assertEqual( self.server.get_stats().get( "requests", 0 ), before )
+
+      # once it times out, it's half-open:  one trial query goes through, and the rest wait
+      time.sleep( 0.6 )
+      self.assertEqual( breaker.acquire(), 0 )
+      self.assertEqual( breaker.state, CircuitBreaker.HALF_OPEN )
+      self.assertEqual( breaker.acquire(), retry.BREAKER_POLL_INTERVAL )
+
+      # the trial fails:  open again, for twice as long
+      breaker.record_failure()
+      self.assertEqual( breaker.state, CircuitBreaker.OPEN )
+      self.assertEqual( breaker.timeout, 1.0 )
+
+      # bitcoind comes back.  The next query waits for the breaker to go half-open, is the trial, and closes it
+      self.server.drop_rate = 0
+      start = time.time()
+      self.assertEqual( call_bitcoind( opts, "getblockcount", getblockcount ), self.chain.get_height() )
+      self.assertTrue( time.time() - start >= 0.5 )
+      self.assertEqual( breaker.state, CircuitBreaker.CLOSED )
+      self.assertEqual( breaker.timeout, 0.5 )
+      self.assertEqual( get_fetch_metrics()["connections"]["breaker_closed"], 1 )
+
+
+   def test_error_responses_dont_open_breaker( self ):
+      opts = self.get_opts( bitcoind_rpc_breaker_failures=2, bitcoind_rpc_max_attempts=4 )
+      self.server.error_rate = 1.0
+
+      self.assertRaises( JSONRPCException, call_bitcoind, opts, "getblockcount", getblockcount )
+      self.assertEqual( get_circuit_breaker( opts ).state, CircuitBreaker.CLOSED )
+
+
+   def test_hedges_stragglers( self ):
+      opts = self.get_opts( bitcoind_rpc_hedge_percentile=95, bitcoind_rpc_hedge_min_delay=0.2 )
+      self.warm_up( opts, "test_hedges_stragglers" )
+
+      # the first try straggles, but its hedge (sent 0.2s later) doesn't
+      self.server.latency = 3.0
+      threading.Timer( 0.1, setattr, (self.server, "latency", 0) ).start()
+
+      before = self.get_calls( "getblockcount" )
+      start = time.time()
+      self.assertEqual( call_bitcoind( opts, "getblockcount", getblockcount, kind="test_hedges_stragglers" ), self.chain.get_height() )
+
+      self.assertTrue( time.time() - start < 2.0 )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["hedges"], 1 )
+
+      # both tries got sent
+      time.sleep( 3.0 )
+      self.assertEqual( self.get_calls( "getblockcount" ) - before, 2 )
+
+
+   def test_no_hedging_without_history( self ):
+      opts = self.get_opts( bitcoind_rpc_hedge_percentile=95, bitcoind_rpc_hedge_min_delay=0.05 )
+      self.server.latency = 0.2
+
+      self.assertEqual( call_bitcoind( opts, "getblockcount", getblockcount, kind="test_no_hedging_without_history" ), self.chain.get_height() )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["hedges"], 0 )
+
+
+   def test_deadline_on_hung_node( self ):
+      opts = self.get_opts( bitcoind_rpc_hedge_percentile=95, bitcoind_rpc_hedge_min_delay=0.2, bitcoind_rpc_deadline=1.0 )
+      self.warm_up( opts, "test_deadline_on_hung_node" )
+
+      # bitcoind hangs, for longer than the deadline
+      self.server.latency = 3.0
+
+      start = time.time()
+      self.assertRaises( RPCDeadlineExceeded, call_bitcoind, opts, "getblockcount", getblockcount, kind="test_deadline_on_hung_node" )
+
+      elapsed = time.time() - start
+      self.assertTrue( elapsed >= 0.9 and elapsed < 2.0, "gave up after %s seconds" % elapsed )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["hedges"], 1 )
+      self.assertEqual( get_fetch_metrics()["rpc"]["getblockcount"]["deadlines_exceeded"], 1 )
+
+      # let the hung queries finish before the next test
+      self.server.latency = 0
+      time.sleep( 3.0 )
+
+
+if __name__ == "__main__":
+   unittest.main()
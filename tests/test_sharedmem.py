@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""
+Tests for handing transactions back from pool workers through
+shared memory segments.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import os
+import copy
+import shutil
+import tempfile
+import unittest
+
+from virtualchain.lib.blockchain.sharedmem import SharedTxs, SharedOutputs, share_txs, remove_shared_segments, SEGMENT_PREFIX
+from virtualchain.lib.blockchain.txrecord import compact_outputs, trim_input, trim_output
+from virtualchain.lib.blockchain.nulldata import has_nulldata
+from virtualchain.lib.blockchain.mockbitcoind import MockChain, MockBitcoind
+
+
+def get_test_txs( num_blocks=4 ):
+   """
+   Get a synthetic chain's transactions, as bitcoind gives them.
+   """
+   chain = MockChain.synthetic( num_blocks, txs_per_block=8, nulldata_rate=0.4, seed=2 )
+   bitcoind = MockBitcoind( chain )
+
+   txs = []
+   for block_hash in chain.block_hashes:
+      txs += bitcoind.getblock( block_hash, 2 )['tx']
+
+   return txs
+
+
+def get_compact_form( tx ):
+   """
+   Get what should come back for a transaction without nulldata.
+   """
+   return {"txid": tx['txid'], "vin": [trim_input( input ) for input in tx['vin']], "vout": [trim_output( output ) for output in tx['vout']]}
+
+
+class SharedTxListTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.shm_dir = tempfile.mkdtemp()
+      self.txs = get_test_txs()
+
+
+   def tearDown( self ):
+      shutil.rmtree( self.shm_dir )
+
+
+   def test_round_trip( self ):
+      # as a block range fetch gives them:  None for transactions that could not be fetched
+      txs = [None] + self.txs[:10] + [None, None] + self.txs[10:] + [None]
+      nulldata_txs = [tx for tx in self.txs if has_nulldata( tx )]
+      self.assertTrue( len(nulldata_txs) > 0 and len(nulldata_txs) < len(self.txs) )
+
+      expected = copy.deepcopy( txs )
+      shared_txs = share_txs( txs, self.shm_dir, os.getpid() )
+      self.assertEqual( len(shared_txs), len(txs) )
+      self.assertEqual( txs, expected )
+
+      shared_tx_list = shared_txs.load()
+      self.assertFalse( os.path.exists( shared_txs.path ) )
+      self.assertEqual( len(shared_tx_list), len(txs) )
+
+      for i in xrange(0, len(txs)):
+         tx = txs[i]
+         if tx is None:
+            self.assertEqual( shared_tx_list[i], None )
+            self.assertEqual( shared_tx_list.get_txid( i ), None )
+            self.assertFalse( shared_tx_list.has_nulldata( i ) )
+            continue
+
+         self.assertEqual( shared_tx_list.get_txid( i ), tx['txid'] )
+         self.assertEqual( shared_tx_list.has_nulldata( i ), has_nulldata( tx ) )
+
+         if has_nulldata( tx ):
+            # stored whole
+            self.assertEqual( shared_tx_list[i], tx )
+         else:
+            self.assertEqual( shared_tx_list[i], get_compact_form( tx ) )
+
+         self.assertEqual( shared_tx_list.get_outputs( i ), shared_tx_list[i]['vout'] )
+
+         # decoded once, and handed back the same each time
+         self.assertTrue( shared_tx_list[i] is shared_tx_list[i] )
+
+      self.assertEqual( list(shared_tx_list), [shared_tx_list[i] for i in xrange(0, len(txs))] )
+      self.assertRaises( IndexError, shared_tx_list.__getitem__, len(txs) )
+      self.assertRaises( IndexError, shared_tx_list.get_txid, -1 )
+
+
+   def test_whole_txs( self ):
+      # transactions without txids (i.e. decoded from raw ones by a caller that dropped them) are stored whole
+      txs = copy.deepcopy( self.txs[:5] )
+      for tx in txs:
+         del tx['txid']
+
+      shared_tx_list = share_txs( txs, self.shm_dir, os.getpid() ).load()
+      self.assertEqual( list(shared_tx_list), txs )
+      self.assertEqual( [shared_tx_list.get_txid( i ) for i in xrange(0, 5)], [None] * 5 )
+
+
+   def test_empty( self ):
+      shared_txs = share_txs( [], self.shm_dir, os.getpid() )
+      self.assertEqual( len(shared_txs), 0 )
+
+      shared_tx_list = shared_txs.load()
+      self.assertEqual( len(shared_tx_list), 0 )
+      self.assertEqual( list(shared_tx_list), [] )
+      self.assertEqual( os.listdir( self.shm_dir ), [] )
+
+
+   def test_invalid_segment( self ):
+      shared_txs = share_txs( self.txs[:3], self.shm_dir, os.getpid() )
+      self.assertRaises( Exception, SharedTxs( shared_txs.path, 4, shared_txs.size ).load )
+
+      # it is removed even so
+      self.assertEqual( os.listdir( self.shm_dir ), [] )
+
+
+   def test_shared_outputs( self ):
+      compact_txs = [tx for tx in self.txs if not has_nulldata( tx )]
+      nulldata_tx = [tx for tx in self.txs if has_nulldata( tx )][0]
+      shared_tx_list = share_txs( compact_txs[:2] + [nulldata_tx], self.shm_dir, os.getpid() ).load()
+
+      outputs = SharedOutputs()
+      outputs.put_shared( compact_txs[0]['txid'], shared_tx_list, 0 )
+      outputs.put_shared( nulldata_tx['txid'], shared_tx_list, 2 )
+      outputs.put_compact( compact_txs[2]['txid'], compact_outputs( compact_txs[2]['vout'] ) )
+      outputs[compact_txs[3]['txid']] = compact_txs[3]['vout']
+
+      self.assertEqual( len(outputs), 4 )
+      self.assertTrue( outputs.has_key( compact_txs[0]['txid'] ) )
+      self.assertFalse( outputs.has_key( compact_txs[1]['txid'] ) )
+      self.assertEqual( outputs.get( compact_txs[1]['txid'] ), None )
+      self.assertEqual( outputs.get( compact_txs[1]['txid'], [] ), [] )
+
+      self.assertEqual( outputs[compact_txs[0]['txid']], get_compact_form( compact_txs[0] )['vout'] )
+      self.assertEqual( outputs.get( nulldata_tx['txid'] ), nulldata_tx['vout'] )
+      self.assertEqual( outputs[compact_txs[2]['txid']], get_compact_form( compact_txs[2] )['vout'] )
+      self.assertEqual( outputs[compact_txs[3]['txid']], compact_txs[3]['vout'] )
+
+      # decoded once
+      self.assertTrue( outputs[compact_txs[0]['txid']] is shared_tx_list[0]['vout'] )
+      self.assertTrue( outputs[compact_txs[2]['txid']] is outputs[compact_txs[2]['txid']] )
+
+
+class RemoveSharedSegmentsTest( unittest.TestCase ):
+
+   def setUp( self ):
+      self.shm_dir = tempfile.mkdtemp()
+
+
+   def tearDown( self ):
+      shutil.rmtree( self.shm_dir )
+
+
+   def test_remove( self ):
+      txs = get_test_txs( num_blocks=1 )
+      other_pid = os.getpid() + 1
+
+      for i in xrange(0, 3):
+         share_txs( txs, self.shm_dir, os.getpid() )
+
+      other_shared_txs = share_txs( txs, self.shm_dir, other_pid )
+
+      # not ours
+      with open( os.path.join( self.shm_dir, "%s%s" % (SEGMENT_PREFIX, os.getpid()) ), "w" ) as f:
+         f.write( "" )
+
+      self.assertEqual( remove_shared_segments( self.shm_dir ), 3 )
+      self.assertEqual( remove_shared_segments( self.shm_dir ), 0 )
+      self.assertEqual( sorted( os.listdir( self.shm_dir ) ), sorted( [os.path.basename( other_shared_txs.path ), "%s%s" % (SEGMENT_PREFIX, os.getpid())] ) )
+
+      self.assertEqual( remove_shared_segments( self.shm_dir, pid=other_pid ), 1 )
+      self.assertEqual( os.listdir( self.shm_dir ), ["%s%s" % (SEGMENT_PREFIX, os.getpid())] )
+
+
+if __name__ == "__main__":
+   unittest.main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+"""
+Tests for the transaction records handed to the state engine, the
+compact encodings of transactions' inputs and outputs, and filtering
+transactions down to the ones with nulldata.
+
+Run from the top of the repository with:
+   python -m unittest discover -s tests
+"""
+
+import copy
+import decimal
+import binascii
+import cPickle
+import unittest
+
+from virtualchain.lib.blockchain.txrecord import NulldataTx, compact_inputs, expand_inputs, compact_outputs, expand_outputs, \
+        filter_nulldata_txs, trim_input, trim_output, get_tx_size
+from virtualchain.lib.blockchain.nulldata import get_nulldata, is_virtualchain_nulldata
+from virtualchain.lib.blockchain.mockbitcoind import MockChain, MockBitcoind, SYNTHETIC_OPCODES
+
+# as bitcoind gives them (verbosity 2; values are parsed as Decimals)
+COINBASE_TX = {
+   "txid": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+   "hash": "4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b",
+   "version": 1,
+   "size": 204,
+   "vin": [{"coinbase": "04ffff001d0104", "sequence": 4294967295}],
+   "vout": [{
+      "value": decimal.Decimal("50.00000000"),
+      "n": 0,
+      "scriptPubKey": {
+         "asm": "04678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5f OP_CHECKSIG",
+         "hex": "4104678afdb0fe5548271967f1a67130b7105cd6a828e03909a67962e0ea1f61deb649f6bc3f4cef38c4f35504e51ec112de5c384df7ba0b8d578a4c702b6bf11d5fac",
+         "type": "pubkey"
+      }
+   }]
+}
+
+NULLDATA_TX = {
+   "txid": "%064x" % 1,
+   "size": 250,
+   "vin": [{
+      "txid": "%064x" % 2,
+      "vout": 1,
+      "scriptSig": {"asm": "", "hex": ""},
+      "txinwitness": ["3044", "02ab"],
+      "sequence": 4294967293
+   }],
+   "vout": [
+      {"value": decimal.Decimal("0.00000000"), "n": 0, "scriptPubKey": {"asm": "OP_RETURN 69642b", "hex": "6a0369642b", "type": "nulldata"}},
+      {"value": decimal.Decimal("0.00100000"), "n": 1, "scriptPubKey": {"asm": "0 751e76e8199196d454941c45d1b3a323f1433bd6", "hex": "0014751e76e8199196d454941c45d1b3a323f1433bd6", "type": "witness_v0_keyhash", "address": "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4"}},
+      {"value": decimal.Decimal("12.50000000"), "n": 2, "scriptPubKey": {"asm": "OP_DUP OP_HASH160 62e907b15cbf27d5425399ebf6f0fb50ebb88f18 OP_EQUALVERIFY OP_CHECKSIG", "hex": "76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac", "type": "pubkeyhash", "reqSigs": 1, "addresses": ["1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa"]}}
+   ]
+}
+
+
+def make_record( tx, compact=False ):
+   return NulldataTx( tx, "69642b", "id+", [{"script_pubkey": "00", "amount": 1, "addresses": None}], 1000, txindex=3, strings={}, compact=compact )
+
+
+class NulldataTxTest( unittest.TestCase ):
+
+   def test_keeps_bitcoind_fields( self ):
+      tx = copy.deepcopy( NULLDATA_TX )
+      record = make_record( tx )
+
+      # exactly as bitcoind gave them, down to how values are written
+      self.assertEqual( record['vin'], NULLDATA_TX['vin'] )
+      self.assertEqual( record['vout'], NULLDATA_TX['vout'] )
+      self.assertEqual( [str(output['value']) for output in record['vout']], ["0E-8", "0.00100000", "12.50000000"] )
+
+      self.assertEqual( record['txid'], NULLDATA_TX['txid'] )
+      self.assertEqual( record['txindex'], 3 )
+      self.assertEqual( record['fee'], 1000 )
+      self.assertEqual( record['size'], 250 )
+      self.assertEqual( record.get('nulldata'), "69642b" )
+      self.assertEqual( record.get('hex', "missing"), "missing" )
+      self.assertTrue( 'senders' in record and record.has_key('vout') and 'hex' not in record )
+
+      record['fee'] = 2000
+      self.assertEqual( record['fee'], 2000 )
+      self.assertRaises( KeyError, record.__setitem__, 'hex', "00" )
+
+      self.assertEqual( sorted( record.to_dict().keys() ), sorted( NulldataTx.FIELDS + ('vin', 'vout') ) )
+
+
+   def test_compact( self ):
+      record = make_record( copy.deepcopy( NULLDATA_TX ), compact=True )
+
+      self.assertEqual( record['vin'], [{"txid": "%064x" % 2, "vout": 1}] )
+
+      outputs = record['vout']
+      for (output, original) in zip( outputs, NULLDATA_TX['vout'] ):
+         self.assertEqual( output['n'], original['n'] )
+         self.assertEqual( str(output['value']), str(original['value']) )
+         self.assertEqual( output['scriptPubKey'], dict( [(key, value) for (key, value) in original['scriptPubKey'].items() if key in ('hex', 'type', 'address', 'addresses')] ) )
+
+      # a new list each time, so callers can't change the record
+      outputs[1]['value'] = 0
+      self.assertEqual( record['vout'][1]['value'], decimal.Decimal("0.00100000") )
+
+
+   def test_coinbase( self ):
+      record = make_record( COINBASE_TX, compact=True )
+      self.assertEqual( record['vin'], [{"coinbase": "04ffff001d0104"}] )
+      self.assertEqual( str(record['vout'][0]['value']), "50.00000000" )
+
+
+   def test_pickle( self ):
+      for compact in [False, True]:
+         record = make_record( copy.deepcopy( NULLDATA_TX ), compact=compact )
+         copied = cPickle.loads( cPickle.dumps( record, cPickle.HIGHEST_PROTOCOL ) )
+
+         self.assertEqual( copied, record )
+         self.assertEqual( copied['vout'], record['vout'] )
+         self.assertFalse( copied != record )
+
+
+class CompactEncodingTest( unittest.TestCase ):
+
+   def test_round_trip( self ):
+      for tx in [COINBASE_TX, NULLDATA_TX]:
+         inputs = expand_inputs( compact_inputs( tx['vin'] ) )
+         outputs = expand_outputs( compact_outputs( tx['vout'] ) )
+
+         self.assertEqual( len(inputs), len(tx['vin']) )
+         self.assertEqual( [repr(output['value']) for output in outputs], [repr(output['value']) for output in tx['vout']] )
+         self.assertEqual( [output['scriptPubKey'].get('address') for output in outputs], [output['scriptPubKey'].get('address') for output in tx['vout']] )
+         self.assertEqual( [output['scriptPubKey'].get('addresses') for output in outputs], [output['scriptPubKey'].get('addresses') for output in tx['vout']] )
+
+
+   def test_interning( self ):
+      strings = {}
+      first = compact_outputs( copy.deepcopy( NULLDATA_TX['vout'] ), strings=strings )
+      second = compact_outputs( copy.deepcopy( NULLDATA_TX['vout'] ), strings=strings )
+
+      self.assertTrue( first[1][2][2] is second[1][2][2] )
+      self.assertTrue( first[2][2][2][0] is second[2][2][2][0] )
+
+
+class FilterNulldataTxsTest( unittest.TestCase ):
+
+   def setUp( self ):
+      chain = MockChain.synthetic( 20, txs_per_block=10, nulldata_rate=0.4, seed=5 )
+      bitcoind = MockBitcoind( chain )
+
+      # several blocks' worth, so that nulldata transactions spend others in the list
+      self.txs = [None]
+      self.txs_with_prevouts = [None]
+      for block_hash in chain.block_hashes:
+         self.txs += bitcoind.getblock( block_hash, 2 )['tx'] + [None]
+         self.txs_with_prevouts += bitcoind.getblock( block_hash, 3 )['tx'] + [None]
+
+
+   def get_expected( self, txs, prefilter=None ):
+      """
+      Find the nulldata transactions the way the unfiltered path does:  by looking at every one.
+      Return ({index: (tx, nulldata)}, number dropped by the prefilter)
+      """
+      nulldata_txs = {}
+      dropped = 0
+      for k in xrange(0, len(txs)):
+         nulldata = get_nulldata( txs[k] ) if txs[k] is not None else None
+         if nulldata is None:
+            continue
+
+         if prefilter is not None and not is_virtualchain_nulldata( nulldata, prefilter[0], prefilter[1] ):
+            dropped += 1
+            continue
+
+         nulldata_txs[k] = (txs[k], nulldata)
+
+      return (nulldata_txs, dropped)
+
+
+   def check_nulldata_txs( self, filtered, txs, prefilter=None, compact=False ):
+      expected, dropped = self.get_expected( txs, prefilter=prefilter )
+
+      self.assertEqual( len(filtered), len(txs) )
+      self.assertEqual( filtered.dropped, dropped )
+      self.assertEqual( [k for (k, _) in filtered.nulldata_txs], sorted( expected.keys() ) )
+
+      for (k, trimmed) in filtered.nulldata_txs:
+         tx, nulldata = expected[k]
+         self.assertEqual( trimmed['txid'], tx['txid'] )
+         self.assertEqual( trimmed['size'], get_tx_size( tx ) )
+         self.assertEqual( trimmed['nulldata'], nulldata )
+         self.assertEqual( trimmed['nulldata_bin'], binascii.unhexlify( nulldata ) )
+
+         if compact:
+            self.assertEqual( trimmed['vin'], [trim_input( input ) for input in tx['vin']] )
+            self.assertEqual( trimmed['vout'], [trim_output( output ) for output in tx['vout']] )
+         else:
+            self.assertEqual( trimmed['vin'], tx['vin'] )
+            self.assertEqual( trimmed['vout'], tx['vout'] )
+
+      return expected
+
+
+   def test_nulldata_txs( self ):
+      for txs in [self.txs, self.txs_with_prevouts]:
+         for compact in [False, True]:
+            expected = self.check_nulldata_txs( filter_nulldata_txs( txs, compact=compact ), txs, compact=compact )
+            self.assertTrue( len(expected) > 0 )
+
+
+   def test_prefilter( self ):
+      # every synthetic operation matches
+      prefilter = ("id", SYNTHETIC_OPCODES)
+      filtered = filter_nulldata_txs( self.txs, prefilter=prefilter )
+      self.check_nulldata_txs( filtered, self.txs, prefilter=prefilter )
+      self.assertEqual( filtered.dropped, 0 )
+      self.assertEqual( [k for (k, _) in filtered.nulldata_txs], [k for (k, _) in filter_nulldata_txs( self.txs ).nulldata_txs] )
+
+      # some of them match
+      prefilter = ("id", SYNTHETIC_OPCODES[:2])
+      filtered = filter_nulldata_txs( self.txs, prefilter=prefilter )
+      self.check_nulldata_txs( filtered, self.txs, prefilter=prefilter )
+      self.assertTrue( filtered.dropped > 0 and len(filtered.nulldata_txs) > 0 )
+
+      # any opcode
+      prefilter = ("id", None)
+      self.check_nulldata_txs( filter_nulldata_txs( self.txs, prefilter=prefilter ), self.txs, prefilter=prefilter )
+
+      # none of them match
+      prefilter = ("xx", SYNTHETIC_OPCODES)
+      filtered = filter_nulldata_txs( self.txs, prefilter=prefilter )
+      self.check_nulldata_txs( filtered, self.txs, prefilter=prefilter )
+      self.assertEqual( filtered.nulldata_txs, [] )
+      self.assertEqual( filtered.others, [] )
+
+
+   def test_spent_outputs( self ):
+      for prefilter in [None, ("id", SYNTHETIC_OPCODES[:2])]:
+         filtered = filter_nulldata_txs( self.txs, prefilter=prefilter )
+         expected, _ = self.get_expected( self.txs, prefilter=prefilter )
+
+         # only the outputs of the other transactions that the kept ones spend
+         spent_txids = set( [input['txid'] for (tx, _) in expected.values() for input in tx['vin'] if 'txid' in input] )
+         spent_txs = [tx for k, tx in enumerate( self.txs ) if tx is not None and k not in expected and tx['txid'] in spent_txids]
+         self.assertTrue( len(spent_txs) > 0 )
+
+         self.assertEqual( filtered.others, [(tx['txid'], None, compact_outputs( tx['vout'] )) for tx in spent_txs] )
+
+      # bitcoind already gave the outputs they spend
+      self.assertEqual( filter_nulldata_txs( self.txs_with_prevouts ).others, [] )
+
+
+   def test_keep_all( self ):
+      for prefilter in [None, ("id", SYNTHETIC_OPCODES[:2])]:
+         for txs in [self.txs, self.txs_with_prevouts]:
+            filtered = filter_nulldata_txs( txs, keep_all=True, prefilter=prefilter )
+            self.check_nulldata_txs( filtered, txs, prefilter=prefilter )
+
+            # everything else, including the nulldata transactions the prefilter dropped
+            expected, _ = self.get_expected( txs, prefilter=prefilter )
+            others = [tx for k, tx in enumerate( txs ) if tx is not None and k not in expected]
+            self.assertEqual( [txid for (txid, _, _) in filtered.others], [tx['txid'] for tx in others] )
+
+            # the prevout index sees the same inputs and outputs as it would from the unfiltered transactions
+            index_txs = dict( [(tx['txid'], tx) for tx in filtered.get_index_txs()] )
+            self.assertEqual( len(index_txs), len([tx for tx in txs if tx is not None]) )
+            for tx in txs:
+               if tx is None:
+                  continue
+
+               self.assertEqual( [(input.get('txid', None), input.get('vout', None)) for input in index_txs[tx['txid']]['vin']], [(input.get('txid', None), input.get('vout', None)) for input in tx['vin']] )
+               self.assertEqual( [trim_output( output ) for output in index_txs[tx['txid']]['vout']], [trim_output( output ) for output in tx['vout']] )
+
+
+   def test_empty( self ):
+      for txs in [[], [None, None]]:
+         filtered = filter_nulldata_txs( txs, keep_all=True, prefilter=("id", None) )
+         self.assertEqual( len(filtered), len(txs) )
+         self.assertEqual( (filtered.nulldata_txs, filtered.others, filtered.dropped), ([], [], 0) )
+         self.assertEqual( filtered.get_index_txs(), [] )
+
+
+if __name__ == "__main__":
+   unittest.main()
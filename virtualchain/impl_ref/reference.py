@@ -81,6 +81,19 @@ def get_op_processing_order():
    return None 
 
 
+def get_opcodes_needing_senders():
+   """
+   (Optional) Return the opcodes whose transactions' senders and fee
+   db_parse() needs.  The inputs of the others' transactions are only
+   fetched on demand:  db_parse() gets a SenderResolver in place of their
+   senders (and None for their fee), whose resolve() method returns
+   (senders, fee).  It can be kept in the op, for db_check() to resolve.
+   Return None if every opcode needs them (the default).
+   """
+   print "\nreference implementation of get_opcodes_needing_senders\n"
+   return None
+
+
 def db_parse( block_id, opcode, op_payload, senders, inputs, outputs, fee, db_state=None ):
    """
    Given the block ID, and information from what looks like 
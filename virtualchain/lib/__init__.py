@@ -28,8 +28,10 @@ import config
 import blockchain 
 import indexer 
 import workpool 
+import tuning
 
 from config import *
 from blockchain import *
 from indexer import StateEngine, get_index_range, RESERVED_KEYS
-from workpool import multiprocess_bitcoind, multiprocess_batch_size, multiprocess_pool
+from workpool import multiprocess_bitcoind, multiprocess_batch_size, multiprocess_pool, InlinePool
+from tuning import ConcurrencyController, SliceBudget, get_concurrency_controller, get_concurrency_settings
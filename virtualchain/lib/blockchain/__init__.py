@@ -23,8 +23,32 @@
 
 import transactions 
 import session
+import cache
+import prevouts
+import rawblock
+import blockfiles
+import metrics
+import retry
+import notify
+import mockbitcoind
+import sharedmem
+import txrecord
 
 from transactions import get_bitcoind, getrawtransaction, getrawtransaction_async, getblockhash, getblockhash_async, getblock, getblock_async, get_sender_and_amount_in_from_txn, \
-   get_total_out, process_nulldata_tx_async, get_nulldata_txs_in_blocks
+   get_sender_and_amount_in_from_output, get_sender_and_amount_in_from_prevout, has_prevouts, find_input_sender, \
+   get_total_out, get_senders_and_fee, SenderResolver, process_nulldata_tx_async, get_nulldata_txs_in_blocks, get_nulldata_txs_in_blocks_pooled, bitcoind_batch, getblockhash_batch, getblockhash_batch_async, \
+   getrawtransaction_batch, getrawtransaction_batch_async, getblock_txs, getblock_txs_async, \
+   getblock_raw, getblock_deserialized, getrawtransaction_batch_deserialized
 from nulldata import get_nulldata, has_nulldata
-from session import BitcoindConnection, create_bitcoind_connection, connect_bitcoind
+from session import BitcoindConnection, BitcoindRPCPool, create_bitcoind_connection, create_bitcoind_rpc_pool, connect_bitcoind, \
+   get_connection_stats, connection_is_alive, bitcoind_is_alive
+from cache import RPCCache, get_rpc_cache, SenderCache, get_sender_cache, get_sender_cache_stats
+from prevouts import PrevoutIndex, get_prevout_index
+from rawblock import deserialize_block, deserialize_transaction, deserialize_block_header, BlockDeserializeError
+from blockfiles import BlockFileIndex, get_block_file_index, getblock_from_file
+from metrics import MeteredBitcoind, get_fetch_metrics, format_prometheus_metrics, reset_fetch_metrics
+from retry import call_bitcoind, CircuitBreaker, RPCDeadlineExceeded, CircuitOpen
+from notify import BlockNotifier, ZMQBlockNotifier, LongPollBlockNotifier, get_block_notifier
+from mockbitcoind import MockChain, MockBitcoind, MockBitcoindServer, MockBitcoindError
+from sharedmem import SharedTxs, SharedTxList, share_txs, remove_shared_segments
+from txrecord import NulldataTx, FilteredTxs, filter_nulldata_txs
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import mmap
+import struct
+import binascii
+import threading
+import collections
+
+from .. import config
+from .rawblock import sha256d, deserialize_block
+
+import session
+log = session.log
+
+# the bytes that precede each block in a block file, per network
+BLOCK_FILE_MAGIC = {
+   "mainnet": "\xf9\xbe\xb4\xd9",
+   "testnet": "\x0b\x11\x09\x07",
+   "regtest": "\xfa\xbf\xb5\xda"
+}
+
+BLOCK_FILE_PATTERN = re.compile( r"^blk[0-9]{5}\.dat$" )
+
+# maximum number of block files a process keeps mapped at once
+MAX_MAPPED_BLOCK_FILES = 64
+
+# process-local index of the block files
+process_local_block_file_index = None
+
+# process-local mapped block files:  {path: mmap}, least-recently-used first
+process_local_block_files = collections.OrderedDict()
+process_local_block_files_lock = threading.Lock()
+
+
+def read_xor_key( blocks_dir ):
+   """
+   Get the key bitcoind obfuscates its block files with
+   (newer versions write one to xor.dat).
+   Return None if the files are not obfuscated.
+   """
+   path = os.path.join( blocks_dir, "xor.dat" )
+   if not os.path.exists( path ):
+      return None
+
+   with open( path, "rb" ) as f:
+      key = f.read()
+
+   if len(key) == 0 or key == "\x00" * len(key):
+      return None
+
+   return key
+
+
+def xor_bytes( data, key, position ):
+   """
+   Undo bitcoind's block file obfuscation on data,
+   which was read from the given position in its file.
+   """
+   if key is None or len(data) == 0:
+      return data
+
+   shift = position % len(key)
+   keystream = (key[shift:] + key[:shift]) * (len(data) / len(key) + 1)
+
+   # XOR the lot as two big integers, instead of byte by byte
+   x = int( binascii.hexlify( data ), 16 ) ^ int( binascii.hexlify( keystream[:len(data)] ), 16 )
+   return binascii.unhexlify( "%0*x" % (2 * len(data), x) )
+
+
+def map_block_file( path, min_size=0 ):
+   """
+   Get a read-only memory map of a block file, reusing this process's
+   mapping if it covers at least min_size bytes (block files grow as
+   bitcoind appends blocks, so stale mappings get replaced).
+   """
+   with process_local_block_files_lock:
+
+      mm = process_local_block_files.pop( path, None )
+      if mm is not None and len(mm) < min_size:
+         mm.close()
+         mm = None
+
+      if mm is None:
+         with open( path, "rb" ) as f:
+            mm = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+
+      process_local_block_files[path] = mm
+
+      while len(process_local_block_files) > MAX_MAPPED_BLOCK_FILES:
+         _, old_mm = process_local_block_files.popitem( last=False )
+         old_mm.close()
+
+      return mm
+
+
+def unmap_block_files():
+   """
+   Unmap all of this process's block files.
+   """
+   with process_local_block_files_lock:
+      for mm in process_local_block_files.values():
+         mm.close()
+
+      process_local_block_files.clear()
+
+
+class BlockFileIndex( object ):
+   """
+   Index of the blocks in bitcoind's blk*.dat files, i.e.
+   block hash --> (file name, offset, size).
+
+   Block files hold blocks in the order in which bitcoind received them,
+   not in height order, and they include blocks that are not on the best
+   chain.  So, blocks are looked up by hash; the caller gets the best
+   chain's hashes from bitcoind.
+
+   The index is built by walking each file's (magic, size, block) records,
+   which only touches each block's 88-byte preamble and header.
+   It is extended as bitcoind appends blocks.
+   """
+
+   def __init__( self, blocks_dir, network="mainnet" ):
+      self.blocks_dir = blocks_dir
+      self.network = network
+      self.magic = BLOCK_FILE_MAGIC[network]
+      self.xor_key = read_xor_key( blocks_dir )
+
+      self.locations = {}      # {block hash: (file name, offset, size)}
+      self.scanned = {}        # {file name: number of bytes indexed}
+      self.file_stats = {}     # {file name: (size, modification time) when we last indexed it}
+
+
+   def list_block_files( self ):
+      """
+      Get the names of the block files, in order.
+      """
+      return sorted( [name for name in os.listdir( self.blocks_dir ) if BLOCK_FILE_PATTERN.match( name )] )
+
+
+   def read( self, mm, offset, size ):
+      """
+      Read size bytes at offset from a mapped block file, de-obfuscating them if need be.
+      """
+      return xor_bytes( mm[offset:offset+size], self.xor_key, offset )
+
+
+   def scan_file( self, name ):
+      """
+      Index the blocks in a block file that we haven't indexed yet.
+      Return the number of blocks found.
+      """
+      path = os.path.join( self.blocks_dir, name )
+      offset = self.scanned.get( name, 0 )
+
+      if os.path.getsize( path ) <= offset:
+         return 0
+
+      mm = map_block_file( path, os.path.getsize( path ) )
+      count = 0
+
+      while offset + 88 <= len(mm):
+
+         preamble = self.read( mm, offset, 8 )
+         if preamble[:4] != self.magic:
+            # end of the file's data (the rest is preallocated zeros),
+            # or a block that has not been completely written yet
+            break
+
+         size = struct.unpack( "<I", preamble[4:] )[0]
+         if offset + 8 + size > len(mm):
+            break
+
+         block_hash = binascii.hexlify( sha256d( self.read( mm, offset + 8, 80 ) )[::-1] )
+         self.locations[block_hash] = (name, offset + 8, size)
+
+         offset += 8 + size
+         count += 1
+
+      self.scanned[name] = offset
+      return count
+
+
+   def scan( self ):
+      """
+      Index blocks that bitcoind has written since we last looked.
+      Return the number of blocks found.
+      """
+      count = 0
+      names = self.list_block_files()
+
+      for name in names:
+
+         # NOTE: bitcoind preallocates block files, so they can change without growing
+         st = os.stat( os.path.join( self.blocks_dir, name ) )
+         if self.file_stats.get( name, None ) == (st.st_size, st.st_mtime):
+            # unchanged since we last looked
+            continue
+
+         count += self.scan_file( name )
+         self.file_stats[name] = (st.st_size, st.st_mtime)
+
+      if count > 0:
+         log.debug("Indexed %s blocks in %s (%s total)" % (count, self.blocks_dir, len(self.locations)))
+
+      return count
+
+
+   def locate( self, block_hash ):
+      """
+      Find a block in the block files.
+      Return (file name, offset, size) on success.
+      Return None if it is not in them (i.e. not yet written, or pruned).
+      """
+      location = self.locations.get( block_hash, None )
+      if location is None and self.scan() > 0:
+         location = self.locations.get( block_hash, None )
+
+      return location
+
+
+def get_block_file_index( bitcoind_opts ):
+   """
+   Get this process's index of bitcoind's block files.
+   Return None if we are not configured to read them.
+   """
+
+   global process_local_block_file_index
+
+   blocks_dir = config.configure_block_files( bitcoind_opts )
+   if blocks_dir is None:
+      return None
+
+   _, network = config.configure_raw_blocks( bitcoind_opts )
+
+   if process_local_block_file_index is None or process_local_block_file_index.blocks_dir != blocks_dir or process_local_block_file_index.network != network:
+      process_local_block_file_index = BlockFileIndex( blocks_dir, network )
+
+   return process_local_block_file_index
+
+
+def getblock_from_file( bitcoind_opts, block_hash, location ):
+   """
+   Read and decode a block from bitcoind's block files, given its
+   hash and its location in them (from BlockFileIndex.locate()).
+   The block is decoded in place in the mapped file, without copying it
+   (unless bitcoind obfuscates its block files).
+
+   Return the block in the same form as getblock_deserialized() does.
+   """
+
+   block_file_index = get_block_file_index( bitcoind_opts )
+
+   name, offset, size = location
+   mm = map_block_file( os.path.join( block_file_index.blocks_dir, name ), offset + size )
+
+   if block_file_index.xor_key is not None:
+      block_data = deserialize_block( block_file_index.read( mm, offset, size ), network=block_file_index.network )
+   else:
+      block_data = deserialize_block( mm, offset, network=block_file_index.network )
+
+   if block_data['hash'] != block_hash or block_data['size'] != size:
+      raise Exception("Block %s: got block %s (%s bytes) at %s:%s instead" % (block_hash, block_data['hash'], block_data['size'], name, offset))
+
+   return block_data
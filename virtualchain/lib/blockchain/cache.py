@@ -0,0 +1,518 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import types
+import hashlib
+import binascii
+import zlib
+import fcntl
+import cPickle
+
+from collections import OrderedDict
+
+from .. import config
+
+import session
+log = session.log
+
+RPC_CACHE_MAGIC = "vcc1"
+RPC_CACHE_COMPRESSION_LEVEL = 3
+RPC_CACHE_INDEX = "size.idx"     # holds the cache's total size, in bytes
+
+# process-local cache handles
+process_local_rpc_cache = None
+process_local_sender_cache = None
+
+def is_block_data( block_hash, verbosity, block_data ):
+   """
+   Is block_data a getblock result for the block with the given hash?
+   With verbosity 0, it's the hex-encoded block, so check its header's hash.
+   """
+   if verbosity == 0:
+      if type(block_data) not in [types.StringType, types.UnicodeType] or len(block_data) < 160:
+         return False
+
+      try:
+         header = binascii.unhexlify( block_data[:160] )
+      except TypeError:
+         return False
+
+      return binascii.hexlify( hashlib.sha256( hashlib.sha256( header ).digest() ).digest()[::-1] ) == block_hash
+
+   return type(block_data) == types.DictType and block_data.get('hash', None) == block_hash
+
+
+class RPCCache( object ):
+   """
+   Content-addressed on-disk cache of bitcoind RPC responses.
+
+   Blocks and transactions are immutable once we know their hashes,
+   so they can be kept forever (up to the cache's size cap).  Block
+   hashes are only cached for blocks that are buried deep enough
+   that we don't expect them to be reorganized away.
+
+   Each entry is stored in its own file, as:
+      magic (4 bytes) | sha256 of the compressed payload (32 bytes) | zlib-compressed payload
+   Entries that fail their integrity check are discarded and re-fetched.
+
+   Multiple processes may share a cache directory.  Writes are atomic
+   (write to a temporary file, then rename).  The cache's total size is
+   kept in an index file, which processes update under a lock as they
+   write, so that none of them has to measure the cache except to evict
+   its least-recently-used entries once it gets too big.
+   """
+
+   def __init__( self, cache_dir, max_size ):
+      """
+      Cache up to max_size bytes of RPC responses in cache_dir.
+      """
+      self.cache_dir = cache_dir
+      self.max_size = max_size
+      self.cur_size = None   # as of our last write
+      self.hits = 0
+      self.misses = 0
+      self.corrupt = 0
+
+      if not os.path.exists( self.cache_dir ):
+         try:
+            os.makedirs( self.cache_dir )
+         except OSError:
+            # someone else made it
+            if not os.path.exists( self.cache_dir ):
+               raise
+
+
+   def entry_path( self, kind, name ):
+      """
+      Get the path to the file that holds a cache entry.
+      """
+      shard = hashlib.sha256( name ).hexdigest()[:2]
+      return os.path.join( self.cache_dir, kind, shard, name )
+
+
+   def get( self, kind, name ):
+      """
+      Get a cached value.
+      Return None if it is not cached, or if the cached copy is corrupt.
+      """
+      path = self.entry_path( kind, name )
+
+      try:
+         with open( path, "rb" ) as f:
+            data = f.read()
+
+      except IOError:
+         self.misses += 1
+         return None
+
+      value = None
+      if data[:len(RPC_CACHE_MAGIC)] == RPC_CACHE_MAGIC:
+
+         digest = data[len(RPC_CACHE_MAGIC):len(RPC_CACHE_MAGIC)+32]
+         payload = data[len(RPC_CACHE_MAGIC)+32:]
+
+         if hashlib.sha256( payload ).digest() == digest:
+            try:
+               value = cPickle.loads( zlib.decompress( payload ) )
+            except Exception, e:
+               log.exception(e)
+               value = None
+
+      if value is None:
+         log.error("Corrupt RPC cache entry '%s'; discarding" % path)
+         self.corrupt += 1
+         self.misses += 1
+         self.discard( path )
+         return None
+
+      # remember that we used it, for eviction
+      try:
+         os.utime( path, None )
+      except OSError:
+         pass
+
+      self.hits += 1
+      return value
+
+
+   def put( self, kind, name, value ):
+      """
+      Cache a value.
+      Return True if stored; False if not.
+      """
+      if value is None:
+         return False
+
+      path = self.entry_path( kind, name )
+      payload = zlib.compress( cPickle.dumps( value, cPickle.HIGHEST_PROTOCOL ), RPC_CACHE_COMPRESSION_LEVEL )
+      data = RPC_CACHE_MAGIC + hashlib.sha256( payload ).digest() + payload
+
+      if len(data) > self.max_size:
+         return False
+
+      tmp_path = path + (".tmp.%s" % os.getpid())
+
+      try:
+         old_size = os.stat( path ).st_size
+      except OSError:
+         old_size = 0
+
+      try:
+         dirname = os.path.dirname( path )
+         if not os.path.exists( dirname ):
+            try:
+               os.makedirs( dirname )
+            except OSError:
+               if not os.path.exists( dirname ):
+                  raise
+
+         with open( tmp_path, "wb" ) as f:
+            f.write( data )
+
+         os.rename( tmp_path, path )
+
+      except Exception, e:
+         log.error("Failed to cache '%s': %s" % (path, e))
+         self.remove( tmp_path )
+         return False
+
+      self.cur_size = self.update_size( len(data) - old_size )
+      return True
+
+
+   def remove( self, path ):
+      """
+      Remove a cache file, if it exists.
+      """
+      try:
+         os.unlink( path )
+      except OSError:
+         pass
+
+
+   def update_size( self, delta ):
+      """
+      Add delta bytes to the cache's total size in its index, and
+      evict entries if that makes it too big.  Return the new total.
+
+      If there is no index yet (or it is garbled), measure the cache
+      to make one.  Hold the index's lock throughout, so only one
+      process measures or evicts at a time.
+      """
+      index_path = os.path.join( self.cache_dir, RPC_CACHE_INDEX )
+      fd = os.open( index_path, os.O_RDWR | os.O_CREAT, 0644 )
+
+      try:
+         fcntl.flock( fd, fcntl.LOCK_EX )
+
+         try:
+            total_size = max( int(os.read( fd, 64 )) + delta, 0 )
+         except ValueError:
+            total_size = self.get_size()
+
+         if total_size > self.max_size:
+            total_size = self.evict()
+
+         os.lseek( fd, 0, os.SEEK_SET )
+         os.ftruncate( fd, 0 )
+         os.write( fd, "%s" % total_size )
+
+      finally:
+         # releases the lock
+         os.close( fd )
+
+      return total_size
+
+
+   def discard( self, path ):
+      """
+      Remove a cache entry, if it exists, and take it out of the cache's size.
+      """
+      try:
+         size = os.stat( path ).st_size
+         os.unlink( path )
+      except OSError:
+         return
+
+      self.cur_size = self.update_size( -size )
+
+
+   def list_entries( self ):
+      """
+      Get the list of (mtime, size, path) for every cache entry.
+      """
+      index_path = os.path.join( self.cache_dir, RPC_CACHE_INDEX )
+      entries = []
+      for dirpath, dirnames, filenames in os.walk( self.cache_dir ):
+         for filename in filenames:
+            path = os.path.join( dirpath, filename )
+            if path == index_path:
+               continue
+
+            try:
+               sb = os.stat( path )
+            except OSError:
+               # evicted by someone else
+               continue
+
+            entries.append( (sb.st_mtime, sb.st_size, path) )
+
+      return entries
+
+
+   def get_size( self ):
+      """
+      Get the total size of the cache, in bytes.
+      """
+      return sum( [size for (_, size, _) in self.list_entries()] )
+
+
+   def evict( self ):
+      """
+      Remove least-recently-used entries until the
+      cache is at most 90% of its maximum size.
+      Return the cache's size afterwards.
+      """
+      entries = self.list_entries()
+      entries.sort()
+
+      total_size = sum( [size for (_, size, _) in entries] )
+      target_size = int(self.max_size * 0.9)
+      num_evicted = 0
+
+      for (_, size, path) in entries:
+         if total_size <= target_size:
+            break
+
+         self.remove( path )
+         total_size -= size
+         num_evicted += 1
+
+      log.debug("Evicted %s RPC cache entries (%s bytes remain)" % (num_evicted, total_size))
+      return total_size
+
+
+   def get_block( self, block_hash, verbosity ):
+      """
+      Get a cached getblock result.
+      """
+      block_data = self.get( "block", "%s-%s" % (block_hash, verbosity) )
+      if block_data is not None and not is_block_data( block_hash, verbosity, block_data ):
+         log.error("RPC cache entry for block %s holds a different block; discarding" % block_hash)
+         self.discard( self.entry_path( "block", "%s-%s" % (block_hash, verbosity) ) )
+         return None
+
+      return block_data
+
+
+   def put_block( self, block_hash, verbosity, block_data ):
+      """
+      Cache a getblock result.  If the block is buried deeply enough,
+      then remember its hash for its height as well.
+      """
+      if not is_block_data( block_hash, verbosity, block_data ):
+         return False
+
+      rc = self.put( "block", "%s-%s" % (block_hash, verbosity), block_data )
+
+      if verbosity > 0 and block_data.get('height', None) is not None and block_data.get('confirmations', 0) >= config.RPC_CACHE_MIN_CONFIRMATIONS:
+         self.put_block_hash( block_data['height'], block_hash )
+
+      return rc
+
+
+   def get_block_hash( self, block_number ):
+      """
+      Get the cached hash of the block at a given height.
+      """
+      block_hash = self.get( "blockhash", "%s" % block_number )
+      if block_hash is not None and (type(block_hash) not in [types.StringType, types.UnicodeType] or len(block_hash) != 64):
+         log.error("RPC cache entry for block height %s is not a block hash; discarding" % block_number)
+         self.discard( self.entry_path( "blockhash", "%s" % block_number ) )
+         return None
+
+      return block_hash
+
+
+   def put_block_hash( self, block_number, block_hash ):
+      """
+      Cache the hash of the block at a given height.
+      Only do this for blocks that won't be reorganized away.
+      """
+      return self.put( "blockhash", "%s" % block_number, block_hash )
+
+
+   def get_transaction( self, txid, verbose ):
+      """
+      Get a cached getrawtransaction result.
+      """
+      tx = self.get( "tx", "%s-%s" % (txid, verbose) )
+      if tx is not None and verbose and (type(tx) != types.DictType or tx.get('txid', None) != txid):
+         log.error("RPC cache entry for transaction %s holds a different transaction; discarding" % txid)
+         self.discard( self.entry_path( "tx", "%s-%s" % (txid, verbose) ) )
+         return None
+
+      return tx
+
+
+   def put_transaction( self, txid, verbose, tx ):
+      """
+      Cache a getrawtransaction result.
+      """
+      if verbose and (type(tx) != types.DictType or tx.get('txid', None) != txid):
+         return False
+
+      return self.put( "tx", "%s-%s" % (txid, verbose), tx )
+
+
+def get_rpc_cache( bitcoind_or_opts ):
+   """
+   Get this process's RPC cache, given either a bitcoind
+   API endpoint proxy or a dict of options.
+   Return None if caching is disabled.
+   """
+
+   global process_local_rpc_cache
+
+   if bitcoind_or_opts is None:
+      return None
+
+   if type(bitcoind_or_opts) == types.DictType:
+      bitcoind_opts = bitcoind_or_opts
+   else:
+      bitcoind_opts = getattr( bitcoind_or_opts, "opts", None )
+
+   cache_dir, max_size = config.configure_rpc_cache( bitcoind_opts )
+   if cache_dir is None or max_size <= 0:
+      return None
+
+   if process_local_rpc_cache is None or process_local_rpc_cache.cache_dir != cache_dir:
+      process_local_rpc_cache = RPCCache( cache_dir, max_size )
+
+   return process_local_rpc_cache
+
+
+class SenderCache( object ):
+   """
+   Bounded in-memory LRU cache of resolved transaction outputs,
+   i.e. (txid, vout) --> (sender, amount), so we don't have to
+   fetch the same input transactions over and over again.
+   
+   Also keeps hit-rate counters for the ways in which inputs
+   get resolved without an RPC.
+   """
+
+   def __init__( self, max_entries ):
+      self.max_entries = max_entries
+      self.entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+      self.coalesced = 0      # lookups that piggy-backed on another in-flight lookup
+      self.in_block = 0       # lookups resolved from a transaction we had already fetched
+
+
+   def get( self, txid, vout ):
+      """
+      Get the (sender, amount) pair for a transaction output.
+      Return None if it is not cached.
+      """
+      key = (txid, vout)
+      value = self.entries.pop( key, None )
+      if value is None:
+         self.misses += 1
+         return None
+
+      # most-recently used goes last
+      self.entries[key] = value
+      self.hits += 1
+
+      sender, amount_in = value
+      if sender is not None:
+         # callers may modify the sender
+         sender = dict(sender)
+
+      return (sender, amount_in)
+
+
+   def put( self, txid, vout, sender, amount_in ):
+      """
+      Remember the (sender, amount) pair for a transaction output.
+      """
+      if self.max_entries <= 0:
+         return
+
+      key = (txid, vout)
+      self.entries.pop( key, None )
+      self.entries[key] = (sender, amount_in)
+
+      while len(self.entries) > self.max_entries:
+         self.entries.popitem( last=False )
+
+
+   def get_stats( self ):
+      """
+      Get the cache's counters, as a dict.
+      hit_rate is the fraction of lookups that did not need an RPC.
+      """
+      lookups = self.hits + self.misses
+      saved = self.hits + self.coalesced + self.in_block
+      return {
+         "size": len(self.entries),
+         "max_size": self.max_entries,
+         "hits": self.hits,
+         "misses": self.misses,
+         "coalesced": self.coalesced,
+         "in_block": self.in_block,
+         "hit_rate": float(saved) / lookups if lookups > 0 else 0.0
+      }
+
+
+def get_sender_cache( bitcoind_opts ):
+   """
+   Get this process's cache of resolved transaction outputs.
+   Return None if it is disabled.
+   """
+
+   global process_local_sender_cache
+
+   max_entries = config.configure_sender_cache( bitcoind_opts )
+   if max_entries <= 0:
+      return None
+
+   if process_local_sender_cache is None:
+      process_local_sender_cache = SenderCache( max_entries )
+
+   process_local_sender_cache.max_entries = max_entries
+   return process_local_sender_cache
+
+
+def get_sender_cache_stats():
+   """
+   Get the hit-rate counters for this process's cache of resolved
+   transaction outputs.  Return None if it has not been used.
+   """
+   if process_local_sender_cache is None:
+      return None
+
+   return process_local_sender_cache.get_stats()
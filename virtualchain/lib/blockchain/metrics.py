@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Metrics for the block fetch layer:  per-RPC-method latency histograms,
+error, retry, and byte counters, in-flight gauges, connection events,
+and block throughput.
+
+The metrics live in shared memory that is allocated when this module
+is loaded, so worker processes forked later on (i.e. by the "process"
+workpool backend) update the same counters as the process that
+forked them, and every process sees the totals.  Counters only go up,
+from when the module is loaded (or reset_fetch_metrics() is called).
+"""
+
+import time
+import httplib
+import threading
+import multiprocessing
+
+# RPC methods we keep separate metrics for.  Anything else is counted as "other".
+# "rest" is for blocks fetched over bitcoind's REST interface.
+METRICS_RPC_METHODS = ["getblockhash", "getblock", "getrawtransaction", "getblockcount", "rest", "other"]
+
+# per-method counters
+METRICS_RPC_COUNTERS = ["requests", "errors", "retries", "hedges", "deadlines_exceeded", "bytes_received", "batched_calls", "in_flight", "latency_sum"]
+
+# upper bounds of the RPC latency histogram buckets, in seconds (there's also an implicit +Inf bucket)
+METRICS_LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# bitcoind connection events (see session.count_connection_event())
+# (and circuit breaker events; see retry.CircuitBreaker)
+METRICS_CONNECTION_EVENTS = ["created", "reused", "probed", "probe_failures", "expired", "reset", "breaker_opened", "breaker_closed"]
+
+# stages of get_nulldata_txs_in_blocks(), which we count the time spent in
+METRICS_FETCH_STAGES = ["hash", "block", "tx", "nulldata"]
+
+# counters and gauges for the fetch as a whole
+METRICS_FETCH_COUNTERS = ["blocks", "slices", "nulldata_txs", "prefiltered_txs", "goodput_bytes", "block_bytes", "fetch_seconds", "blocks_per_second", "peak_slice_bytes", "peak_slice_txs"]
+
+# the RPC method being called by this thread, so the bytes it receives can be attributed to it
+thread_local_rpc = threading.local()
+
+
+class FetchMetrics( object ):
+   """
+   Fixed set of counters in shared memory, laid out as one array of doubles.
+   """
+
+   def __init__( self ):
+      self.offsets = {}
+      names = []
+
+      for method in METRICS_RPC_METHODS:
+         for counter in METRICS_RPC_COUNTERS:
+            names.append( ("rpc", method, counter) )
+
+         for i in xrange(0, len(METRICS_LATENCY_BUCKETS) + 1):
+            names.append( ("rpc", method, "bucket", i) )
+
+      for event in METRICS_CONNECTION_EVENTS:
+         names.append( ("connection", event) )
+
+      for stage in METRICS_FETCH_STAGES:
+         names.append( ("stage", stage) )
+
+      for counter in METRICS_FETCH_COUNTERS:
+         names.append( ("fetch", counter) )
+
+      for i in xrange(0, len(names)):
+         self.offsets[names[i]] = i
+
+      self.values = multiprocessing.RawArray( 'd', len(names) )
+      self.lock = multiprocessing.Lock()
+
+
+   def add( self, name, amount=1 ):
+      """
+      Add to a counter (or gauge).
+      """
+      with self.lock:
+         self.values[ self.offsets[name] ] += amount
+
+
+   def set( self, name, value ):
+      """
+      Set a gauge.
+      """
+      with self.lock:
+         self.values[ self.offsets[name] ] = value
+
+
+   def observe_rpc( self, method, latency, success ):
+      """
+      Record a finished RPC.
+      """
+      bucket = len(METRICS_LATENCY_BUCKETS)
+      for i in xrange(0, len(METRICS_LATENCY_BUCKETS)):
+         if latency <= METRICS_LATENCY_BUCKETS[i]:
+            bucket = i
+            break
+
+      with self.lock:
+         self.values[ self.offsets[("rpc", method, "latency_sum")] ] += latency
+         self.values[ self.offsets[("rpc", method, "bucket", bucket)] ] += 1
+         self.values[ self.offsets[("rpc", method, "in_flight")] ] -= 1
+
+         if not success:
+            self.values[ self.offsets[("rpc", method, "errors")] ] += 1
+
+
+   def snapshot( self ):
+      """
+      Get a consistent copy of all counters, as {name: value}.
+      """
+      with self.lock:
+         values = self.values[:]
+
+      return dict( [(name, values[offset]) for (name, offset) in self.offsets.items()] )
+
+
+   def reset( self ):
+      """
+      Zero all counters.
+      """
+      with self.lock:
+         for i in xrange(0, len(self.values)):
+            self.values[i] = 0
+
+
+# shared by this process and any worker processes it forks
+fetch_metrics = FetchMetrics()
+
+
+def get_rpc_method_label( method ):
+   """
+   Get the name we keep an RPC method's metrics under.
+   """
+   if method in METRICS_RPC_METHODS:
+      return method
+
+   return "other"
+
+
+def rpc_started( method ):
+   """
+   Note that this thread is sending an RPC.
+   Return the time it started, to pass to rpc_finished().
+   """
+   method = get_rpc_method_label( method )
+
+   fetch_metrics.add( ("rpc", method, "requests") )
+   fetch_metrics.add( ("rpc", method, "in_flight") )
+   thread_local_rpc.method = method
+
+   return time.time()
+
+
+def rpc_finished( method, start_time, success ):
+   """
+   Note that this thread's RPC finished.
+   """
+   thread_local_rpc.method = None
+   fetch_metrics.observe_rpc( get_rpc_method_label( method ), time.time() - start_time, success )
+
+
+def count_rpc_retry( method ):
+   """
+   Note that an RPC is being tried again.
+   """
+   fetch_metrics.add( ("rpc", get_rpc_method_label( method ), "retries") )
+
+
+def count_rpc_hedge( method ):
+   """
+   Note that a straggling RPC is being sent again.
+   """
+   fetch_metrics.add( ("rpc", get_rpc_method_label( method ), "hedges") )
+
+
+def count_rpc_deadline( method ):
+   """
+   Note that we gave up on an RPC, because it ran out of time
+   (or bitcoind was down for too long).
+   """
+   fetch_metrics.add( ("rpc", get_rpc_method_label( method ), "deadlines_exceeded") )
+
+
+def count_connection_event( event, count=1 ):
+   """
+   Count a bitcoind connection event.
+   """
+   fetch_metrics.add( ("connection", event), count )
+
+
+def record_fetch_slice( num_blocks, elapsed, stage_times, num_nulldata_txs, goodput_bytes, num_prefiltered_txs=0, slice_bytes=0, slice_txs=0 ):
+   """
+   Record that get_nulldata_txs_in_blocks() finished a slice of num_blocks blocks
+   in elapsed seconds.  stage_times is {stage: seconds spent in it}.
+   num_nulldata_txs transactions with nulldata were kept, and num_prefiltered_txs
+   were dropped for not matching the magic bytes and opcodes.
+   The slice's blocks had slice_bytes bytes (as serialized) and slice_txs transactions.
+   """
+   with fetch_metrics.lock:
+      values = fetch_metrics.values
+      offsets = fetch_metrics.offsets
+
+      values[ offsets[("fetch", "blocks")] ] += num_blocks
+      values[ offsets[("fetch", "slices")] ] += 1
+      values[ offsets[("fetch", "nulldata_txs")] ] += num_nulldata_txs
+      values[ offsets[("fetch", "prefiltered_txs")] ] += num_prefiltered_txs
+      values[ offsets[("fetch", "goodput_bytes")] ] += goodput_bytes
+      values[ offsets[("fetch", "block_bytes")] ] += slice_bytes
+      values[ offsets[("fetch", "fetch_seconds")] ] += elapsed
+      values[ offsets[("fetch", "blocks_per_second")] ] = num_blocks / max(elapsed, 1e-6)
+      values[ offsets[("fetch", "peak_slice_bytes")] ] = max( values[ offsets[("fetch", "peak_slice_bytes")] ], slice_bytes )
+      values[ offsets[("fetch", "peak_slice_txs")] ] = max( values[ offsets[("fetch", "peak_slice_txs")] ], slice_txs )
+
+      for stage, stage_time in stage_times.items():
+         values[ offsets[("stage", stage)] ] += max(stage_time, 0)
+
+
+class MeteredHTTPResponse( httplib.HTTPResponse ):
+   """
+   HTTP response that counts the bytes read from it,
+   against the RPC method this thread is calling.
+   """
+
+   def read( self, amt=None ):
+      data = httplib.HTTPResponse.read( self, amt )
+
+      method = getattr( thread_local_rpc, "method", None )
+      if method is not None and data:
+         fetch_metrics.add( ("rpc", method, "bytes_received"), len(data) )
+
+      return data
+
+
+def meter_http_connection( conn ):
+   """
+   Count the bytes received over an httplib connection.
+   Return the connection.
+   """
+   conn.response_class = MeteredHTTPResponse
+   return conn
+
+
+class MeteredBitcoind( object ):
+   """
+   Wrapper around a bitcoind client that times each RPC (and batch
+   of RPCs) that goes through it, by method.  Other attributes
+   (i.e. ".opts") are passed through.
+   """
+
+   def __init__( self, bitcoind ):
+      self.__dict__['bitcoind'] = bitcoind
+
+
+   def __getattr__( self, name ):
+      attr = getattr( self.__dict__['bitcoind'], name )
+      if name.startswith('__') or not callable( attr ):
+         return attr
+
+      def rpc( *args ):
+
+         method = name
+         batched_calls = 1
+
+         if name == "_batch":
+            # label a batch with the method of its first call (we don't mix methods in a batch)
+            rpc_calls = list(args[0]) if len(args) > 0 else []
+            method = rpc_calls[0].get('method', 'other') if len(rpc_calls) > 0 else 'other'
+            batched_calls = len(rpc_calls)
+
+         start_time = rpc_started( method )
+         success = False
+
+         try:
+            result = attr( *args )
+            success = True
+            return result
+
+         finally:
+            rpc_finished( method, start_time, success )
+            if batched_calls > 1:
+               fetch_metrics.add( ("rpc", get_rpc_method_label( method ), "batched_calls"), batched_calls )
+
+      return rpc
+
+
+def unwrap_bitcoind( bitcoind ):
+   """
+   Get the bitcoind client behind a MeteredBitcoind.
+   """
+   if isinstance( bitcoind, MeteredBitcoind ):
+      return bitcoind.__dict__['bitcoind']
+
+   return bitcoind
+
+
+def get_fetch_metrics():
+   """
+   Get the fetch layer's metrics, totalled over this process and
+   its worker processes, as a dict:
+   {
+      "rpc": {method: {"requests", "errors", "retries", "hedges", "deadlines_exceeded", "bytes_received", "batched_calls", "in_flight",
+                       "latency": {"count", "sum", "buckets": [(upper bound, cumulative count)]}}},
+      "connections": {event: count},
+      "stages": {stage: seconds},
+      "fetch": {"blocks", "slices", "nulldata_txs", "prefiltered_txs", "goodput_bytes", "block_bytes", "fetch_seconds", "blocks_per_second",
+                "peak_slice_bytes", "peak_slice_txs"}
+   }
+   """
+   values = fetch_metrics.snapshot()
+   ret = {
+      "rpc": {},
+      "connections": dict( [(event, int(values[("connection", event)])) for event in METRICS_CONNECTION_EVENTS] ),
+      "stages": dict( [(stage, values[("stage", stage)]) for stage in METRICS_FETCH_STAGES] ),
+      "fetch": dict( [(counter, values[("fetch", counter)]) for counter in METRICS_FETCH_COUNTERS] )
+   }
+
+   for method in METRICS_RPC_METHODS:
+
+      rpc_metrics = {}
+      for counter in METRICS_RPC_COUNTERS:
+         if counter != "latency_sum":
+            rpc_metrics[counter] = int(values[("rpc", method, counter)])
+
+      buckets = []
+      count = 0
+      for i in xrange(0, len(METRICS_LATENCY_BUCKETS) + 1):
+         count += int(values[("rpc", method, "bucket", i)])
+         upper_bound = METRICS_LATENCY_BUCKETS[i] if i < len(METRICS_LATENCY_BUCKETS) else float("inf")
+         buckets.append( (upper_bound, count) )
+
+      rpc_metrics["latency"] = {
+         "count": count,
+         "sum": values[("rpc", method, "latency_sum")],
+         "buckets": buckets
+      }
+
+      ret["rpc"][method] = rpc_metrics
+
+   return ret
+
+
+def format_prometheus_metrics( prefix="virtualchain" ):
+   """
+   Get the fetch layer's metrics in Prometheus' text exposition format.
+   """
+   metrics = get_fetch_metrics()
+   lines = []
+
+   def header( name, metric_type, help_text ):
+      lines.append( "# HELP %s_%s %s" % (prefix, name, help_text) )
+      lines.append( "# TYPE %s_%s %s" % (prefix, name, metric_type) )
+
+   def sample( name, labels, value ):
+      label_str = ""
+      if len(labels) > 0:
+         label_str = "{" + ",".join( ['%s="%s"' % (k, v) for (k, v) in labels] ) + "}"
+
+      if value == float("inf"):
+         value_str = "+Inf"
+      elif type(value) in [int, long]:
+         value_str = "%d" % value
+      else:
+         value_str = repr(float(value))
+
+      lines.append( "%s_%s%s %s" % (prefix, name, label_str, value_str) )
+
+   rpc_counters = [
+      ("rpc_requests_total", "requests", "counter", "bitcoind RPC requests (a batch counts once)"),
+      ("rpc_errors_total", "errors", "counter", "bitcoind RPC requests that failed"),
+      ("rpc_retries_total", "retries", "counter", "bitcoind RPCs that were tried again"),
+      ("rpc_hedges_total", "hedges", "counter", "straggling bitcoind RPCs that were sent again"),
+      ("rpc_deadlines_exceeded_total", "deadlines_exceeded", "counter", "bitcoind RPCs given up on for taking too long"),
+      ("rpc_received_bytes_total", "bytes_received", "counter", "bytes received from bitcoind"),
+      ("rpc_batched_calls_total", "batched_calls", "counter", "bitcoind RPCs sent in batches"),
+      ("rpc_in_flight", "in_flight", "gauge", "bitcoind RPC requests in progress")
+   ]
+
+   for (name, key, metric_type, help_text) in rpc_counters:
+      header( name, metric_type, help_text )
+      for method in METRICS_RPC_METHODS:
+         sample( name, [("method", method)], metrics["rpc"][method][key] )
+
+   header( "rpc_latency_seconds", "histogram", "bitcoind RPC request latency" )
+   for method in METRICS_RPC_METHODS:
+      latency = metrics["rpc"][method]["latency"]
+      for (upper_bound, count) in latency["buckets"]:
+         le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+         sample( "rpc_latency_seconds_bucket", [("method", method), ("le", le)], count )
+
+      sample( "rpc_latency_seconds_sum", [("method", method)], latency["sum"] )
+      sample( "rpc_latency_seconds_count", [("method", method)], latency["count"] )
+
+   header( "bitcoind_connection_events_total", "counter", "bitcoind connection lifecycle events" )
+   for event in METRICS_CONNECTION_EVENTS:
+      sample( "bitcoind_connection_events_total", [("event", event)], metrics["connections"][event] )
+
+   header( "fetch_stage_seconds_total", "counter", "time spent in each stage of fetching blocks" )
+   for stage in METRICS_FETCH_STAGES:
+      sample( "fetch_stage_seconds_total", [("stage", stage)], metrics["stages"][stage] )
+
+   fetch_metrics_info = [
+      ("fetched_blocks_total", "blocks", "counter", "blocks fetched"),
+      ("fetched_slices_total", "slices", "counter", "slices of blocks fetched"),
+      ("fetched_nulldata_txs_total", "nulldata_txs", "counter", "transactions with nulldata fetched"),
+      ("prefiltered_nulldata_txs_total", "prefiltered_txs", "counter", "transactions with nulldata dropped for not matching the magic bytes and opcodes"),
+      ("fetched_goodput_bytes_total", "goodput_bytes", "counter", "bytes of transactions with nulldata fetched"),
+      ("fetched_block_bytes_total", "block_bytes", "counter", "bytes of blocks (as serialized) fetched"),
+      ("fetch_seconds_total", "fetch_seconds", "counter", "time spent fetching slices of blocks"),
+      ("fetch_blocks_per_second", "blocks_per_second", "gauge", "blocks per second fetched in the last slice"),
+      ("fetch_peak_slice_bytes", "peak_slice_bytes", "gauge", "most bytes of blocks (as serialized) held at once by a slice"),
+      ("fetch_peak_slice_txs", "peak_slice_txs", "gauge", "most transactions held at once by a slice")
+   ]
+
+   for (name, key, metric_type, help_text) in fetch_metrics_info:
+      header( name, metric_type, help_text )
+      sample( name, [], metrics["fetch"][key] )
+
+   return "\n".join( lines ) + "\n"
+
+
+def reset_fetch_metrics():
+   """
+   Zero the fetch layer's metrics (in this process and its workers).
+   """
+   fetch_metrics.reset()
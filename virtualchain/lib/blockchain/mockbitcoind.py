@@ -0,0 +1,889 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+A stand-in for bitcoind, for benchmarking and testing the block
+fetch pipeline without a real node.
+
+MockChain holds a chain of serialized blocks:  either a synthetic one
+(made up of real transactions, some carrying nulldata), or one recorded
+from a real bitcoind.  Chains can be saved to and loaded from JSON files.
+
+MockBitcoindServer serves a MockChain over HTTP JSON-RPC, the way bitcoind
+does (getblockcount, getblockhash, getblock with any verbosity,
+getrawtransaction, and waitforblockheight), with configurable latency, bandwidth, error rates,
+RPC thread count, and batch support.  Point the bitcoind options at it
+(see get_bitcoind_opts()), or pass its connect_bitcoind() as
+setup_virtualchain()'s bitcoind_connection_factory.
+
+Usage: python -m virtualchain.lib.blockchain.mockbitcoind [--port PORT] [--blocks N | --chain FILE] [--latency SECONDS] ...
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import decimal
+import binascii
+import argparse
+import threading
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from .rawblock import sha256d, parse_script, deserialize_block, deserialize_transaction, OP_RETURN
+
+import session
+log = session.log
+
+# bitcoind's RPC error codes
+RPC_MISC_ERROR = -1
+RPC_INVALID_PARAMETER = -8
+RPC_INVALID_ADDRESS_OR_KEY = -5
+RPC_METHOD_NOT_FOUND = -32601
+RPC_INTERNAL_ERROR = -32603
+RPC_PARSE_ERROR = -32700
+
+# the error we inject (an internal error, so callers don't mistake it for anything specific)
+INJECTED_ERROR = {"code": RPC_INTERNAL_ERROR, "message": "Injected error"}
+
+# amounts are encoded as strings that start with this, and then turned back into numbers
+AMOUNT_MARKER = "__mock_amount__:"
+AMOUNT_PATTERN = re.compile( '"%s(-?[0-9]+\\.[0-9]{8})"' % AMOUNT_MARKER )
+
+# send responses in pieces of this many bytes, when limiting bandwidth
+BANDWIDTH_CHUNK_SIZE = 16384
+
+COINBASE_VALUE = 50 * 10**8
+SYNTHETIC_FEE = 10000   # satoshis per synthetic transaction
+SYNTHETIC_OPCODES = "+>:~#"   # opcode bytes that synthetic nulldata uses
+
+# how often waitforblockheight checks for new blocks, in seconds
+WAIT_POLL_INTERVAL = 0.01
+
+
+def serialize_varint( n ):
+   """
+   Serialize an integer as a Bitcoin varint.
+   """
+   if n < 0xfd:
+      return chr(n)
+   elif n <= 0xffff:
+      return "\xfd" + struct.pack( "<H", n )
+   elif n <= 0xffffffff:
+      return "\xfe" + struct.pack( "<I", n )
+   else:
+      return "\xff" + struct.pack( "<Q", n )
+
+
+def serialize_push( data ):
+   """
+   Serialize a script push of data.
+   """
+   if len(data) < 0x4c:
+      return chr(len(data)) + data
+   elif len(data) <= 0xff:
+      return "\x4c" + chr(len(data)) + data
+   else:
+      return "\x4d" + struct.pack( "<H", len(data) ) + data
+
+
+def serialize_transaction( inputs, outputs, witnesses=None, version=1, locktime=0 ):
+   """
+   Serialize a transaction.
+   inputs is a list of (txid, output index, scriptSig), and outputs
+   a list of (value in satoshis, scriptPubKey).  witnesses, if given, is a
+   list of witness stacks (lists of strings), one per input.
+
+   Return (serialized transaction, txid)
+   """
+   body = serialize_varint( len(inputs) )
+   for (txid, vout, script_sig) in inputs:
+      body += binascii.unhexlify( txid )[::-1] + struct.pack( "<I", vout ) + serialize_varint( len(script_sig) ) + script_sig + struct.pack( "<I", 0xffffffff )
+
+   body += serialize_varint( len(outputs) )
+   for (value, script_pubkey) in outputs:
+      body += struct.pack( "<q", value ) + serialize_varint( len(script_pubkey) ) + script_pubkey
+
+   head = struct.pack( "<i", version )
+   tail = struct.pack( "<I", locktime )
+   txid = binascii.hexlify( sha256d( head + body + tail )[::-1] )
+
+   if witnesses is None:
+      return (head + body + tail, txid)
+
+   witness_data = ""
+   for stack in witnesses:
+      witness_data += serialize_varint( len(stack) ) + "".join( [serialize_varint( len(item) ) + item for item in stack] )
+
+   return (head + "\x00\x01" + body + witness_data + tail, txid)
+
+
+def merkle_root( txids ):
+   """
+   Get the merkle root of a block's transactions, given their txids.
+   """
+   hashes = [binascii.unhexlify( txid )[::-1] for txid in txids]
+   while len(hashes) > 1:
+      if len(hashes) % 2 == 1:
+         hashes.append( hashes[-1] )
+
+      hashes = [sha256d( hashes[i] + hashes[i+1] ) for i in xrange(0, len(hashes), 2)]
+
+   return hashes[0]
+
+
+def script_to_asm( script ):
+   """
+   Render a script the way bitcoind does in its verbose output
+   (small pushes are shown as numbers).
+   """
+   ops = parse_script( script )
+   if ops is None:
+      return "[error]"
+
+   parts = []
+   for (opcode, data) in ops:
+      if data is not None:
+         if len(data) <= 4:
+            # bitcoind shows these as script numbers
+            n = 0
+            for i in xrange(0, len(data)):
+               n |= ord(data[i]) << (8 * i)
+
+            if len(data) > 0 and ord(data[-1]) & 0x80:
+               n = -(n & ~(0x80 << (8 * (len(data) - 1))))
+
+            parts.append( str(n) )
+
+         else:
+            parts.append( binascii.hexlify( data ) )
+
+      elif opcode == 0x00:
+         parts.append( "0" )
+
+      elif opcode == 0x4f:
+         parts.append( "-1" )
+
+      elif opcode >= 0x51 and opcode <= 0x60:
+         parts.append( str(opcode - 0x50) )
+
+      elif opcode == OP_RETURN:
+         parts.append( "OP_RETURN" )
+
+      else:
+         parts.append( "OP_UNKNOWN_%02x" % opcode )
+
+   return " ".join( parts )
+
+
+class MockChain( object ):
+   """
+   A chain of serialized blocks, starting at start_height,
+   and indexes of their transactions.
+   """
+
+   def __init__( self, raw_blocks, start_height=0, network="mainnet" ):
+      self.start_height = start_height
+      self.network = network
+
+      self.raw_blocks = {}       # {block hash: serialized block}
+      self.block_hashes = []     # in height order
+      self.heights = {}          # {block hash: height}
+      self.tx_locations = {}     # {txid: (block hash, offset, size)}
+      self.outputs = {}          # {txid: ([scriptPubKey, ...], [value, ...], height, coinbase?)}
+
+      for raw_block in raw_blocks:
+         self.append_block( raw_block )
+
+
+   def append_block( self, raw_block ):
+      """
+      Add a serialized block to the tip of the chain.
+      """
+      block = deserialize_block( raw_block, network=self.network )
+      height = self.start_height + len(self.block_hashes)
+
+      self.raw_blocks[block['hash']] = raw_block
+      self.block_hashes.append( block['hash'] )
+      self.heights[block['hash']] = height
+
+      offset = 80 + len(serialize_varint( len(block['tx']) ))
+      for i in xrange(0, len(block['tx'])):
+         tx = block['tx'][i]
+         self.tx_locations[tx['txid']] = (block['hash'], offset, tx['size'])
+         self.outputs[tx['txid']] = ([o['scriptPubKey'] for o in tx['vout']], [o['value'] for o in tx['vout']], height, i == 0)
+         offset += tx['size']
+
+
+   def get_height( self ):
+      """
+      Get the height of the tip.
+      """
+      return self.start_height + len(self.block_hashes) - 1
+
+
+   def get_block_height( self, block_hash ):
+      """
+      Get a block's height.
+      """
+      return self.heights[block_hash]
+
+
+   def get_raw_transaction( self, txid ):
+      """
+      Get a serialized transaction, and the hash of the block it's in.
+      Return (None, None) if there's no such transaction.
+      """
+      if not self.tx_locations.has_key( txid ):
+         return (None, None)
+
+      block_hash, offset, size = self.tx_locations[txid]
+      return (self.raw_blocks[block_hash][offset:offset+size], block_hash)
+
+
+   def to_json( self ):
+      """
+      Serialize the chain as a JSON fixture.
+      """
+      return json.dumps( {
+         "network": self.network,
+         "start_height": self.start_height,
+         "blocks": [binascii.hexlify( self.raw_blocks[block_hash] ) for block_hash in self.block_hashes]
+      } )
+
+
+   def save( self, path ):
+      """
+      Save the chain to a JSON fixture file.
+      """
+      with open( path, "w" ) as f:
+         f.write( self.to_json() )
+
+
+   @classmethod
+   def load( cls, path ):
+      """
+      Load a chain from a JSON fixture file (see save()).
+      """
+      with open( path, "r" ) as f:
+         fixture = json.loads( f.read() )
+
+      return cls( [binascii.unhexlify( block_hex ) for block_hex in fixture['blocks']], start_height=int(fixture.get('start_height', 0)), network=str(fixture.get('network', "mainnet")) )
+
+
+   @classmethod
+   def record( cls, bitcoind, start_height, end_height, network="mainnet" ):
+      """
+      Record blocks [start_height, end_height) from a real bitcoind.
+      """
+      raw_blocks = []
+      for height in xrange(start_height, end_height):
+         block_hash = bitcoind.getblockhash( height )
+         raw_blocks.append( binascii.unhexlify( bitcoind.getblock( block_hash, 0 ) ) )
+
+      return cls( raw_blocks, start_height=start_height, network=network )
+
+
+   @classmethod
+   def synthetic( cls, num_blocks, txs_per_block=10, nulldata_rate=0.3, magic="id", max_inputs=2, seed=0, network="mainnet" ):
+      """
+      Make up a chain of num_blocks blocks, each with a coinbase and
+      txs_per_block - 1 transactions that spend 1 to max_inputs earlier outputs.  Roughly
+      nulldata_rate of them carry nulldata that starts with magic (followed
+      by an opcode byte and a payload).  Outputs are a mix of P2PKH, P2SH,
+      and P2WPKH; P2WPKH spends carry witnesses.
+      """
+      rand = random.Random( seed )
+      utxos = []      # [(txid, output index, value, type)]
+      raw_blocks = []
+      prev_hash = "\x00" * 32
+
+      def make_script_pubkey():
+         script_type = rand.choice( ["pubkeyhash", "scripthash", "witness_v0_keyhash"] )
+         key_hash = "".join( [chr(rand.randint(0, 255)) for i in xrange(0, 20)] )
+
+         if script_type == "pubkeyhash":
+            return (script_type, "\x76\xa9\x14" + key_hash + "\x88\xac")
+         elif script_type == "scripthash":
+            return (script_type, "\xa9\x14" + key_hash + "\x87")
+         else:
+            return (script_type, "\x00\x14" + key_hash)
+
+      for height in xrange(0, num_blocks):
+
+         txs = []
+         txids = []
+         new_utxos = []
+
+         # coinbase
+         script_type, script_pubkey = make_script_pubkey()
+         raw_tx, txid = serialize_transaction( [("00" * 32, 0xffffffff, serialize_push( struct.pack( "<I", height ) ))], [(COINBASE_VALUE, script_pubkey)] )
+         txs.append( raw_tx )
+         txids.append( txid )
+         new_utxos.append( (txid, 0, COINBASE_VALUE, script_type) )
+
+         for i in xrange(1, txs_per_block):
+            if len(utxos) == 0:
+               break
+
+            spent = [utxos.pop( rand.randrange( len(utxos) ) ) for j in xrange(0, min( len(utxos), rand.randint(1, max_inputs) ))]
+            value_in = sum( [value for (_, _, value, _) in spent] )
+
+            inputs = []
+            witnesses = []
+            for (prev_txid, prev_vout, _, prev_type) in spent:
+               signature = "\x30" + "".join( [chr(rand.randint(0, 255)) for j in xrange(0, 70)] )
+               pubkey = "\x02" + "".join( [chr(rand.randint(0, 255)) for j in xrange(0, 32)] )
+
+               if prev_type == "witness_v0_keyhash":
+                  inputs.append( (prev_txid, prev_vout, "") )
+                  witnesses.append( [signature, pubkey] )
+               else:
+                  inputs.append( (prev_txid, prev_vout, serialize_push( signature ) + serialize_push( pubkey )) )
+                  witnesses.append( [] )
+
+            outputs = []
+            output_types = []
+            num_outputs = rand.randint(1, 2)
+            value_out = max( 0, value_in - SYNTHETIC_FEE )
+            for j in xrange(0, num_outputs):
+               script_type, script_pubkey = make_script_pubkey()
+               outputs.append( (value_out / num_outputs, script_pubkey) )
+               output_types.append( script_type )
+
+            if rand.random() < nulldata_rate:
+               payload = magic + rand.choice( SYNTHETIC_OPCODES ) + "".join( [chr(rand.randint(0, 255)) for j in xrange(0, rand.randint(16, 60))] )
+               outputs.append( (0, chr(OP_RETURN) + serialize_push( payload )) )
+               output_types.append( "nulldata" )
+
+            if len([w for w in witnesses if len(w) > 0]) == 0:
+               witnesses = None
+
+            raw_tx, txid = serialize_transaction( inputs, outputs, witnesses=witnesses, version=2 )
+            txs.append( raw_tx )
+            txids.append( txid )
+
+            for j in xrange(0, len(outputs)):
+               if output_types[j] != "nulldata":
+                  new_utxos.append( (txid, j, outputs[j][0], output_types[j]) )
+
+         utxos += new_utxos
+
+         header = struct.pack( "<i32s32sIII", 0x20000000, prev_hash, merkle_root( txids ), 1231006505 + 600 * height, 0x207fffff, height )
+         raw_blocks.append( header + serialize_varint( len(txs) ) + "".join( txs ) )
+         prev_hash = sha256d( header )
+
+      return cls( raw_blocks, start_height=0, network=network )
+
+
+class MockBitcoindError( Exception ):
+   """
+   An error for the mock bitcoind to send back, as bitcoind would.
+   """
+   def __init__( self, code, message ):
+      Exception.__init__( self, message )
+      self.error = {"code": code, "message": message}
+
+
+class MockBitcoind( object ):
+   """
+   Answer bitcoind RPCs from a MockChain, as bitcoind would.
+   """
+
+   def __init__( self, chain ):
+      self.chain = chain
+
+
+   def getblockcount( self ):
+      return self.chain.get_height()
+
+
+   def getbestblockhash( self ):
+      return self.chain.block_hashes[-1]
+
+
+   def getblockhash( self, height ):
+      idx = int(height) - self.chain.start_height
+      if idx < 0 or idx >= len(self.chain.block_hashes):
+         raise MockBitcoindError( RPC_INVALID_PARAMETER, "Block height out of range" )
+
+      return self.chain.block_hashes[idx]
+
+
+   def decode_transaction( self, raw_tx ):
+      """
+      Decode a serialized transaction into bitcoind's verbose form.
+      """
+      tx, _ = deserialize_transaction( raw_tx, network=self.chain.network )
+
+      del tx['nulldata']
+      del tx['nulldata_bin']
+
+      tx['hex'] = binascii.hexlify( raw_tx )
+      for output in tx['vout']:
+         output['scriptPubKey']['asm'] = script_to_asm( binascii.unhexlify( output['scriptPubKey']['hex'] ) )
+
+      return tx
+
+
+   def add_prevouts( self, tx ):
+      """
+      Annotate a decoded transaction's inputs with the outputs they
+      spend, as getblock verbosity 3 does.
+      """
+      for input in tx['vin']:
+         if 'txid' not in input or not self.chain.outputs.has_key( input['txid'] ):
+            continue
+
+         script_pubkeys, values, height, coinbase = self.chain.outputs[input['txid']]
+         input['prevout'] = {
+            "generated": coinbase,
+            "height": height,
+            "value": values[input['vout']],
+            "scriptPubKey": dict( script_pubkeys[input['vout']], asm=script_to_asm( binascii.unhexlify( script_pubkeys[input['vout']]['hex'] ) ) )
+         }
+
+
+   def getblock( self, block_hash, verbosity=1 ):
+      if not self.chain.raw_blocks.has_key( block_hash ):
+         raise MockBitcoindError( RPC_INVALID_ADDRESS_OR_KEY, "Block not found" )
+
+      if verbosity is True:
+         verbosity = 1
+      elif verbosity is False:
+         verbosity = 0
+
+      raw_block = self.chain.raw_blocks[block_hash]
+      if verbosity == 0:
+         return binascii.hexlify( raw_block )
+
+      block = deserialize_block( raw_block, network=self.chain.network )
+      height = self.chain.get_block_height( block_hash )
+
+      block['height'] = height
+      block['confirmations'] = self.chain.get_height() - height + 1
+      block['nTx'] = len(block['tx'])
+      if height == self.chain.start_height and block['previousblockhash'] == "00" * 32:
+         del block['previousblockhash']
+
+      if height < self.chain.get_height():
+         block['nextblockhash'] = self.chain.block_hashes[height - self.chain.start_height + 1]
+
+      if verbosity == 1:
+         block['tx'] = [tx['txid'] for tx in block['tx']]
+         return block
+
+      offset = 80 + len(serialize_varint( len(block['tx']) ))
+      txs = []
+      for tx in block['tx']:
+         decoded = self.decode_transaction( raw_block[offset:offset+tx['size']] )
+         if verbosity >= 3:
+            self.add_prevouts( decoded )
+
+         txs.append( decoded )
+         offset += tx['size']
+
+      block['tx'] = txs
+      return block
+
+
+   def getrawtransaction( self, txid, verbose=0 ):
+      raw_tx, block_hash = self.chain.get_raw_transaction( txid )
+      if raw_tx is None:
+         raise MockBitcoindError( RPC_INVALID_ADDRESS_OR_KEY, "No such mempool or blockchain transaction" )
+
+      if not verbose:
+         return binascii.hexlify( raw_tx )
+
+      tx = self.decode_transaction( raw_tx )
+      height = self.chain.get_block_height( block_hash )
+
+      tx['blockhash'] = block_hash
+      tx['confirmations'] = self.chain.get_height() - height + 1
+      return tx
+
+
+   def waitforblockheight( self, height, timeout=0 ):
+      """
+      Wait until the chain reaches the given height (i.e. a block
+      gets appended to it), or for timeout milliseconds (0 means
+      forever).  Return the tip either way.
+      """
+      deadline = time.time() + timeout / 1000.0
+      while self.chain.get_height() < int(height) and (timeout <= 0 or time.time() < deadline):
+         time.sleep( WAIT_POLL_INTERVAL )
+
+      return {"hash": self.getbestblockhash(), "height": self.chain.get_height()}
+
+
+   def call( self, method, params ):
+      """
+      Carry out an RPC.  Raise MockBitcoindError on error.
+      """
+      if method not in ["getblockcount", "getbestblockhash", "getblockhash", "getblock", "getrawtransaction", "waitforblockheight"]:
+         raise MockBitcoindError( RPC_METHOD_NOT_FOUND, "Method not found" )
+
+      try:
+         return getattr( self, method )( *params )
+
+      except TypeError, te:
+         raise MockBitcoindError( RPC_MISC_ERROR, str(te) )
+
+
+class MockJSONEncoder( json.JSONEncoder ):
+   """
+   Encode amounts as bitcoind does (i.e. as numbers with 8 decimal
+   places).  json can't write a number like that itself, so amounts
+   are written as marked strings, which encode_json() then unquotes.
+   """
+   def default( self, o ):
+      if isinstance( o, decimal.Decimal ):
+         return "%s%s" % (AMOUNT_MARKER, "{:.8f}".format( o ))
+
+      return json.JSONEncoder.default( self, o )
+
+
+def encode_json( obj ):
+   """
+   Encode an RPC response as bitcoind would.
+   """
+   return AMOUNT_PATTERN.sub( r"\1", json.dumps( obj, cls=MockJSONEncoder ) )
+
+
+class BandwidthLimiter( object ):
+   """
+   Limit the rate at which all of a server's connections send,
+   like the link between bitcoind and us would.
+   """
+
+   def __init__( self, bytes_per_second ):
+      self.bytes_per_second = float(bytes_per_second)
+      self.lock = threading.Lock()
+      self.next_free = 0
+
+
+   def consume( self, num_bytes ):
+      """
+      Wait until num_bytes can go out.
+      """
+      with self.lock:
+         now = time.time()
+         start = max( now, self.next_free )
+         self.next_free = start + num_bytes / self.bytes_per_second
+
+      if self.next_free > now:
+         time.sleep( self.next_free - now )
+
+
+class MockBitcoindRequestHandler( BaseHTTPRequestHandler ):
+   """
+   Handle a JSON-RPC request (or batch of them) over HTTP,
+   as bitcoind's HTTP server does.  Connections are kept alive.
+   """
+
+   protocol_version = "HTTP/1.1"
+
+   def log_message( self, format, *args ):
+      log.debug("mock bitcoind: " + format % args)
+
+
+   def do_POST( self ):
+      server = self.server
+      server.count( "requests" )
+
+      body = self.rfile.read( int(self.headers.get("Content-Length", 0)) )
+
+      if server.drop_rate > 0 and server.random.random() < server.drop_rate:
+         # hang up without answering
+         server.count( "dropped" )
+         self.close_connection = 1
+         return
+
+      if server.rpc_threads is not None:
+         server.rpc_thread_slots.acquire()
+
+      try:
+         if server.latency > 0 or server.latency_jitter > 0:
+            time.sleep( server.latency + server.random.random() * server.latency_jitter )
+
+         try:
+            request = json.loads( body )
+
+         except ValueError:
+            self.send_json( 500, {"result": None, "error": {"code": RPC_PARSE_ERROR, "message": "Parse error"}, "id": None} )
+            return
+
+         if type(request) == list:
+            if not server.batch:
+               # like a bitcoind that predates batching
+               self.send_json( 500, {"result": None, "error": {"code": RPC_PARSE_ERROR, "message": "Top-level object parse error"}, "id": None} )
+               return
+
+            server.count( "batches" )
+            self.send_json( 200, [self.handle_call( call ) for call in request] )
+
+         else:
+            response = self.handle_call( request )
+            self.send_json( 200 if response['error'] is None else 500, response )
+
+      finally:
+         if server.rpc_threads is not None:
+            server.rpc_thread_slots.release()
+
+
+   def handle_call( self, call ):
+      """
+      Carry out one call, and make its response.
+      """
+      server = self.server
+      method = call.get( "method", None )
+      server.count( "calls" )
+      server.count( "calls.%s" % method )
+
+      if server.error_rate > 0 and server.random.random() < server.error_rate:
+         server.count( "errors" )
+         return {"result": None, "error": INJECTED_ERROR, "id": call.get("id", None)}
+
+      try:
+         result = server.bitcoind.call( method, call.get("params", []) )
+
+      except MockBitcoindError, me:
+         server.count( "errors" )
+         return {"result": None, "error": me.error, "id": call.get("id", None)}
+
+      return {"result": result, "error": None, "id": call.get("id", None)}
+
+
+   def send_json( self, status, response ):
+      """
+      Send a JSON response, no faster than the bandwidth limit allows.
+      """
+      data = encode_json( response )
+
+      self.send_response( status )
+      self.send_header( "Content-Type", "application/json" )
+      self.send_header( "Content-Length", str(len(data)) )
+      self.end_headers()
+
+      if self.server.bandwidth_limiter is None:
+         self.wfile.write( data )
+
+      else:
+         for i in xrange(0, len(data), BANDWIDTH_CHUNK_SIZE):
+            chunk = data[i:i+BANDWIDTH_CHUNK_SIZE]
+            self.server.bandwidth_limiter.consume( len(chunk) )
+            self.wfile.write( chunk )
+
+      self.server.count( "bytes_sent", len(data) )
+
+
+class MockBitcoindServer( ThreadingMixIn, HTTPServer ):
+   """
+   Serve a MockChain over HTTP JSON-RPC, on a thread of its own.
+
+   * latency:  seconds to wait before answering each request, plus up to latency_jitter more
+   * bandwidth:  most bytes per second to send, over all connections (None for no limit)
+   * error_rate:  fraction of calls to answer with an error
+   * drop_rate:  fraction of requests to hang up on without answering
+   * rpc_threads:  most requests to work on at once, like bitcoind's -rpcthreads (None for no limit)
+   * batch:  whether or not to accept JSON-RPC batches
+   """
+
+   daemon_threads = True
+   allow_reuse_address = True
+
+   def __init__( self, chain, host="127.0.0.1", port=0, latency=0, latency_jitter=0, bandwidth=None, error_rate=0, drop_rate=0, rpc_threads=None, batch=True, seed=None ):
+      HTTPServer.__init__( self, (host, port), MockBitcoindRequestHandler )
+
+      self.chain = chain
+      self.bitcoind = MockBitcoind( chain )
+
+      self.latency = latency
+      self.latency_jitter = latency_jitter
+      self.bandwidth_limiter = BandwidthLimiter( bandwidth ) if bandwidth else None
+      self.error_rate = error_rate
+      self.drop_rate = drop_rate
+      self.rpc_threads = rpc_threads
+      self.rpc_thread_slots = threading.Semaphore( rpc_threads ) if rpc_threads is not None else None
+      self.batch = batch
+      self.random = random.Random( seed )
+
+      self.stats = {}
+      self.stats_lock = threading.Lock()
+      self.thread = None
+
+      self.connections = set()    # open client sockets, so stop() can hang up on them
+      self.connections_lock = threading.Lock()
+
+
+   def count( self, name, amount=1 ):
+      with self.stats_lock:
+         self.stats[name] = self.stats.get( name, 0 ) + amount
+
+
+   def process_request( self, request, client_address ):
+      with self.connections_lock:
+         self.connections.add( request )
+
+      ThreadingMixIn.process_request( self, request, client_address )
+
+
+   def shutdown_request( self, request ):
+      with self.connections_lock:
+         self.connections.discard( request )
+
+      HTTPServer.shutdown_request( self, request )
+
+
+   def handle_error( self, request, client_address ):
+      """
+      Clients hang up on us all the time (i.e. when a worker is torn down);
+      don't print a traceback when they do.
+      """
+      exc = sys.exc_info()[1]
+      if isinstance( exc, socket.error ):
+         log.debug("Connection from %s:%s closed: %s" % (client_address[0], client_address[1], exc))
+         return
+
+      HTTPServer.handle_error( self, request, client_address )
+
+
+   def get_stats( self ):
+      """
+      Get the server's request counters, as a dict.
+      """
+      with self.stats_lock:
+         return dict(self.stats)
+
+
+   def get_port( self ):
+      return self.server_address[1]
+
+
+   def start( self ):
+      """
+      Start serving, on a daemon thread.
+      """
+      self.thread = threading.Thread( target=self.serve_forever )
+      self.thread.daemon = True
+      self.thread.start()
+
+      log.debug("Mock bitcoind serving blocks %s-%s at %s:%s" % (self.chain.start_height, self.chain.get_height(), self.server_address[0], self.get_port()))
+      return self
+
+
+   def stop( self ):
+      """
+      Stop serving, and hang up on clients' kept-alive connections
+      so their request threads exit.
+      """
+      self.shutdown()
+      self.server_close()
+
+      with self.connections_lock:
+         connections = list(self.connections)
+
+      for connection in connections:
+         try:
+            connection.shutdown( socket.SHUT_RDWR )
+         except socket.error:
+            pass
+
+
+   def get_bitcoind_opts( self, bitcoind_opts=None ):
+      """
+      Get bitcoind options that point to this server
+      (a copy of bitcoind_opts, if given, with the connection options replaced).
+      """
+      opts = dict(bitcoind_opts or {})
+      opts.update( {
+         "bitcoind_server": self.server_address[0],
+         "bitcoind_port": self.get_port(),
+         "bitcoind_user": opts.get("bitcoind_user", None) or "mock",
+         "bitcoind_passwd": opts.get("bitcoind_passwd", None) or "mock",
+         "bitcoind_use_https": False
+      } )
+
+      if self.chain.network != "mainnet":
+         opts['bitcoin_network'] = self.chain.network
+
+      return opts
+
+
+   def connect_bitcoind( self, bitcoind_opts ):
+      """
+      Connect to this server, instead of the bitcoind in bitcoind_opts.
+      Pass as setup_virtualchain()'s bitcoind_connection_factory.
+      """
+      return session.connect_bitcoind( self.get_bitcoind_opts( bitcoind_opts ) )
+
+
+def main( argv ):
+   """
+   Run a mock bitcoind from the command line.
+   """
+   parser = argparse.ArgumentParser( description="Serve a synthetic or recorded chain over bitcoind's JSON-RPC interface" )
+   parser.add_argument( "--host", default="127.0.0.1", help="address to listen on" )
+   parser.add_argument( "--port", type=int, default=18332, help="port to listen on" )
+   parser.add_argument( "--chain", help="JSON chain fixture to serve (see MockChain.save())" )
+   parser.add_argument( "--blocks", type=int, default=1000, help="number of synthetic blocks to serve, if no --chain is given" )
+   parser.add_argument( "--txs-per-block", type=int, default=10, help="transactions per synthetic block" )
+   parser.add_argument( "--nulldata-rate", type=float, default=0.3, help="fraction of synthetic transactions with nulldata" )
+   parser.add_argument( "--magic", default="id", help="magic bytes that synthetic nulldata starts with" )
+   parser.add_argument( "--max-inputs", type=int, default=2, help="most inputs per synthetic transaction" )
+   parser.add_argument( "--save", help="save the chain to this JSON fixture file" )
+   parser.add_argument( "--latency", type=float, default=0, help="seconds to wait before answering each request" )
+   parser.add_argument( "--latency-jitter", type=float, default=0, help="up to this many more seconds to wait, at random" )
+   parser.add_argument( "--bandwidth", type=float, default=None, help="most bytes per second to send" )
+   parser.add_argument( "--error-rate", type=float, default=0, help="fraction of calls to fail" )
+   parser.add_argument( "--drop-rate", type=float, default=0, help="fraction of requests to hang up on" )
+   parser.add_argument( "--rpc-threads", type=int, default=None, help="most requests to work on at once" )
+   parser.add_argument( "--no-batch", action="store_true", help="reject JSON-RPC batches" )
+   args = parser.parse_args( argv )
+
+   if args.chain is not None:
+      chain = MockChain.load( args.chain )
+   else:
+      chain = MockChain.synthetic( args.blocks, txs_per_block=args.txs_per_block, nulldata_rate=args.nulldata_rate, magic=args.magic, max_inputs=args.max_inputs )
+
+   if args.save is not None:
+      chain.save( args.save )
+
+   server = MockBitcoindServer( chain, host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter, bandwidth=args.bandwidth,
+                                error_rate=args.error_rate, drop_rate=args.drop_rate, rpc_threads=args.rpc_threads, batch=not args.no_batch )
+
+   print "Serving blocks %s-%s at http://%s:%s" % (chain.start_height, chain.get_height(), args.host, server.get_port())
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+
+   return 0
+
+
+if __name__ == "__main__":
+   sys.exit( main( sys.argv[1:] ) )
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Finding out about new blocks, so run_virtualchain() can index
+them as soon as they arrive instead of on its next poll:
+
+* over ZMQ, from bitcoind's -zmqpubhashblock publisher (needs pyzmq);
+* with a long-polling RPC (waitforblockheight), which bitcoind
+answers as soon as it has a block at the height we're waiting for;
+* by polling, every REINDEX_FREQUENCY seconds.
+
+Notifications can get lost (i.e. ZMQ drops messages while we're not
+listening, and bitcoind can restart), so notifiers give up waiting
+after a timeout, and the caller checks for new blocks anyway.
+"""
+
+import os
+import time
+import types
+import binascii
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from .. import config
+
+import session
+log = session.log
+
+try:
+   import zmq
+except ImportError:
+   zmq = None
+
+# bitcoind's "method not found" error code
+RPC_METHOD_NOT_FOUND = -32601
+
+
+class BlockNotifier( object ):
+   """
+   Wait for new blocks by polling every poll_interval seconds.
+   Subclasses wait for bitcoind to tell us about them instead.
+   """
+
+   name = "poll"
+
+   def __init__( self, poll_interval=None ):
+      if poll_interval is None:
+         poll_interval = config.REINDEX_FREQUENCY
+
+      self.poll_interval = poll_interval
+
+
+   def wait( self, last_block_id ):
+      """
+      Wait until there may be a block after last_block_id.
+      Return True if we were told there is one, and False if
+      we only waited out the timeout (there may be one anyway).
+      """
+      time.sleep( self.poll_interval )
+      return False
+
+
+   def close( self ):
+      """
+      Stop listening for new blocks.
+      """
+      pass
+
+
+class ZMQBlockNotifier( BlockNotifier ):
+   """
+   Wait for new blocks by subscribing to bitcoind's hashblock
+   messages (i.e. bitcoind -zmqpubhashblock=tcp://127.0.0.1:28332).
+
+   The subscription stays open between calls to wait(), so blocks
+   that arrive while the caller is indexing are not missed.
+   """
+
+   name = "zmq"
+
+   def __init__( self, address, timeout ):
+      super( ZMQBlockNotifier, self ).__init__( timeout )
+
+      if zmq is None:
+         raise Exception("pyzmq is not installed")
+
+      self.address = address
+      self.context = zmq.Context()
+      self.socket = self.context.socket( zmq.SUB )
+      self.socket.setsockopt( zmq.SUBSCRIBE, "hashblock" )
+      self.socket.setsockopt( zmq.LINGER, 0 )
+      self.socket.connect( address )
+
+      log.debug("Listening for new blocks at %s" % address)
+
+
+   def wait( self, last_block_id ):
+      """
+      Wait for a hashblock message, or the timeout.
+      Return True if we got at least one.
+      """
+      if self.socket.poll( int(self.poll_interval * 1000) ) == 0:
+         return False
+
+      # drain the backlog; the caller only needs to know there is something new
+      while True:
+         try:
+            parts = self.socket.recv_multipart( zmq.NOBLOCK )
+
+         except zmq.Again:
+            break
+
+         if len(parts) >= 2:
+            log.debug("New block %s" % binascii.hexlify( parts[1] ))
+
+      return True
+
+
+   def close( self ):
+      self.socket.close()
+      self.context.term()
+
+
+class LongPollBlockNotifier( BlockNotifier ):
+   """
+   Wait for new blocks with bitcoind's waitforblockheight RPC,
+   which returns once bitcoind has a block at the given height (or after
+   the given timeout).  Unlike waitfornewblock, it can't miss a block that
+   arrives between calls.
+
+   Falls back to polling if bitcoind does not have waitforblockheight
+   (it is only in bitcoind 0.14 and later).
+
+   The RPC ties up the given bitcoind connection while it waits, so it
+   should not be one that is shared with other threads.  Its HTTP timeout
+   must be longer than the notifier's timeout.
+   """
+
+   name = "longpoll"
+
+   def __init__( self, bitcoind, timeout ):
+      super( LongPollBlockNotifier, self ).__init__( timeout )
+      self.bitcoind = bitcoind
+      self.supported = None
+
+
+   def wait( self, last_block_id ):
+      """
+      Wait for a block after last_block_id, or the timeout.
+      Return True if there is one.
+      """
+      if self.supported is False or last_block_id is None:
+         time.sleep( config.REINDEX_FREQUENCY )
+         return False
+
+      try:
+         tip = self.bitcoind.waitforblockheight( last_block_id + 1, int(self.poll_interval * 1000) )
+
+      except JSONRPCException, je:
+         if type(je.error) == types.DictType and je.error.get('code', None) == RPC_METHOD_NOT_FOUND:
+            log.warning("bitcoind does not support waitforblockheight; polling for new blocks instead")
+            self.supported = False
+
+         else:
+            log.error("waitforblockheight failed: %s" % je.error)
+
+         time.sleep( config.REINDEX_FREQUENCY )
+         return False
+
+      except Exception, e:
+         # probably a transient bitcoind failure; don't spin
+         log.error("[%s] Failed to wait for new blocks: %s" % (os.getpid(), repr(e)))
+         time.sleep( config.REINDEX_FREQUENCY )
+         return False
+
+      self.supported = True
+      return int(tip['height']) > last_block_id
+
+
+def get_block_notifier( bitcoind, bitcoind_opts ):
+   """
+   Make a notifier for new blocks, as configured (see configure_block_notify()).
+   bitcoind is the client to long-poll with.
+
+   In "auto" mode, use ZMQ if we have an address for bitcoind's
+   publisher and pyzmq is installed, and otherwise long-poll.
+   """
+
+   method, zmq_address, timeout = config.configure_block_notify( bitcoind_opts )
+
+   if method == "auto":
+      if zmq_address is not None and zmq is not None:
+         method = "zmq"
+      else:
+         method = "longpoll"
+
+   if method == "zmq":
+      if zmq_address is None:
+         raise Exception("No bitcoind ZMQ hashblock address given")
+
+      return ZMQBlockNotifier( zmq_address, timeout )
+
+   elif method == "longpoll":
+      return LongPollBlockNotifier( bitcoind, timeout )
+
+   else:
+      return BlockNotifier()
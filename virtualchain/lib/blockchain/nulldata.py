@@ -22,9 +22,16 @@
 """
 
 import sys 
+import binascii
 import pybitcoin
 
+from utilitybelt import is_hex
+
 def get_nulldata(tx):
+    if 'nulldata_bin' in tx:
+        # already found when the transaction was decoded
+        return tx['nulldata']
+    
     if not ('vout' in tx):
         return None
     
@@ -64,3 +71,33 @@ def get_nulldata(tx):
 
 def has_nulldata(tx):
     return (get_nulldata(tx) is not None)
+
+
+def is_virtualchain_nulldata(nulldata, magic_bytes, opcodes=None):
+    """
+    Could this nulldata (a hex string) be a virtual chain operation,
+    i.e. does it start with magic_bytes followed by one of the opcodes
+    (if given)?  StateEngine.parse_transaction() ignores the rest, so 
+    their transactions need not be looked at any further.
+    """
+    
+    if nulldata is None:
+        return False
+    
+    if not is_hex(nulldata) or len(nulldata) % 2 != 0:
+        # the state engine ignores these too
+        return False
+    
+    try:
+        nulldata_bin = binascii.unhexlify(nulldata)
+    except Exception:
+        # let the state engine complain about it
+        return True
+    
+    if not nulldata_bin.startswith(magic_bytes) or len(nulldata_bin) <= len(magic_bytes):
+        return False
+    
+    if opcodes is not None and nulldata_bin[len(magic_bytes)] not in opcodes:
+        return False
+    
+    return True
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sqlite3
+import binascii
+
+from .. import config
+
+import session
+log = session.log
+
+PREVOUT_INDEX_SCHEMA = [
+   """
+   CREATE TABLE IF NOT EXISTS outputs(
+      txid BLOB NOT NULL,
+      vout INTEGER NOT NULL,
+      script_pubkey BLOB,
+      script_type TEXT,
+      addresses TEXT,
+      value INTEGER NOT NULL,
+      spent_height INTEGER,
+      PRIMARY KEY(txid, vout)
+   );
+   """,
+   """
+   CREATE INDEX IF NOT EXISTS outputs_spent_height ON outputs(spent_height);
+   """
+]
+
+# process-local index handle
+process_local_prevout_index = None
+
+class PrevoutIndex( object ):
+   """
+   Local index of the transaction outputs the indexer has seen,
+   i.e. (txid, vout) --> (scriptPubKey, script type, addresses, value),
+   so senders and fees can be found without asking bitcoind
+   (and without bitcoind needing a txindex).
+
+   Outputs are recorded as their blocks are fetched, and marked
+   spent by the inputs that spend them.  Spent outputs are pruned once
+   the spending block is buried deeply enough that it won't be
+   reorganized away.
+
+   Outputs created before indexing started are not in the index;
+   callers should fall back to bitcoind for those.
+   """
+
+   def __init__( self, path ):
+      self.path = path
+      self.hits = 0
+      self.misses = 0
+
+      # NOTE: only one thread uses this at a time, but it need not be the one that created it
+      self.db = sqlite3.connect( path, check_same_thread=False )
+      self.db.text_factory = str
+      self.db.execute( "PRAGMA journal_mode=WAL;" )
+      self.db.execute( "PRAGMA synchronous=NORMAL;" )
+
+      for stmt in PREVOUT_INDEX_SCHEMA:
+         self.db.execute( stmt )
+
+      self.db.commit()
+
+
+   def close( self ):
+      """
+      Close the index.
+      """
+      if self.db is not None:
+         self.db.close()
+         self.db = None
+
+
+   def record_outputs( self, txs ):
+      """
+      Record the outputs of a list of transactions (from bitcoind).
+      """
+      from .transactions import get_sender_and_amount_in_from_output
+
+      rows = []
+      for tx in txs:
+
+         if tx is None or 'txid' not in tx or 'vout' not in tx:
+            continue
+
+         txid = binascii.unhexlify( tx['txid'] )
+         outputs = tx['vout']
+
+         for i in xrange(0, len(outputs)):
+            sender, value = get_sender_and_amount_in_from_output( outputs[i] )
+            if sender is None:
+               continue
+
+            script_pubkey = None
+            if sender['script_pubkey'] is not None:
+               script_pubkey = sqlite3.Binary( binascii.unhexlify( sender['script_pubkey'] ) )
+
+            addresses = None
+            if sender['addresses'] is not None:
+               addresses = ",".join( sender['addresses'] )
+
+            rows.append( (sqlite3.Binary(txid), outputs[i].get('n', i), script_pubkey, sender['script_type'], addresses, value) )
+
+      self.db.executemany( "INSERT OR REPLACE INTO outputs (txid, vout, script_pubkey, script_type, addresses, value) VALUES (?,?,?,?,?,?);", rows )
+      return len(rows)
+
+
+   def record_spends( self, block_height, txs ):
+      """
+      Mark the outputs spent by a list of transactions
+      (from bitcoind) in the block at block_height.
+      """
+      rows = []
+      for tx in txs:
+
+         if tx is None or 'vin' not in tx:
+            continue
+
+         for input in tx['vin']:
+            if 'txid' not in input or 'vout' not in input:
+               continue
+
+            rows.append( (block_height, sqlite3.Binary( binascii.unhexlify( input['txid'] ) ), input['vout']) )
+
+      self.db.executemany( "UPDATE outputs SET spent_height = ? WHERE txid = ? AND vout = ?;", rows )
+      return len(rows)
+
+
+   def record_blocks( self, block_txs ):
+      """
+      Record a set of blocks' transactions.
+      block_txs is a list of (block_height, [txs]).
+      Outputs are recorded before spends, so blocks can be given in any order.
+      """
+      for block_height, txs in block_txs:
+         self.record_outputs( txs )
+
+      for block_height, txs in block_txs:
+         self.record_spends( block_height, txs )
+
+      self.db.commit()
+
+
+   def get_sender_and_amount( self, txid, vout ):
+      """
+      Get the sender and amount for a transaction output,
+      in the same form as get_sender_and_amount_in_from_txn().
+      Return None if the output is not in the index.
+      """
+      cur = self.db.execute( "SELECT script_pubkey, script_type, addresses, value FROM outputs WHERE txid = ? AND vout = ?;", (sqlite3.Binary( binascii.unhexlify( txid ) ), vout) )
+      row = cur.fetchone()
+
+      if row is None:
+         self.misses += 1
+         return None
+
+      self.hits += 1
+      script_pubkey, script_type, addresses, value = row
+
+      if script_pubkey is not None:
+         script_pubkey = binascii.hexlify( script_pubkey )
+
+      if addresses is not None:
+         addresses = addresses.split(",")
+
+      sender = {
+         "script_pubkey": script_pubkey,
+         "script_type": script_type,
+         "amount": value,
+         "addresses": addresses
+      }
+
+      return sender, value
+
+
+   def prune( self, max_spent_height ):
+      """
+      Forget outputs that were spent at or below max_spent_height.
+      """
+      cur = self.db.execute( "DELETE FROM outputs WHERE spent_height IS NOT NULL AND spent_height <= ?;", (max_spent_height,) )
+      self.db.commit()
+
+      if cur.rowcount > 0:
+         log.debug("Pruned %s spent outputs at or below block %s" % (cur.rowcount, max_spent_height))
+
+      return cur.rowcount
+
+
+   def get_stats( self ):
+      """
+      Get the index's lookup counters, as a dict.
+      """
+      return {
+         "hits": self.hits,
+         "misses": self.misses
+      }
+
+
+def get_prevout_index( bitcoind_opts ):
+   """
+   Get this process's local index of transaction outputs.
+   Return None if it is disabled.
+   """
+
+   global process_local_prevout_index
+
+   path = config.configure_prevout_index( bitcoind_opts )
+   if path is None:
+      return None
+
+   if process_local_prevout_index is None or process_local_prevout_index.path != path:
+      process_local_prevout_index = PrevoutIndex( path )
+
+   return process_local_prevout_index
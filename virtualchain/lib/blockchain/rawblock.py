@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import struct
+import hashlib
+import binascii
+
+import pybitcoin
+
+from .txrecord import satoshis_to_value
+
+# script opcodes we need to recognize
+OP_0 = 0x00
+OP_PUSHDATA1 = 0x4c
+OP_PUSHDATA2 = 0x4d
+OP_PUSHDATA4 = 0x4e
+OP_1NEGATE = 0x4f
+OP_1 = 0x51
+OP_16 = 0x60
+OP_RETURN = 0x6a
+OP_DUP = 0x76
+OP_EQUAL = 0x87
+OP_EQUALVERIFY = 0x88
+OP_HASH160 = 0xa9
+OP_CHECKSIG = 0xac
+OP_CHECKMULTISIG = 0xae
+
+# (pubkey hash address version, script hash address version, bech32 human-readable part)
+BITCOIN_NETWORK_PARAMS = {
+   "mainnet": (0x00, 0x05, "bc"),
+   "testnet": (0x6f, 0xc4, "tb"),
+   "regtest": (0x6f, 0xc4, "bcrt")
+}
+
+BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+
+
+class BlockDeserializeError( Exception ):
+   """
+   Raised when a serialized block or transaction is malformed.
+   """
+   pass
+
+
+def sha256d( data ):
+   """
+   Double-SHA256 of a byte string.
+   """
+   return hashlib.sha256( hashlib.sha256( data ).digest() ).digest()
+
+
+def read_varint( data, offset ):
+   """
+   Read a Bitcoin variable-length integer at offset.
+   Return (value, new offset).
+   """
+   prefix = ord(data[offset])
+   if prefix < 0xfd:
+      return (prefix, offset + 1)
+
+   elif prefix == 0xfd:
+      return (struct.unpack_from( "<H", data, offset + 1 )[0], offset + 3)
+
+   elif prefix == 0xfe:
+      return (struct.unpack_from( "<I", data, offset + 1 )[0], offset + 5)
+
+   else:
+      return (struct.unpack_from( "<Q", data, offset + 1 )[0], offset + 9)
+
+
+def bech32_polymod( values ):
+   """
+   BIP173 checksum.
+   """
+   generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+   chk = 1
+   for value in values:
+      top = chk >> 25
+      chk = (chk & 0x1ffffff) << 5 ^ value
+      for i in xrange(0, 5):
+         chk ^= generator[i] if ((top >> i) & 1) else 0
+
+   return chk
+
+
+def bech32_encode_address( hrp, witness_version, witness_program ):
+   """
+   Encode a segwit address (bech32 for version 0, bech32m otherwise).
+   """
+   # convert 8-bit program to 5-bit groups
+   acc = 0
+   bits = 0
+   data = [witness_version]
+   for b in witness_program:
+      acc = (acc << 8) | ord(b)
+      bits += 8
+      while bits >= 5:
+         bits -= 5
+         data.append( (acc >> bits) & 31 )
+
+   if bits > 0:
+      data.append( (acc << (5 - bits)) & 31 )
+
+   const = BECH32_CONST if witness_version == 0 else BECH32M_CONST
+   hrp_expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+   polymod = bech32_polymod( hrp_expanded + data + [0] * 6 ) ^ const
+   checksum = [(polymod >> 5 * (5 - i)) & 31 for i in xrange(0, 6)]
+
+   return hrp + "1" + "".join( [BECH32_CHARSET[d] for d in data + checksum] )
+
+
+def parse_script( script ):
+   """
+   Split a script into a list of (opcode, pushed data or None).
+   Return None if the script is malformed (i.e. a push runs off the end).
+   """
+   ops = []
+   i = 0
+   while i < len(script):
+      opcode = ord(script[i])
+      i += 1
+
+      if opcode >= 0x01 and opcode < OP_PUSHDATA1:
+         size = opcode
+
+      elif opcode == OP_PUSHDATA1:
+         if i + 1 > len(script):
+            return None
+         size = ord(script[i])
+         i += 1
+
+      elif opcode == OP_PUSHDATA2:
+         if i + 2 > len(script):
+            return None
+         size = struct.unpack_from( "<H", script, i )[0]
+         i += 2
+
+      elif opcode == OP_PUSHDATA4:
+         if i + 4 > len(script):
+            return None
+         size = struct.unpack_from( "<I", script, i )[0]
+         i += 4
+
+      else:
+         ops.append( (opcode, None) )
+         continue
+
+      if i + size > len(script):
+         return None
+
+      ops.append( (opcode, script[i:i+size]) )
+      i += size
+
+   return ops
+
+
+def is_push_only( ops ):
+   """
+   Is a parsed script made up only of pushes (including small integers)?
+   """
+   for (opcode, _) in ops:
+      if opcode > OP_16:
+         return False
+
+   return True
+
+
+def pubkey_to_address( pubkey, network_params ):
+   """
+   Get the pay-to-pubkey-hash address for a public key.
+   """
+   return pybitcoin.b58check_encode( pybitcoin.bin_hash160( pubkey ), version_byte=network_params[0] )
+
+
+def classify_script_pubkey( script, network_params ):
+   """
+   Work out a scriptPubKey's type and addresses, the way
+   bitcoind reports them in its verbose output.
+   Return (type, [addresses] or None)
+   """
+   size = len(script)
+
+   # fast paths for the common templates
+   if size == 25 and ord(script[0]) == OP_DUP and ord(script[1]) == OP_HASH160 and ord(script[2]) == 20 and ord(script[23]) == OP_EQUALVERIFY and ord(script[24]) == OP_CHECKSIG:
+      return ("pubkeyhash", [pybitcoin.b58check_encode( script[3:23], version_byte=network_params[0] )])
+
+   if size == 23 and ord(script[0]) == OP_HASH160 and ord(script[1]) == 20 and ord(script[22]) == OP_EQUAL:
+      return ("scripthash", [pybitcoin.b58check_encode( script[2:22], version_byte=network_params[1] )])
+
+   if size >= 1 and ord(script[0]) == OP_RETURN:
+      ops = parse_script( script[1:] )
+      if ops is not None and is_push_only( ops ):
+         return ("nulldata", None)
+
+      return ("nonstandard", None)
+
+   if size >= 4 and size <= 42 and (ord(script[0]) == OP_0 or (ord(script[0]) >= OP_1 and ord(script[0]) <= OP_16)) and ord(script[1]) == size - 2 and size - 2 >= 2:
+      witness_version = 0 if ord(script[0]) == OP_0 else ord(script[0]) - OP_1 + 1
+      witness_program = script[2:]
+
+      if witness_version == 0 and len(witness_program) == 20:
+         return ("witness_v0_keyhash", [bech32_encode_address( network_params[2], 0, witness_program )])
+
+      if witness_version == 0 and len(witness_program) == 32:
+         return ("witness_v0_scripthash", [bech32_encode_address( network_params[2], 0, witness_program )])
+
+      if witness_version == 1 and len(witness_program) == 32:
+         return ("witness_v1_taproot", [bech32_encode_address( network_params[2], 1, witness_program )])
+
+      if witness_version != 0:
+         return ("witness_unknown", [bech32_encode_address( network_params[2], witness_version, witness_program )])
+
+      return ("nonstandard", None)
+
+   if (size == 35 or size == 67) and ord(script[0]) == size - 2 and ord(script[-1]) == OP_CHECKSIG:
+      return ("pubkey", [pubkey_to_address( script[1:-1], network_params )])
+
+   if size >= 37 and ord(script[-1]) == OP_CHECKMULTISIG:
+      ops = parse_script( script )
+      if ops is not None and len(ops) >= 4:
+         required = ops[0][0]
+         total = ops[-2][0]
+         pubkeys = [data for (_, data) in ops[1:-2]]
+
+         if required >= OP_1 and required <= OP_16 and total >= OP_1 and total <= OP_16 and \
+            total - OP_1 + 1 == len(pubkeys) and required <= total and None not in pubkeys:
+            return ("multisig", [pubkey_to_address( pubkey, network_params ) for pubkey in pubkeys])
+
+   return ("nonstandard", None)
+
+
+def deserialize_transaction( data, offset=0, network="mainnet" ):
+   """
+   Deserialize a transaction from data (a string, buffer, or mmap),
+   starting at offset.  Witness data is skipped over.
+
+   The transaction is returned in the same form that bitcoind's
+   getrawtransaction gives in verbose mode (i.e. with txid, vin, and vout),
+   except that scripts are given only as hex (no asm).  In addition,
+   the OP_RETURN payload is found while the outputs are scanned:
+   "nulldata" is its hex (or None), and "nulldata_bin" its raw bytes.
+
+   Return (tx, new offset)
+   """
+   network_params = BITCOIN_NETWORK_PARAMS[network]
+   start = offset
+
+   try:
+      version = struct.unpack_from( "<i", data, offset )[0]
+      offset += 4
+
+      # segwit marker and flag
+      segwit = False
+      if ord(data[offset]) == 0 and ord(data[offset+1]) != 0:
+         segwit = True
+         offset += 2
+
+      body_start = offset
+
+      num_inputs, offset = read_varint( data, offset )
+      vin = []
+      for i in xrange(0, num_inputs):
+         prev_txid = data[offset:offset+32]
+         prev_vout = struct.unpack_from( "<I", data, offset + 32 )[0]
+         offset += 36
+
+         script_len, offset = read_varint( data, offset )
+         script_sig = data[offset:offset+script_len]
+         offset += script_len
+
+         sequence = struct.unpack_from( "<I", data, offset )[0]
+         offset += 4
+
+         if prev_txid == "\x00" * 32 and prev_vout == 0xffffffff:
+            vin.append( {"coinbase": binascii.hexlify( script_sig ), "sequence": sequence} )
+
+         else:
+            vin.append( {"txid": binascii.hexlify( prev_txid[::-1] ), "vout": prev_vout, "scriptSig": {"hex": binascii.hexlify( script_sig )}, "sequence": sequence} )
+
+      num_outputs, offset = read_varint( data, offset )
+      vout = []
+      nulldata_bin = None
+      for i in xrange(0, num_outputs):
+         value = struct.unpack_from( "<q", data, offset )[0]
+         offset += 8
+
+         script_len, offset = read_varint( data, offset )
+         script = data[offset:offset+script_len]
+         offset += script_len
+
+         script_type, addresses = classify_script_pubkey( script, network_params )
+
+         # same rule as get_nulldata():  the first nulldata output with exactly one push
+         if nulldata_bin is None and script_type == "nulldata":
+            ops = parse_script( script[1:] )
+            if len(ops) == 1:
+               nulldata_bin = script[2:]
+
+         script_pubkey = {"hex": binascii.hexlify( script ), "type": script_type}
+         if addresses is not None:
+            script_pubkey['addresses'] = addresses
+
+         vout.append( {"value": satoshis_to_value( value ), "n": i, "scriptPubKey": script_pubkey} )
+
+      body_end = offset
+
+      if segwit:
+         for i in xrange(0, num_inputs):
+            num_items, offset = read_varint( data, offset )
+            witness = []
+            for j in xrange(0, num_items):
+               item_len, offset = read_varint( data, offset )
+               witness.append( binascii.hexlify( data[offset:offset+item_len] ) )
+               offset += item_len
+
+            if num_items > 0:
+               vin[i]['txinwitness'] = witness
+
+      locktime = struct.unpack_from( "<I", data, offset )[0]
+      offset += 4
+
+   except (IndexError, struct.error), e:
+      raise BlockDeserializeError("Truncated transaction at offset %s" % start)
+
+   if segwit:
+      # the txid does not cover the witness data
+      txid = sha256d( data[start:start+4] + data[body_start:body_end] + data[offset-4:offset] )
+   else:
+      txid = sha256d( data[start:offset] )
+
+   tx = {
+      "txid": binascii.hexlify( txid[::-1] ),
+      "hash": binascii.hexlify( sha256d( data[start:offset] )[::-1] ),
+      "version": version,
+      "size": offset - start,
+      "locktime": locktime,
+      "vin": vin,
+      "vout": vout,
+      "nulldata": binascii.hexlify( nulldata_bin ) if nulldata_bin is not None else None,
+      "nulldata_bin": nulldata_bin
+   }
+
+   return (tx, offset)
+
+
+def deserialize_block_header( data, offset=0 ):
+   """
+   Deserialize an 80-byte block header at offset.
+   Return a dict with the header fields (as bitcoind's getblock names them)
+   """
+   if len(data) < offset + 80:
+      raise BlockDeserializeError("Truncated block header at offset %s" % offset)
+
+   header = data[offset:offset+80]
+   version, prev_hash, merkle_root, timestamp, bits, nonce = struct.unpack( "<i32s32sIII", header )
+
+   return {
+      "hash": binascii.hexlify( sha256d( header )[::-1] ),
+      "version": version,
+      "previousblockhash": binascii.hexlify( prev_hash[::-1] ),
+      "merkleroot": binascii.hexlify( merkle_root[::-1] ),
+      "time": timestamp,
+      "bits": "%08x" % bits,
+      "nonce": nonce
+   }
+
+
+def deserialize_block( data, offset=0, network="mainnet" ):
+   """
+   Deserialize a block from data (a string, buffer, or mmap), starting at offset.
+   Return the block in the same form that bitcoind's getblock gives
+   with verbosity 2 (i.e. with decoded transactions in "tx").
+   """
+   block = deserialize_block_header( data, offset )
+   start = offset
+   offset += 80
+
+   try:
+      num_txs, offset = read_varint( data, offset )
+   except (IndexError, struct.error), e:
+      raise BlockDeserializeError("Truncated block at offset %s" % start)
+
+   txs = []
+   for i in xrange(0, num_txs):
+      tx, offset = deserialize_transaction( data, offset, network=network )
+      txs.append( tx )
+
+   block['tx'] = txs
+   block['size'] = offset - start
+   return block
+
+
+def deserialize_block_hex( block_hex, network="mainnet" ):
+   """
+   Deserialize a hex-encoded block (i.e. from getblock verbosity 0).
+   """
+   return deserialize_block( binascii.unhexlify( block_hex ), network=network )
+
+
+def deserialize_transaction_hex( tx_hex, network="mainnet" ):
+   """
+   Deserialize a hex-encoded transaction (i.e. from getrawtransaction with verbose=0).
+   """
+   tx, _ = deserialize_transaction( binascii.unhexlify( tx_hex ), network=network )
+   return tx
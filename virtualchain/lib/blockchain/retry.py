@@ -0,0 +1,557 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+How hard to try to get an answer out of bitcoind.
+
+Every bitcoind query goes through call_bitcoind(), which:
+* retries failed queries with jittered exponential backoff, until the
+query's deadline passes or it runs out of attempts;
+* re-issues ("hedges") a query that is taking much longer than recent
+queries of its kind, and takes whichever answer comes back first;
+* stops querying a bitcoind that keeps failing (i.e. is down, or
+restarting) for a while, instead of hammering it (a circuit breaker).
+
+The breakers, latency histories and hedging threads are process-local.
+"""
+
+import os
+import time
+import types
+import random
+import threading
+import collections
+import Queue
+
+from bitcoinrpc.authproxy import JSONRPCException
+
+from .. import config
+from ..workpool import multiprocess_bitcoind
+
+from .metrics import count_rpc_retry
+
+import metrics
+import session
+log = session.log
+
+# how many recent latencies to keep per kind of query, to pick the hedging delay from
+LATENCY_WINDOW = 256
+
+# don't hedge a kind of query until we've seen this many of them
+MIN_LATENCY_SAMPLES = 20
+
+# most hedging threads to keep around while they're idle
+MAX_IDLE_HEDGE_THREADS = 16
+
+# while a half-open breaker's trial query is in flight, check back this often
+BREAKER_POLL_INTERVAL = 0.1    # seconds
+
+# bitcoind's "still starting up" error code, which means bitcoind is not ready for anything
+RPC_IN_WARMUP = -28
+
+# process-local state:  {"pid": ..., "breakers": {(server, port): CircuitBreaker}, "latencies": {kind: LatencyTracker}, "threads": HedgeThreadPool}
+process_local_retry_state = None
+process_local_retry_state_lock = threading.Lock()
+
+
+class RPCDeadlineExceeded( Exception ):
+   """
+   A bitcoind query did not get an answer before its deadline.
+   """
+   pass
+
+
+class CircuitOpen( Exception ):
+   """
+   bitcoind is down (as far as its circuit breaker is concerned),
+   and will not be queried again before the query's deadline.
+   """
+   pass
+
+
+class CircuitBreaker( object ):
+   """
+   Track whether or not a bitcoind is answering.
+
+   * closed:  queries go through.  After max_failures consecutive
+   failures, the breaker opens.
+   * open:  queries wait, for timeout seconds.  Then the breaker
+   goes half-open.
+   * half-open:  one trial query goes through (the rest wait).  If it
+   succeeds, the breaker closes.  If it fails, the breaker opens again,
+   with twice the timeout (up to max_timeout).
+
+   Only failures to talk to bitcoind count (i.e. errors from the
+   connection, or bitcoind warming up); error responses to a
+   query don't, since bitcoind had to be up to send them.
+   """
+
+   CLOSED = "closed"
+   OPEN = "open"
+   HALF_OPEN = "half-open"
+
+   def __init__( self, name, max_failures, timeout, max_timeout ):
+      self.name = name
+      self.max_failures = max_failures
+      self.base_timeout = timeout
+      self.max_timeout = max_timeout
+      self.lock = threading.Lock()
+
+      self.state = CircuitBreaker.CLOSED
+      self.failures = 0
+      self.timeout = timeout
+      self.opened_at = 0
+      self.trial_in_flight = False
+
+
+   def acquire( self ):
+      """
+      Ask to send a query.
+      Return 0 if it can go ahead, or how long to wait before asking again.
+      """
+      with self.lock:
+
+         if self.max_failures <= 0 or self.state == CircuitBreaker.CLOSED:
+            return 0
+
+         if self.state == CircuitBreaker.OPEN:
+            wait = self.opened_at + self.timeout - time.time()
+            if wait > 0:
+               return wait
+
+            self.state = CircuitBreaker.HALF_OPEN
+            self.trial_in_flight = False
+
+         if self.trial_in_flight:
+            return BREAKER_POLL_INTERVAL
+
+         self.trial_in_flight = True
+         return 0
+
+
+   def record_success( self ):
+      """
+      bitcoind answered a query (even if only with an error).
+      """
+      with self.lock:
+
+         if self.state != CircuitBreaker.CLOSED:
+            log.warning("[%s] bitcoind at %s is answering again" % (os.getpid(), self.name))
+            metrics.count_connection_event( "breaker_closed" )
+
+         self.state = CircuitBreaker.CLOSED
+         self.failures = 0
+         self.timeout = self.base_timeout
+         self.trial_in_flight = False
+
+
+   def record_failure( self ):
+      """
+      bitcoind did not answer a query.
+      """
+      with self.lock:
+
+         self.failures += 1
+
+         if self.state == CircuitBreaker.HALF_OPEN:
+            # still down
+            self.timeout = min( self.timeout * 2, self.max_timeout )
+            self.trial_in_flight = False
+
+         elif self.state == CircuitBreaker.OPEN or self.max_failures <= 0 or self.failures < self.max_failures:
+            return
+
+         log.error("[%s] bitcoind at %s failed %s times in a row; not querying it for %s seconds" % (os.getpid(), self.name, self.failures, self.timeout))
+         metrics.count_connection_event( "breaker_opened" )
+
+         self.state = CircuitBreaker.OPEN
+         self.opened_at = time.time()
+
+
+class LatencyTracker( object ):
+   """
+   Recent latencies of one kind of query, to tell when one is straggling.
+   """
+
+   def __init__( self, window=LATENCY_WINDOW ):
+      self.latencies = collections.deque( maxlen=window )
+      self.lock = threading.Lock()
+      self.sorted_latencies = None
+
+
+   def observe( self, latency ):
+      """
+      Record a successful query's latency.
+      """
+      with self.lock:
+         self.latencies.append( latency )
+         self.sorted_latencies = None
+
+
+   def percentile( self, p ):
+      """
+      Get the pth percentile of the recent latencies.
+      Return None if we haven't seen enough of them yet.
+      """
+      with self.lock:
+
+         if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+
+         if self.sorted_latencies is None:
+            self.sorted_latencies = sorted( self.latencies )
+
+         idx = min( len(self.sorted_latencies) - 1, int(len(self.sorted_latencies) * p / 100.0) )
+         return self.sorted_latencies[idx]
+
+
+class HedgeThreadPool( object ):
+   """
+   Threads to send hedged queries on.  Each thread has its own
+   bitcoind connection (see multiprocess_bitcoind()), so a query that
+   gets abandoned in favor of its hedge can finish on its own time
+   without tying up the caller's connection.
+
+   The pool grows as needed, and threads exit when they finish a job
+   if there are already max_idle idle ones.
+   """
+
+   def __init__( self, max_idle=MAX_IDLE_HEDGE_THREADS ):
+      self.max_idle = max_idle
+      self.jobs = Queue.Queue()
+      self.lock = threading.Lock()
+      self.num_idle = 0
+
+
+   def submit( self, func ):
+      """
+      Run func() on one of the threads.
+      """
+      with self.lock:
+         if self.num_idle > 0:
+            # an idle thread will pick it up
+            self.num_idle -= 1
+
+         else:
+            t = threading.Thread( target=self.run )
+            t.daemon = True
+            t.start()
+
+      self.jobs.put( func )
+
+
+   def run( self ):
+      """
+      Thread main loop.
+      """
+      while True:
+         # NOTE: no timeout, so idle threads don't wake up during interpreter shutdown
+         func = self.jobs.get()
+         func()
+
+         with self.lock:
+            if self.num_idle >= self.max_idle:
+               return
+
+            self.num_idle += 1
+
+
+def get_process_local_retry_state():
+   """
+   Get this process's breakers, latency trackers, and hedging threads.
+   Worker processes get their own (they don't inherit their parent's threads).
+   """
+
+   global process_local_retry_state
+
+   with process_local_retry_state_lock:
+      if process_local_retry_state is None or process_local_retry_state['pid'] != os.getpid():
+         process_local_retry_state = {
+            "pid": os.getpid(),
+            "breakers": {},
+            "latencies": {},
+            "threads": HedgeThreadPool()
+         }
+
+      return process_local_retry_state
+
+
+def get_circuit_breaker( bitcoind_opts ):
+   """
+   Get this process's circuit breaker for the bitcoind the options point to.
+   """
+   state = get_process_local_retry_state()
+
+   server = None
+   port = None
+   if bitcoind_opts is not None:
+      server = bitcoind_opts.get( "bitcoind_server", None )
+      port = bitcoind_opts.get( "bitcoind_port", None )
+
+   max_failures, timeout, max_timeout = config.configure_rpc_breaker( bitcoind_opts )
+
+   with process_local_retry_state_lock:
+      breaker = state['breakers'].get( (server, port), None )
+      if breaker is None or (breaker.max_failures, breaker.base_timeout, breaker.max_timeout) != (max_failures, timeout, max_timeout):
+         breaker = CircuitBreaker( "%s:%s" % (server, port), max_failures, timeout, max_timeout )
+         state['breakers'][(server, port)] = breaker
+
+      return breaker
+
+
+def get_latency_tracker( kind ):
+   """
+   Get this process's latency tracker for a kind of query.
+   """
+   state = get_process_local_retry_state()
+
+   with process_local_retry_state_lock:
+      tracker = state['latencies'].get( kind, None )
+      if tracker is None:
+         tracker = LatencyTracker()
+         state['latencies'][kind] = tracker
+
+      return tracker
+
+
+def is_bitcoind_failure( e ):
+   """
+   Does an exception from a query mean that we couldn't talk to bitcoind
+   (as opposed to bitcoind answering with an error)?
+   """
+   if isinstance( e, JSONRPCException ):
+      return type(e.error) == types.DictType and e.error.get('code', None) == RPC_IN_WARMUP
+
+   return True
+
+
+def get_retry_delay( attempt, base_delay, max_delay ):
+   """
+   How long to wait before the given retry (1 for the first)?
+   Wait a random time up to an exponentially-growing limit, so
+   workers that failed together don't all retry together.
+   """
+   return random.uniform( 0, min( max_delay, base_delay * 2**(attempt - 1) ) )
+
+
+def wait_for_breaker( breaker, deadline ):
+   """
+   Wait until the breaker lets a query through.
+   Raise CircuitOpen if it won't before the deadline.
+   """
+   while True:
+      wait = breaker.acquire()
+      if wait <= 0:
+         return
+
+      if time.time() + wait > deadline:
+         raise CircuitOpen("bitcoind at %s is down" % breaker.name)
+
+      time.sleep( wait )
+
+
+def call_direct( bitcoind, rpc, breaker, latencies ):
+   """
+   Send a query on the caller's own connection.
+   """
+   start = time.time()
+   try:
+      ret = rpc( bitcoind )
+
+   except Exception, e:
+      if is_bitcoind_failure( e ):
+         breaker.record_failure()
+      else:
+         breaker.record_success()
+
+      raise
+
+   breaker.record_success()
+   latencies.observe( time.time() - start )
+   return ret
+
+
+def call_hedged( bitcoind_opts, method, rpc, breaker, latencies, hedge_delay, deadline ):
+   """
+   Send a query on a hedging thread.  If it hasn't been answered
+   after hedge_delay seconds, send it again on another thread.
+   Return the first answer.  If both fail, raise the last failure.
+   Raise RPCDeadlineExceeded if neither is answered by the deadline.
+   """
+   results = Queue.Queue()
+
+   def run():
+      start = time.time()
+      try:
+         ret = rpc( multiprocess_bitcoind( bitcoind_opts ) )
+
+      except Exception, e:
+         if is_bitcoind_failure( e ):
+            breaker.record_failure()
+         else:
+            breaker.record_success()
+
+         results.put( (False, e) )
+
+         # don't reuse this thread's connection
+         try:
+            multiprocess_bitcoind( bitcoind_opts, reset=True )
+         except Exception, e2:
+            log.error("[%s] Failed to reconnect to bitcoind: %s" % (os.getpid(), repr(e2)))
+         return
+
+      breaker.record_success()
+      latencies.observe( time.time() - start )
+      results.put( (True, ret) )
+
+   threads = get_process_local_retry_state()['threads']
+   threads.submit( run )
+   num_sent = 1
+   num_received = 0
+   last_error = None
+   timeout = min( hedge_delay, deadline - time.time() )
+
+   while True:
+      try:
+         success, ret = results.get( timeout=max(timeout, 0) )
+
+      except Queue.Empty:
+         if num_sent == 1 and time.time() < deadline:
+            # straggler.  Hedge it.
+            log.debug("[%s] %s has taken over %.3f seconds; sending it again" % (os.getpid(), method, hedge_delay))
+            metrics.count_rpc_hedge( method )
+            threads.submit( run )
+            num_sent += 1
+            timeout = deadline - time.time()
+            continue
+
+         raise RPCDeadlineExceeded("%s did not finish in time" % method)
+
+      num_received += 1
+      if success:
+         return ret
+
+      last_error = ret
+      if num_received == num_sent:
+         raise last_error
+
+      timeout = deadline - time.time()
+
+
+def call_bitcoind( bitcoind_or_opts, method, rpc, kind=None, give_up=None ):
+   """
+   Query bitcoind, by calling rpc(bitcoind) with a bitcoind client.
+   Retry, hedge and back off as configured (see configure_rpc_retry(),
+   configure_rpc_hedging() and configure_rpc_breaker()).
+
+   bitcoind_or_opts is either a bitcoind client or the options to make
+   one with.  Queries are only hedged if given options, since hedges
+   need connections of their own.  Either way, failed queries are
+   retried on a new connection.
+
+   method is the RPC method, for logging and metrics.  kind says which
+   queries' latencies are comparable (i.e. for deciding when to hedge),
+   and defaults to method.  If given, give_up(exception) says whether
+   or not a failure should be raised right away instead of retried.
+
+   Return rpc()'s result.  Raise its last exception if it failed every
+   time (or failed, and there's no time left to retry), RPCDeadlineExceeded
+   if a hedged query went unanswered past the deadline, or CircuitOpen
+   if bitcoind is down for longer than the deadline allows.
+   """
+
+   if bitcoind_or_opts is None:
+      raise Exception("No bitcoind or opts given")
+
+   if type(bitcoind_or_opts) == types.DictType:
+      bitcoind_opts = bitcoind_or_opts
+      bitcoind = None
+   else:
+      bitcoind_opts = getattr( bitcoind_or_opts, "opts", None )
+      bitcoind = bitcoind_or_opts
+
+   max_attempts, deadline, base_delay, max_delay = config.configure_rpc_retry( bitcoind_opts )
+   hedge_percentile, hedge_min_delay = config.configure_rpc_hedging( bitcoind_opts )
+
+   breaker = get_circuit_breaker( bitcoind_opts )
+   latencies = get_latency_tracker( kind or method )
+
+   deadline = time.time() + deadline
+   exc_to_raise = None
+
+   for attempt in xrange(0, max_attempts):
+
+      if attempt > 0:
+         delay = get_retry_delay( attempt, base_delay, max_delay )
+         if time.time() + delay >= deadline:
+            log.error("[%s] Out of time to retry %s" % (os.getpid(), method))
+            metrics.count_rpc_deadline( method )
+            break
+
+         count_rpc_retry( method )
+         time.sleep( delay )
+
+      try:
+         wait_for_breaker( breaker, deadline )
+
+         hedge_delay = None
+         if hedge_percentile > 0 and bitcoind is None:
+            hedge_delay = latencies.percentile( hedge_percentile )
+
+         if hedge_delay is not None:
+            return call_hedged( bitcoind_opts, method, rpc, breaker, latencies, max(hedge_delay, hedge_min_delay), deadline )
+
+         if bitcoind is None:
+            bitcoind = multiprocess_bitcoind( bitcoind_opts )
+
+         return call_direct( bitcoind, rpc, breaker, latencies )
+
+      except (RPCDeadlineExceeded, CircuitOpen), e:
+         log.error("[%s] Giving up on %s: %s" % (os.getpid(), method, e))
+         metrics.count_rpc_deadline( method )
+         raise
+
+      except JSONRPCException, je:
+         if give_up is not None and give_up( je ):
+            raise
+
+         log.error("\n\n[%s] Caught JSONRPCException from bitcoind %s: %s\n" % (os.getpid(), method, repr(je.error)))
+         exc_to_raise = je
+
+      except Exception, e:
+         if give_up is not None and give_up( e ):
+            raise
+
+         log.error("\n\n[%s] Caught Exception from bitcoind %s: %s" % (os.getpid(), method, repr(e)))
+         exc_to_raise = e
+
+      if bitcoind_opts is not None:
+         bitcoind = multiprocess_bitcoind( bitcoind_opts, reset=True )
+
+   if exc_to_raise is not None:
+      # tried as many times as we dared, so bail
+      raise exc_to_raise
+
+   else:
+      raise Exception("Failed after %s attempts" % max_attempts)
+
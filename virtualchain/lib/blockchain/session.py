@@ -37,8 +37,12 @@ import ssl
 import threading
 import time
 import socket
+import base64
+import decimal
+import select
+import Queue
 
-from ..config import DEBUG
+from ..config import DEBUG, configure_rpc_connection_lifecycle
 from utilitybelt import is_valid_int
 from ConfigParser import SafeConfigParser
 
@@ -63,7 +67,77 @@ if not globals().has_key('log'):
     console.setFormatter(formatter)
     log.addHandler(console)
 
-from bitcoinrpc.authproxy import AuthServiceProxy
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException, HTTP_TIMEOUT
+
+import metrics
+
+# this process's bitcoind connection counters
+connection_stats = {
+   "created": 0,           # new connections
+   "reused": 0,            # times an existing connection was used again
+   "probed": 0,            # times an idle connection was checked before reuse
+   "probe_failures": 0,    # idle connections that turned out to be dead
+   "expired": 0,           # connections replaced for being idle too long
+   "reset": 0              # connections replaced after an error
+}
+connection_stats_lock = threading.Lock()
+
+
+def count_connection_event( event, count=1 ):
+   """
+   Update one of this process's bitcoind connection counters
+   (and the fetch metrics, which are totalled over all processes).
+   """
+   with connection_stats_lock:
+      connection_stats[event] += count
+      
+   metrics.count_connection_event( event, count )
+
+
+def get_connection_stats():
+   """
+   Get a copy of this process's bitcoind connection counters.
+   """
+   with connection_stats_lock:
+      return dict(connection_stats)
+
+
+def connection_is_alive( conn ):
+   """
+   Cheaply check whether or not an idle HTTP(S) connection 
+   can be reused, without sending anything over it.
+   An idle keep-alive connection should have nothing to read;
+   if it is readable, then the server has closed it.
+   """
+   sock = getattr( conn, "sock", None )
+   if sock is None:
+      # not connected; it will connect on demand
+      return True
+   
+   try:
+      readable, _, _ = select.select( [sock], [], [], 0 )
+   except (select.error, socket.error, ValueError):
+      return False
+   
+   return len(readable) == 0
+
+
+def bitcoind_is_alive( bitcoind ):
+   """
+   Check whether or not an idle bitcoind client can be reused.
+   If we know its connection, check the socket.  Otherwise,
+   send it a cheap RPC.
+   """
+   conn = getattr( bitcoind, "__dict__", {} ).get( "connection", None )
+   if conn is not None:
+      return connection_is_alive( conn )
+   
+   try:
+      bitcoind.getblockcount()
+      return True
+   except Exception, e:
+      log.debug("bitcoind probe failed: %s" % e)
+      return False
 
 class BitcoindConnection( httplib.HTTPSConnection ):
    """
@@ -85,6 +159,243 @@ class BitcoindConnection( httplib.HTTPSConnection ):
       self.sock = ssl.wrap_socket( sock, cert_reqs=ssl.CERT_NONE )
       
 
+def make_http_connection( server, port, use_https, timeout ):
+   """
+   Make a (not yet connected) HTTP(S) connection to bitcoind.
+   The bytes received over it are counted in the fetch metrics.
+   """
+   if use_https:
+      if do_wrap_socket:
+         conn = BitcoindConnection( server, int(port), timeout=timeout )
+      
+      elif create_ssl_authproxy:
+         conn = httplib.HTTPSConnection( server, int(port), timeout=timeout )
+      
+      else:
+         ssl_ctx = ssl.create_default_context()
+         ssl_ctx.check_hostname = False
+         ssl_ctx.verify_mode = ssl.CERT_NONE
+         conn = httplib.HTTPSConnection( server, int(port), context=ssl_ctx, timeout=timeout )
+      
+   else:
+      conn = httplib.HTTPConnection( server, int(port), timeout=timeout )
+      
+   return metrics.meter_http_connection( conn )
+
+
+# keep-alive connection to bitcoind's REST interface, for this thread
+thread_local_rest = threading.local()
+
+def bitcoind_rest_get( bitcoind_opts, path ):
+   """
+   GET a resource from bitcoind's REST interface (which is only
+   available if bitcoind was started with -rest).
+   
+   Return the response body on success.
+   Return None if bitcoind would not serve it.
+   Raise an exception on network error.
+   """
+   conn = getattr( thread_local_rest, "conn", None )
+   if conn is not None and not connection_is_alive( conn ):
+      count_connection_event( "probe_failures" )
+      conn.close()
+      conn = None
+   
+   if conn is None:
+      conn = make_http_connection( bitcoind_opts['bitcoind_server'], bitcoind_opts['bitcoind_port'], bitcoind_opts['bitcoind_use_https'], HTTP_TIMEOUT )
+      thread_local_rest.conn = conn
+      count_connection_event( "created" )
+      
+   else:
+      count_connection_event( "reused" )
+   
+   start_time = metrics.rpc_started( "rest" )
+   
+   try:
+      conn.request( 'GET', path, None, {'Host': bitcoind_opts['bitcoind_server'], 'User-Agent': 'virtualchain'} )
+      response = conn.getresponse()
+      body = response.read()
+      
+   except (httplib.HTTPException, socket.error), e:
+      metrics.rpc_finished( "rest", start_time, False )
+      conn.close()
+      thread_local_rest.conn = None
+      raise
+   
+   metrics.rpc_finished( "rest", start_time, response.status == 200 )
+   
+   if response.status != 200:
+      log.debug("bitcoind REST %s: HTTP %s" % (path, response.status))
+      return None
+   
+   return body
+
+
+class BitcoindRPCPool( object ):
+   """
+   Thread-safe bitcoind JSON-RPC client that keeps a pool of 
+   persistent (keep-alive) HTTP(S) connections, so many threads
+   can have RPCs in flight at once without reconnecting for each one.
+
+   At most max_connections RPCs are in flight at a time; callers
+   beyond that wait for a connection to free up.
+
+   Call RPCs like you would with an AuthServiceProxy, e.g. 
+   pool.getblockhash(123), or pool._batch([...]).
+   """
+   
+   def __init__( self, rpc_username, rpc_password, server, port, use_https, max_connections, timeout=300, probe_interval=None, idle_timeout=None ):
+      self.server = server 
+      self.port = int(port)
+      self.use_https = use_https 
+      self.timeout = timeout
+      self.max_connections = max(1, max_connections)
+      self.probe_interval = probe_interval      # check connections idle longer than this before reusing them (None to never check)
+      self.idle_timeout = idle_timeout          # replace connections idle longer than this (None to keep them forever)
+      self.auth_header = "Basic " + base64.b64encode( "%s:%s" % (rpc_username, rpc_password) )
+      
+      self.idle_connections = Queue.LifoQueue()     # (connection, time last used), most-recently-used first, so idle ones age out
+      self.slots = threading.BoundedSemaphore( self.max_connections )
+      self.id_lock = threading.Lock()
+      self.id_count = 0
+      
+      
+   def __getattr__( self, name ):
+      if name.startswith('__') and name.endswith('__'):
+         # Python internal stuff
+         raise AttributeError
+      
+      def rpc( *args ):
+         return self._call( name, args )
+      
+      return rpc 
+      
+      
+   def new_connection( self ):
+      """
+      Make a new connection to bitcoind.
+      """
+      return make_http_connection( self.server, self.port, self.use_https, self.timeout )
+         
+         
+   def get_idle_connection( self ):
+      """
+      Get an idle connection that is fit for reuse.
+      Close the ones that have been idle too long, or that are dead.
+      Return None if there are none left.
+      """
+      while True:
+         try:
+            conn, last_used = self.idle_connections.get_nowait()
+         except Queue.Empty:
+            return None
+         
+         idle_time = time.time() - last_used
+         
+         if self.idle_timeout is not None and idle_time > self.idle_timeout:
+            count_connection_event( "expired" )
+            conn.close()
+            continue
+         
+         if self.probe_interval is not None and idle_time > self.probe_interval:
+            count_connection_event( "probed" )
+            if not connection_is_alive( conn ):
+               count_connection_event( "probe_failures" )
+               conn.close()
+               continue
+            
+         return conn
+      
+      
+   def post( self, postdata ):
+      """
+      POST a JSON-RPC request to bitcoind over a pooled connection,
+      and return the decoded response.
+      """
+      self.slots.acquire()
+      try:
+         
+         conn = self.get_idle_connection()
+         reused = True
+         if conn is None:
+            conn = self.new_connection()
+            count_connection_event( "created" )
+            reused = False
+            
+         else:
+            count_connection_event( "reused" )
+         
+         while True:
+            try:
+               conn.request( 'POST', '/', postdata, {'Host': self.server,
+                                                     'User-Agent': 'virtualchain',
+                                                     'Authorization': self.auth_header,
+                                                     'Content-type': 'application/json'} )
+               
+               http_response = conn.getresponse()
+               response_data = http_response.read()
+               break
+            
+            except (httplib.HTTPException, socket.error), e:
+               conn.close()
+               if not reused:
+                  raise
+               
+               # bitcoind closed this idle connection on us.  try again with a fresh one.
+               count_connection_event( "reset" )
+               count_connection_event( "created" )
+               conn = self.new_connection()
+               reused = False
+               
+         self.idle_connections.put( (conn, time.time()) )
+         
+      finally:
+         self.slots.release()
+         
+      return json.loads( response_data.decode('utf8'), parse_float=decimal.Decimal )
+      
+      
+   def _call( self, method, params ):
+      """
+      Send one RPC, and return its result.
+      Raise JSONRPCException on error.
+      """
+      with self.id_lock:
+         self.id_count += 1
+         rpc_id = self.id_count
+         
+      response = self.post( json.dumps({'version': '1.1', 'method': method, 'params': params, 'id': rpc_id}) )
+      
+      if response.get('error', None) is not None:
+         raise JSONRPCException( response['error'] )
+      
+      elif 'result' not in response:
+         raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+      
+      return response['result']
+   
+   
+   def _batch( self, rpc_call_list ):
+      """
+      Send a batch of RPCs (a list of JSON-RPC request dicts),
+      and return the list of JSON-RPC responses.
+      """
+      return self.post( json.dumps( list(rpc_call_list) ) )
+   
+   
+   def reset( self ):
+      """
+      Close all idle connections.
+      """
+      while True:
+         try:
+            conn, _ = self.idle_connections.get_nowait()
+         except Queue.Empty:
+            break
+         
+         conn.close()
+      
+
 def create_bitcoind_connection( rpc_username, rpc_password, server, port, use_https ):
     """
     Creates an RPC client to a bitcoind instance.
@@ -113,7 +424,8 @@ def create_bitcoind_connection( rpc_username, rpc_password, server, port, use_ht
            
         elif create_ssl_authproxy:
            # ssl has _create_unverified_context, so we're good to go 
-           ret = AuthServiceProxy(authproxy_config_uri, timeout=300)
+           connection = httplib.HTTPSConnection( server, int(port), timeout=300 )
+           ret = AuthServiceProxy(authproxy_config_uri, connection=connection)
         
         else:
            # have to set up an unverified context ourselves 
@@ -124,8 +436,15 @@ def create_bitcoind_connection( rpc_username, rpc_password, server, port, use_ht
            ret = AuthServiceProxy(authproxy_config_uri, connection=connection)
           
     else:
-        ret = AuthServiceProxy(authproxy_config_uri)
+        connection = httplib.HTTPConnection( server, int(port), timeout=HTTP_TIMEOUT )
+        ret = AuthServiceProxy(authproxy_config_uri, connection=connection)
 
+    # remember the connection, so we can check on it when it's idle
+    setattr( ret, "connection", connection )
+    
+    # count what we receive over it
+    metrics.meter_http_connection( connection )
+    
     # remember the options 
     bitcoind_opts = {
        "bitcoind_user": rpc_username,
@@ -139,6 +458,28 @@ def create_bitcoind_connection( rpc_username, rpc_password, server, port, use_ht
     return ret
 
 
+def create_bitcoind_rpc_pool( bitcoind_opts, max_connections ):
+    """
+    Create a pooled, thread-safe RPC client to a bitcoind instance,
+    using a dict of config options.
+    It will have ".opts" defined as a member, just like connect_bitcoind().
+    """
+    
+    log.debug("[%s] Pool up to %s connections to bitcoind at %s://%s@%s:%s" % (os.getpid(), max_connections, 'https' if bitcoind_opts['bitcoind_use_https'] else 'http', bitcoind_opts['bitcoind_user'], bitcoind_opts['bitcoind_server'], bitcoind_opts['bitcoind_port']) )
+    
+    if not bitcoind_opts['bitcoind_server'] or len(bitcoind_opts['bitcoind_server']) < 1:
+        raise Exception('Invalid bitcoind host address.')
+    if not bitcoind_opts['bitcoind_port'] or not is_valid_int(bitcoind_opts['bitcoind_port']):
+        raise Exception('Invalid bitcoind port number.')
+    
+    probe_interval, idle_timeout = configure_rpc_connection_lifecycle( bitcoind_opts )
+    ret = BitcoindRPCPool( bitcoind_opts['bitcoind_user'], bitcoind_opts['bitcoind_passwd'], bitcoind_opts['bitcoind_server'], bitcoind_opts['bitcoind_port'], bitcoind_opts['bitcoind_use_https'], max_connections,
+                           probe_interval=probe_interval, idle_timeout=idle_timeout )
+    
+    setattr( ret, "opts", dict(bitcoind_opts) )
+    return ret
+
+
 def connect_bitcoind( bitcoind_opts ):
     """
     Create a connection to bitcoind, using a dict of config options.
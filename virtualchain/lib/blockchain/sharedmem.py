@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Handing fetched transactions from pool workers back to the indexing
+process through shared memory, instead of pickling them through the
+pool's pipe (which the indexing process then has to unpickle, all of
+it, on its one thread).
+
+A worker writes a list of transactions into a segment:  a file in a
+memory-backed directory (i.e. /dev/shm), written through mmap.  Only
+a small SharedTxs descriptor goes back through the pool.  The indexing
+process maps the segment, unlinks it, and decodes each transaction
+only if and when it is asked for:
+
+* transactions with nulldata (the ones the state engine parses) are
+  stored whole, so they come back exactly as the worker had them;
+* all others are stored compactly, as their inputs' outpoints and their
+  outputs (see encode_compact_tx()), which is all that sender lookups and
+  the prevout index need from them.  Most of them are never decoded.
+"""
+
+import os
+import glob
+import mmap
+import types
+import struct
+import atexit
+import marshal
+import cPickle
+import binascii
+import tempfile
+
+from .nulldata import has_nulldata
+from .txrecord import compact_inputs, expand_inputs, compact_outputs, expand_outputs
+
+import session
+log = session.log
+
+SEGMENT_PREFIX = "virtualchain-txs-"
+SEGMENT_MAGIC = "VCTX"
+SEGMENT_VERSION = 1
+
+# magic, version, number of transactions
+SEGMENT_HEADER = struct.Struct( "<4sHI" )
+
+# per transaction:  txid (little-endian bytes), flags, offset, length
+SEGMENT_INDEX_ENTRY = struct.Struct( "<32sBII" )
+
+TX_PRESENT = 0x01       # not None
+TX_NULLDATA = 0x02      # has nulldata
+TX_WHOLE = 0x04         # pickled whole, instead of compactly
+
+# {(pid, segment directory)} that we remove leftover segments from at exit
+cleanup_registered = set()
+
+
+class SharedTxs( object ):
+   """
+   Descriptor of a segment of transactions, as handed back by a worker.
+   """
+
+   def __init__( self, path, count, size ):
+      self.path = path
+      self.count = count
+      self.size = size
+
+
+   def __len__( self ):
+      return self.count
+
+
+   def load( self ):
+      """
+      Map the segment, and remove it from the file system.
+      Can only be called once.
+      """
+      return SharedTxList( self )
+
+
+class SharedTxList( object ):
+   """
+   Read-only list of the transactions in a segment, which decodes
+   each one the first time it is asked for.
+   """
+
+   def __init__( self, shared_txs ):
+      fd = os.open( shared_txs.path, os.O_RDONLY )
+      try:
+         self.mm = mmap.mmap( fd, shared_txs.size, access=mmap.ACCESS_READ )
+      finally:
+         os.close( fd )
+         os.unlink( shared_txs.path )
+
+      magic, version, count = SEGMENT_HEADER.unpack_from( self.mm, 0 )
+      if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION or count != shared_txs.count:
+         raise Exception("Invalid transaction segment %s" % shared_txs.path)
+
+      self.count = count
+      self.decoded = {}
+
+
+   def __len__( self ):
+      return self.count
+
+
+   def get_entry( self, i ):
+      if i < 0 or i >= self.count:
+         raise IndexError("Transaction index %s out of range" % i)
+
+      return SEGMENT_INDEX_ENTRY.unpack_from( self.mm, SEGMENT_HEADER.size + i * SEGMENT_INDEX_ENTRY.size )
+
+
+   def get_txid( self, i ):
+      """
+      Get the ith transaction's txid, without decoding it.
+      Return None if there is no ith transaction.
+      """
+      txid_bin, flags, _, _ = self.get_entry( i )
+      if not (flags & TX_PRESENT):
+         return None
+
+      if flags & TX_WHOLE:
+         return self[i].get('txid', None)
+
+      return binascii.hexlify( txid_bin[::-1] )
+
+
+   def has_nulldata( self, i ):
+      """
+      Does the ith transaction have nulldata?  (Does not decode it).
+      """
+      _, flags, _, _ = self.get_entry( i )
+      return (flags & TX_NULLDATA) != 0
+
+
+   def get_outputs( self, i ):
+      """
+      Get the ith transaction's outputs.
+      """
+      return self[i]['vout']
+
+
+   def __getitem__( self, i ):
+      if self.decoded.has_key( i ):
+         return self.decoded[i]
+
+      txid_bin, flags, offset, length = self.get_entry( i )
+      if not (flags & TX_PRESENT):
+         return None
+
+      data = self.mm[offset:offset+length]
+      if flags & TX_WHOLE:
+         tx = cPickle.loads( data )
+      else:
+         tx = decode_compact_tx( binascii.hexlify( txid_bin[::-1] ), data )
+
+      # callers annotate transactions in place, so always hand back the same one
+      self.decoded[i] = tx
+      return tx
+
+
+   def __iter__( self ):
+      for i in xrange(0, self.count):
+         yield self[i]
+
+
+class SharedOutputs( dict ):
+   """
+   {txid: outputs}, where the outputs of transactions in a SharedTxList
+   (or given compactly) are only decoded when they are looked up.
+   """
+
+   def put_shared( self, txid, shared_tx_list, i ):
+      dict.__setitem__( self, txid, SharedOutputsRef( shared_tx_list, i ) )
+
+
+   def put_compact( self, txid, outputs ):
+      """
+      Add a transaction's outputs, as encoded by compact_outputs().
+      """
+      dict.__setitem__( self, txid, outputs )
+
+
+   def __getitem__( self, txid ):
+      outputs = dict.__getitem__( self, txid )
+      if isinstance( outputs, SharedOutputsRef ):
+         outputs = outputs.shared_tx_list.get_outputs( outputs.index )
+         dict.__setitem__( self, txid, outputs )
+
+      elif type(outputs) == types.TupleType:
+         outputs = expand_outputs( outputs )
+         dict.__setitem__( self, txid, outputs )
+
+      return outputs
+
+
+   def get( self, txid, default=None ):
+      if not self.has_key( txid ):
+         return default
+
+      return self[txid]
+
+
+class SharedOutputsRef( object ):
+   """
+   Where to find a transaction's not-yet-decoded outputs.
+   """
+
+   def __init__( self, shared_tx_list, index ):
+      self.shared_tx_list = shared_tx_list
+      self.index = index
+
+
+def encode_compact_tx( tx ):
+   """
+   Encode what sender lookups and the prevout index need from a
+   transaction that has no nulldata:  the outpoints its inputs spend,
+   and its outputs' values (in satoshis), numbers, scripts, script
+   types, and addresses.
+   """
+   return marshal.dumps( (compact_inputs( tx.get('vin', []) ), compact_outputs( tx.get('vout', []) )) )
+
+
+def decode_compact_tx( txid, data ):
+   """
+   Decode a transaction encoded with encode_compact_tx(), in
+   the form bitcoind gives (but with only the encoded fields).
+   """
+   vin, vout = marshal.loads( data )
+   return {"txid": txid, "vin": expand_inputs( vin ), "vout": expand_outputs( vout )}
+
+
+def share_txs( txs, shm_dir, reader_pid ):
+   """
+   Write a list of transactions (from bitcoind, or decoded from raw
+   ones; some may be None) to a new segment in shm_dir, for process
+   reader_pid to read.  Meant to be called in a pool worker.
+   Return its SharedTxs descriptor.
+   """
+   entries = []
+   blobs = []
+
+   for tx in txs:
+      if tx is None:
+         entries.append( ("", 0) )
+         blobs.append( "" )
+         continue
+
+      flags = TX_PRESENT
+      txid_bin = ""
+
+      if has_nulldata( tx ):
+         flags |= TX_NULLDATA
+
+      if (flags & TX_NULLDATA) or 'txid' not in tx:
+         flags |= TX_WHOLE
+         blob = cPickle.dumps( tx, cPickle.HIGHEST_PROTOCOL )
+      else:
+         txid_bin = binascii.unhexlify( tx['txid'] )[::-1]
+         blob = encode_compact_tx( tx )
+
+      entries.append( (txid_bin, flags) )
+      blobs.append( blob )
+
+   offset = SEGMENT_HEADER.size + len(entries) * SEGMENT_INDEX_ENTRY.size
+   size = offset + sum( [len(blob) for blob in blobs] )
+
+   # the segment is named after the process that will read it, so it can clean up after us
+   fd, path = tempfile.mkstemp( prefix="%s%s-" % (SEGMENT_PREFIX, reader_pid), dir=shm_dir )
+   try:
+      os.ftruncate( fd, size )
+      mm = mmap.mmap( fd, size )
+
+      SEGMENT_HEADER.pack_into( mm, 0, SEGMENT_MAGIC, SEGMENT_VERSION, len(entries) )
+      for i in xrange(0, len(entries)):
+         txid_bin, flags = entries[i]
+         SEGMENT_INDEX_ENTRY.pack_into( mm, SEGMENT_HEADER.size + i * SEGMENT_INDEX_ENTRY.size, txid_bin, flags, offset, len(blobs[i]) )
+
+         mm[offset:offset+len(blobs[i])] = blobs[i]
+         offset += len(blobs[i])
+
+      mm.close()
+
+   except:
+      os.unlink( path )
+      raise
+
+   finally:
+      os.close( fd )
+
+   return SharedTxs( path, len(entries), size )
+
+
+def remove_shared_segments( shm_dir, pid=None ):
+   """
+   Remove the segments meant for process pid (this one by default)
+   that it never read (i.e. because a fetch failed part-way through).
+   Return the number removed.
+   """
+   if pid is None:
+      pid = os.getpid()
+
+   count = 0
+   for path in glob.glob( os.path.join( shm_dir, "%s%s-*" % (SEGMENT_PREFIX, pid) ) ):
+      try:
+         os.unlink( path )
+         count += 1
+      except OSError:
+         pass
+
+   if count > 0:
+      log.debug("Removed %s unread transaction segments from %s" % (count, shm_dir))
+
+   return count
+
+
+def register_shared_segment_cleanup( shm_dir ):
+   """
+   Remove this process's unread segments in shm_dir when it exits.
+   """
+   key = (os.getpid(), shm_dir)
+   if key in cleanup_registered:
+      return
+
+   cleanup_registered.add( key )
+   atexit.register( remove_shared_segments, shm_dir, os.getpid() )
@@ -21,23 +21,45 @@
     along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from .nulldata import get_nulldata, has_nulldata
+from .nulldata import get_nulldata, has_nulldata, is_virtualchain_nulldata
 import traceback
 
-from ..config import DEBUG, MULTIPROCESS_RPC_RETRY
-from ..workpool import multiprocess_bitcoind, multiprocess_batch_size
+from ..config import DEBUG, PREVOUT_INDEX_PRUNE_DEPTH, RPC_POOL_SIZE, configure_multiprocessing, configure_rpc_batching, configure_getblock_verbosity, configure_rpc_pool, \
+   configure_raw_blocks, configure_result_transfer, configure_worker_filtering, configure_compact_tx_records, configure_fetch_budget
+from ..workpool import multiprocess_bitcoind, multiprocess_batch_size, CompletionQueue, CompletionQueueStopped
+from ..tuning import get_concurrency_controller, SliceBudget
 
 import logging
 import os
 import time
 import types
-import random
+import binascii
 
 from bitcoinrpc.authproxy import JSONRPCException
 
 import session 
 log = session.log 
 
+from .session import get_connection_stats, bitcoind_rest_get
+from .rawblock import deserialize_block, deserialize_transaction_hex
+from .blockfiles import get_block_file_index, getblock_from_file
+from .metrics import count_rpc_retry, record_fetch_slice, unwrap_bitcoind
+from .retry import call_bitcoind
+
+from .cache import get_rpc_cache, get_sender_cache
+from .prevouts import get_prevout_index
+from .sharedmem import SharedTxs, SharedTxList, SharedOutputs, share_txs, register_shared_segment_cleanup
+from .txrecord import NulldataTx, FilteredTxs, filter_nulldata_txs, get_tx_size
+
+# highest getblock verbosity this process's bitcoind supports (None if we haven't found out yet)
+getblock_max_verbosity = None
+
+# whether or not this process's bitcoind serves raw blocks over REST (None if we haven't found out yet)
+bitcoind_rest_supported = None
+
+# whether or not this process's bitcoind accepts JSON-RPC batches (None if we haven't found out yet)
+bitcoind_batch_supported = None
+
 def get_bitcoind( bitcoind_or_opts ):
    """
    Given either a bitcoind API endpoint proxy, 
@@ -75,48 +97,21 @@ def getrawtransaction( bitcoind_or_opts, txid, verbose=0 ):
    Only call out to bitcoind if we need to.
    """
    
-   exc_to_raise = None
-   bitcoind = get_bitcoind( bitcoind_or_opts )
-   
    if bitcoind_or_opts is None:
        raise Exception("No bitcoind or opts given")
    
-   for i in xrange(0, MULTIPROCESS_RPC_RETRY):
-      try:
-         
-         try:
-            
-            tx = bitcoind.getrawtransaction( txid, verbose )
-            
-         except JSONRPCException, je:
-            log.error("\n\n[%s] Caught JSONRPCException from bitcoind: %s\n" % (os.getpid(), repr(je.error)))
-            exc_to_raise = je
-            
-            new_opts = get_bitcoind_opts( bitcoind_or_opts )
-            bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-            continue
-
-         except Exception, e:
-            log.error("\n\n[%s] Caught Exception from bitcoind: %s" % (os.getpid(), repr(e)))
-            exc_to_raise = e
-        
-            new_opts = get_bitcoind_opts( bitcoind_or_opts )
-            bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-            continue 
-            
-         return tx 
-      
-      except Exception, e:
-         log.exception(e)
-         exc_to_raise = e 
-         continue
-
-   if exc_to_raise is not None:
-      # tried as many times as we dared, so bail 
-      raise exc_to_raise
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      tx = rpc_cache.get_transaction( txid, verbose )
+      if tx is not None:
+         return tx
    
-   else:
-      raise Exception("Failed after %s attempts" % MULTIPROCESS_RPC_RETRY)
+   tx = call_bitcoind( bitcoind_or_opts, "getrawtransaction", lambda bitcoind: bitcoind.getrawtransaction( txid, verbose ) )
+   
+   if rpc_cache is not None:
+      rpc_cache.put_transaction( txid, verbose, tx )
+      
+   return tx 
 
 
 def getrawtransaction_async( workpool, bitcoind_opts, tx_hash, verbose ):
@@ -135,53 +130,20 @@ def getblockhash( bitcoind_or_opts, block_number, reset ):
    Return None if there are no options
    """
    
-   exc_to_raise = None  # exception to raise if we fail
-   bitcoind = get_bitcoind( bitcoind_or_opts )
-   
    if bitcoind_or_opts is None:
        raise Exception("No bitcoind or opts given")
        
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      block_hash = rpc_cache.get_block_hash( block_number )
+      if block_hash is not None:
+         return block_hash
+       
    if reset:
        new_opts = get_bitcoind_opts( bitcoind_or_opts )
-       bitcoind = multiprocess_bitcoind( new_opts, reset=True )
-   
-   for i in xrange(0, MULTIPROCESS_RPC_RETRY):
-      try:
-         
-         try:
-         
-            block_hash = bitcoind.getblockhash( block_number )
-         except JSONRPCException, je:
-            log.error("\n\n[%s] Caught JSONRPCException from bitcoind: %s\n" % (os.getpid(), repr(je.error)))
-            exc_to_raise = je 
-        
-            new_opts = get_bitcoind_opts( bitcoind_or_opts )
-            bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-            continue
-         
-         except Exception, e:
-            log.error("\n\n[%s] Caught Exception from bitcoind: %s" % (os.getpid(), repr(e)))
-            exc_to_raise = e
-            
-            new_opts = get_bitcoind_opts( bitcoind_or_opts )
-            if new_opts is None:
-                raise Exception("No bitcoind or opts given")
-            
-            bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-            continue 
-         
-         return block_hash
-      
-      except Exception, e:
-         log.exception(e)
-         exc_to_raise = e
-         continue
+       multiprocess_bitcoind( new_opts, reset=True )
    
-   if exc_to_raise is not None:
-      raise exc_to_raise
-   
-   else:
-      raise Exception("Failed after %s attempts" % MULTIPROCESS_RPC_RETRY)
+   return call_bitcoind( bitcoind_or_opts, "getblockhash", lambda bitcoind: bitcoind.getblockhash( block_number ) )
    
 
 def getblockhash_async( workpool, bitcoind_opts, block_number, reset=False ):
@@ -196,57 +158,30 @@ def getblockhash_async( workpool, bitcoind_opts, block_number, reset=False ):
    return block_hash_future
 
 
-def getblock( bitcoind_or_opts, block_hash ):
+def getblock( bitcoind_or_opts, block_hash, verbosity=1 ):
    """
    Get a block's data, given its hash.
    """
    if bitcoind_or_opts is None:
        raise Exception("No bitcoind or opts given")
     
-   exc_to_raise = None
-   bitcoind = get_bitcoind( bitcoind_or_opts )
-   attempts = 0
-   
-   for i in xrange(0, MULTIPROCESS_RPC_RETRY):
-      
-      try:
-         block_data = bitcoind.getblock( block_hash )
-         
-      except JSONRPCException, je:
-         log.error("\n\n[%s] Caught JSONRPCException from bitcoind: %s\n" % (os.getpid(), repr(je.error)))
-         exc_to_raise = je
-     
-         attempts += 1
-         
-         # probably a transient bitcoind failure
-         # exponential backof with jitter
-         time.sleep(2**attempts + random.randint( 0, 2**(attempts - 1)) )
-         
-         new_opts = get_bitcoind_opts( bitcoind_or_opts )
-         bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-         continue
-     
-      except Exception, e:
-         log.error("\n\n[%s] Caught Exception from bitcoind: %s" % (os.getpid(), repr(e)))
-         exc_to_raise = e
-     
-         attempts += 1
-         
-         # probably a transient network failure
-         # exponential backoff with jitter
-         time.sleep(2**attempts + random.randint( 0, 2**(attempts - 1)) )
-         
-         new_opts = get_bitcoind_opts( bitcoind_or_opts )
-         bitcoind = multiprocess_bitcoind( new_opts, reset=True)
-         continue
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      block_data = rpc_cache.get_block( block_hash, verbosity )
+      if block_data is not None:
+         return block_data
+    
+   if verbosity == 1:
+      rpc = lambda bitcoind: bitcoind.getblock( block_hash )
+   else:
+      rpc = lambda bitcoind: bitcoind.getblock( block_hash, verbosity )
+
+   block_data = call_bitcoind( bitcoind_or_opts, "getblock", rpc, kind="getblock/%s" % verbosity )
    
-      return block_data 
+   if rpc_cache is not None:
+      rpc_cache.put_block( block_hash, verbosity, block_data )
       
-   if exc_to_raise is not None:
-      raise exc_to_raise
-   
-   else:
-      raise Exception("Failed after %s attempts" % MULTIPROCESS_RPC_RETRY)
+   return block_data 
    
 
 
@@ -256,24 +191,389 @@ def getblock_async( workpool, bitcoind_opts, block_hash ):
    Return a future to the data.
    """
    block_future = workpool.apply_async( getblock, (bitcoind_opts, block_hash) )
-   return block_future 
+   return block_future
 
 
-def get_sender_and_amount_in_from_txn( tx, output_index ):
+def is_getblock_verbosity_unsupported( rpc_error ):
    """
-   Given a transaction, get information about the sender 
-   and the money paid.
-   
-   Return a sender (a dict with a script_pubkey, amount, and list of addresses
-   within the script_pubkey), and the amount paid.
+   Does a getblock error from bitcoind mean that it did not understand the verbosity we asked for?
+   (Older versions of bitcoind only accept a boolean "verbose" argument).
+
+   RPC_MISC_ERROR (-1) does not count:  bitcoind also uses it for blocks
+   it can't serve (i.e. "Block not available (pruned data)").
    """
-   
-   # grab the previous tx output (the current input)
+   if type(rpc_error) != types.DictType:
+      return False
+
+   code = rpc_error.get('code', None)
+
+   # RPC_TYPE_ERROR:  the verbosity was not a boolean
+   if code == -3:
+      return True
+
+   # RPC_INVALID_PARAMETER:  only if it's the verbosity that was invalid
+   if code == -8:
+      return 'verbos' in str(rpc_error.get('message', '')).lower()
+
+   return False
+
+
+def getblock_txs( bitcoind_or_opts, block_hash, verbosity ):
+   """
+   Get a block's data, given its hash, along with its decoded
+   transactions (i.e. with getblock verbosity 2 or higher), so the 
+   transactions don't have to be fetched one at a time.
+
+   If bitcoind does not support the given verbosity, then fall 
+   back to lower verbosities until it does.  The caller can tell 
+   which one it got by checking whether or not the block's "tx" 
+   list contains dicts (decoded transactions) or txids.
+   """
+
+   global getblock_max_verbosity
+
+   if bitcoind_or_opts is None:
+       raise Exception("No bitcoind or opts given")
+
+   if verbosity == 0:
+      # decode it ourselves
+      return getblock_deserialized( bitcoind_or_opts, block_hash )
+
+   if getblock_max_verbosity is not None:
+      verbosity = min( verbosity, getblock_max_verbosity )
+
+   if verbosity <= 1:
+      return getblock( bitcoind_or_opts, block_hash )
+
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      block_data = rpc_cache.get_block( block_hash, verbosity )
+      if block_data is not None:
+         return block_data
+
    try:
-      prev_tx_output = tx['vout'][output_index]
+      rpc = lambda bitcoind: bitcoind.getblock( block_hash, verbosity )
+      give_up = lambda e: isinstance( e, JSONRPCException ) and is_getblock_verbosity_unsupported( e.error )
+      block_data = call_bitcoind( bitcoind_or_opts, "getblock", rpc, kind="getblock/%s" % verbosity, give_up=give_up )
+
+   except JSONRPCException, je:
+      if not is_getblock_verbosity_unsupported( je.error ):
+         raise
+
+      log.warning("[%s] bitcoind does not support getblock verbosity %s (%s); falling back to %s" % (os.getpid(), verbosity, je.error, verbosity - 1))
+      block_data = getblock_txs( bitcoind_or_opts, block_hash, verbosity - 1 )
+
+      # only stop asking for this verbosity once a lower one has worked
+      if getblock_max_verbosity is None or getblock_max_verbosity > verbosity - 1:
+         getblock_max_verbosity = verbosity - 1
+
+      return block_data
+
+   if type(block_data) == types.DictType and len(block_data.get('tx', [])) > 0 and type(block_data['tx'][0]) != types.DictType:
+      # bitcoind took the verbosity for a boolean, and gave us txids
+      log.warning("[%s] bitcoind does not support getblock verbosity %s; falling back to 1" % (os.getpid(), verbosity))
+      getblock_max_verbosity = 1
+
+   elif verbosity >= 3 and type(block_data) == types.DictType and len(block_data.get('tx', [])) > 1 and not has_prevouts( block_data['tx'][1] ):
+      # bitcoind gave us transactions, but not the outputs they spend
+      # (i.e. it treated the verbosity as 2).  Senders will be found by fetching input transactions.
+      log.warning("[%s] bitcoind does not support getblock verbosity %s; falling back to 2" % (os.getpid(), verbosity))
+      getblock_max_verbosity = 2
+
+   if rpc_cache is not None:
+      rpc_cache.put_block( block_hash, min( verbosity, getblock_max_verbosity or verbosity ), block_data )
+
+   return block_data
+
+
+def getblock_raw( bitcoind_or_opts, block_hash ):
+   """
+   Get a block's serialized bytes, given its hash.
+   Use bitcoind's REST interface if we're configured to and
+   bitcoind supports it; otherwise, use getblock with verbosity 0.
+   """
+
+   global bitcoind_rest_supported
+
+   bitcoind_opts = get_bitcoind_opts( bitcoind_or_opts )
+   use_rest, _ = configure_raw_blocks( bitcoind_opts )
+
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      block_hex = rpc_cache.get_block( block_hash, 0 )
+      if block_hex is not None:
+         return binascii.unhexlify( block_hex )
+
+   if use_rest and bitcoind_rest_supported is not False:
+      block_bin = None
+      try:
+         block_bin = bitcoind_rest_get( bitcoind_opts, "/rest/block/%s.bin" % block_hash )
+
+      except Exception, e:
+         # probably transient; use RPC for this block
+         log.error("[%s] Failed to fetch block %s over REST: %s" % (os.getpid(), block_hash, e))
+
+      else:
+         if block_bin is None:
+            log.warning("[%s] bitcoind does not serve blocks over REST; falling back to RPC" % os.getpid())
+            bitcoind_rest_supported = False
+
+         else:
+            bitcoind_rest_supported = True
+            if rpc_cache is not None:
+               rpc_cache.put_block( block_hash, 0, binascii.hexlify( block_bin ) )
+
+            return block_bin
+
+   # getblock() caches it for us
+   block_hex = getblock( bitcoind_or_opts, block_hash, 0 )
+   return binascii.unhexlify( block_hex )
+
+
+def getblock_deserialized( bitcoind_or_opts, block_hash ):
+   """
+   Get a block's raw bytes, given its hash, and decode it 
+   in-process.  Return it in the same form as getblock_txs() 
+   does with verbosity 2 (but with nulldata already extracted
+   from each transaction--see rawblock.deserialize_transaction()).
+   """
+
+   _, network = configure_raw_blocks( get_bitcoind_opts( bitcoind_or_opts ) )
+
+   block_bin = getblock_raw( bitcoind_or_opts, block_hash )
+   block_data = deserialize_block( block_bin, network=network )
+
+   if block_data['hash'] != block_hash:
+      raise Exception("Block %s: got block %s instead" % (block_hash, block_data['hash']))
+
+   return block_data
+
+
+def getblock_txs_async( workpool, bitcoind_opts, block_hash, verbosity ):
+   """
+   Get a block's data and decoded transactions, given its hash.
+   Return a future to the data.
+   """
+   block_future = workpool.apply_async( getblock_txs, (bitcoind_opts, block_hash, verbosity) )
+   return block_future
+
+
+def bitcoind_batch( bitcoind_or_opts, method, params_list ):
+   """
+   Call the same bitcoind RPC method several times, using
+   a single JSON-RPC batch request (i.e. one round trip).
+   params_list is a list of parameter lists, one per call.
+
+   Return a list of (result, error) pairs, in the same order as params_list.
+   error is None if the call succeeded, and is bitcoind's error object if not.
+   Raise an exception if the batch as a whole could not be carried out.
+   """
+
+   global bitcoind_batch_supported
+
+   bitcoind = get_bitcoind( bitcoind_or_opts )
+
+   if len(params_list) == 1 or bitcoind_batch_supported is False or getattr( type(unwrap_bitcoind( bitcoind )), "_batch", None ) is None:
+      # not worth batching, or the client or bitcoind can't batch.
+      # issue the calls one at a time.
+      ret = []
+      for params in params_list:
+         try:
+            result = getattr( bitcoind, method )( *params )
+            ret.append( (result, None) )
+
+         except JSONRPCException, je:
+            ret.append( (None, je.error) )
+
+      return ret
+
+   rpc_calls = []
+   for i in xrange(0, len(params_list)):
+      rpc_calls.append( {"version": "1.1", "method": method, "params": list(params_list[i]), "id": i} )
+
+   responses = bitcoind._batch( rpc_calls )
+
+   if type(responses) != types.ListType:
+      # bitcoind rejected the batch outright
+      error = None
+      if type(responses) == types.DictType:
+         error = responses.get('error', None)
+
+      if type(error) == types.DictType and error.get('code', None) in [-32700, -32600] and bitcoind_batch_supported is None:
+         # parse error or invalid request:  bitcoind doesn't understand batches
+         log.warning("[%s] bitcoind rejected a JSON-RPC batch (%s); sending calls one at a time" % (os.getpid(), error))
+         bitcoind_batch_supported = False
+
+      raise JSONRPCException( error or {'code': -342, 'message': 'invalid JSON-RPC batch response'} )
+
+   bitcoind_batch_supported = True
+
+   ret = [(None, {'code': -343, 'message': 'missing JSON-RPC result'})] * len(params_list)
+
+   for response in responses:
+
+      idx = response.get('id', None)
+      if type(idx) not in [types.IntType, types.LongType] or idx < 0 or idx >= len(params_list):
+         log.error("Unexpected JSON-RPC batch response id '%s'" % idx)
+         continue
+
+      if response.get('error', None) is not None:
+         ret[idx] = (None, response['error'])
+
+      elif 'result' in response:
+         ret[idx] = (response['result'], None)
+
+   return ret
+
+
+def bitcoind_batch_retry( bitcoind_or_opts, method, params_list, retry_func ):
+   """
+   Call the same bitcoind RPC method several times in one batch.
+   If the batch as a whole fails, reconnect and try it again, as
+   call_bitcoind() does for single calls.  If bitcoind reports an error for
+   an individual call, retry just that call with retry_func(bitcoind_or_opts, params),
+   which is expected to implement the same retry logic as the single-call methods.
+
+   Return the list of results, in the same order as params_list.
+   Raise an exception if an individual call could not be completed.
+   """
+
+   if bitcoind_or_opts is None:
+      raise Exception("No bitcoind or opts given")
+
+   if len(params_list) == 0:
+      return []
+
+   results = None
+   try:
+      # (if bitcoind rejects the batch outright, it will reject it again)
+      give_up = lambda e: bitcoind_batch_supported is False
+      results = call_bitcoind( bitcoind_or_opts, method, lambda bitcoind: bitcoind_batch( bitcoind, method, params_list ), kind="%s/batch" % method, give_up=give_up )
+
    except Exception, e:
-      print "output_index = '%s'" % output_index
-      raise e
+      log.error("[%s] bitcoind batch %s failed: %s" % (os.getpid(), method, repr(e)))
+
+   if results is None:
+      # batching isn't working; fall back to retrying each call
+      results = [(None, {'code': -342, 'message': 'batch failed'})] * len(params_list)
+
+   ret = []
+   for i in xrange(0, len(params_list)):
+
+      result, error = results[i]
+      if error is not None:
+         log.error("[%s] bitcoind batch %s%s failed: %s; retrying" % (os.getpid(), method, params_list[i], error))
+         count_rpc_retry( method )
+         result = retry_func( bitcoind_or_opts, params_list[i] )
+
+      ret.append( result )
+
+   return ret
+
+
+def getblockhash_batch( bitcoind_or_opts, block_numbers, reset ):
+   """
+   Get a list of blocks' hashes, given their IDs, in one round trip.
+   Return the list of hashes, in the same order as block_numbers.
+   """
+
+   if bitcoind_or_opts is None:
+       raise Exception("No bitcoind or opts given")
+
+   block_hashes = [None] * len(block_numbers)
+
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      block_hashes = [rpc_cache.get_block_hash( block_number ) for block_number in block_numbers]
+
+   missing = [i for i in xrange(0, len(block_numbers)) if block_hashes[i] is None]
+   if len(missing) == 0:
+      return block_hashes
+
+   if reset:
+       new_opts = get_bitcoind_opts( bitcoind_or_opts )
+       multiprocess_bitcoind( new_opts, reset=True )
+
+   retry_func = lambda b, params: getblockhash( b, params[0], False )
+   fetched = bitcoind_batch_retry( bitcoind_or_opts, "getblockhash", [[block_numbers[i]] for i in missing], retry_func )
+
+   for i, block_hash in zip( missing, fetched ):
+      block_hashes[i] = block_hash
+
+   return block_hashes
+
+
+def getblockhash_batch_async( workpool, bitcoind_opts, block_numbers, reset=False ):
+   """
+   Get a list of blocks' hashes, asynchronously, given their IDs.
+   Return a future to the list of block hashes.
+   """
+
+   block_hashes_future = workpool.apply_async( getblockhash_batch, (bitcoind_opts, block_numbers, reset) )
+   log.debug("getblockhash_batch_async %s-%s" % (block_numbers[0], block_numbers[-1]))
+
+   return block_hashes_future
+
+
+def getrawtransaction_batch( bitcoind_or_opts, txids, verbose ):
+   """
+   Get a list of raw transactions, given their txids, in one round trip.
+   Return the list of transactions, in the same order as txids.
+   """
+
+   txs = [None] * len(txids)
+
+   rpc_cache = get_rpc_cache( bitcoind_or_opts )
+   if rpc_cache is not None:
+      txs = [rpc_cache.get_transaction( txid, verbose ) for txid in txids]
+
+   missing = [i for i in xrange(0, len(txids)) if txs[i] is None]
+   if len(missing) == 0:
+      return txs
+
+   retry_func = lambda b, params: getrawtransaction( b, params[0], params[1] )
+   fetched = bitcoind_batch_retry( bitcoind_or_opts, "getrawtransaction", [[txids[i], verbose] for i in missing], retry_func )
+
+   for i, tx in zip( missing, fetched ):
+      txs[i] = tx
+      if rpc_cache is not None:
+         rpc_cache.put_transaction( txids[i], verbose, tx )
+
+   return txs
+
+
+def getrawtransaction_batch_deserialized( bitcoind_or_opts, txids ):
+   """
+   Get a list of raw transactions, given their txids, in one round trip,
+   and decode them in-process (see rawblock.deserialize_transaction()).
+   Return the list of decoded transactions, in the same order as txids.
+   """
+
+   _, network = configure_raw_blocks( get_bitcoind_opts( bitcoind_or_opts ) )
+
+   txs = getrawtransaction_batch( bitcoind_or_opts, txids, 0 )
+   return [deserialize_transaction_hex( tx_hex, network=network ) if tx_hex is not None else None for tx_hex in txs]
+
+
+def getrawtransaction_batch_async( workpool, bitcoind_opts, txids, verbose ):
+   """
+   Get a list of transactions, asynchronously, using the pool
+   of processes to go get them.
+   Return a future to the list of transactions.
+   """
+
+   txs_future = workpool.apply_async( getrawtransaction_batch, (bitcoind_opts, txids, verbose) )
+   return txs_future
+
+
+def get_sender_and_amount_in_from_output( prev_tx_output ):
+   """
+   Given a previous transaction's output (i.e. the current input),
+   get information about the sender and the money paid.
+
+   Return a sender (a dict with a script_pubkey, amount, and list of addresses
+   within the script_pubkey), and the amount paid.
+   """
 
    # make sure the previous tx output is valid
    if not ('scriptPubKey' in prev_tx_output and 'value' in prev_tx_output):
@@ -281,6 +581,11 @@ def get_sender_and_amount_in_from_txn( tx, output_index ):
 
    # extract the script_pubkey
    script_pubkey = prev_tx_output['scriptPubKey']
+
+   # newer versions of bitcoind give a single address instead of a list
+   addresses = script_pubkey.get('addresses')
+   if addresses is None and script_pubkey.get('address') is not None:
+      addresses = [script_pubkey['address']]
    
    # build and append the sender to the list of senders
    amount_in = int(prev_tx_output['value']*10**8)
@@ -288,12 +593,224 @@ def get_sender_and_amount_in_from_txn( tx, output_index ):
       "script_pubkey": script_pubkey.get('hex'),
       "script_type": script_pubkey.get('type'),
       "amount": amount_in,
-      "addresses": script_pubkey.get('addresses')
+      "addresses": addresses
    }
    
    return sender, amount_in
 
 
+def get_sender_and_amount_in_from_txn( tx, output_index ):
+   """
+   Given a transaction, get information about the sender 
+   and the money paid.
+   
+   Return a sender (a dict with a script_pubkey, amount, and list of addresses
+   within the script_pubkey), and the amount paid.
+   """
+   
+   # grab the previous tx output (the current input)
+   try:
+      prev_tx_output = tx['vout'][output_index]
+   except Exception, e:
+      print "output_index = '%s'" % output_index
+      raise e
+
+   return get_sender_and_amount_in_from_output( prev_tx_output )
+
+
+def get_sender_and_amount_in_from_prevout( input ):
+   """
+   Given a transaction input that bitcoind has annotated with the 
+   output it spends (i.e. from getblock verbosity 3), get information
+   about the sender and the money paid, without fetching the input's
+   transaction.
+
+   Return a sender and the amount paid, as get_sender_and_amount_in_from_txn() does.
+   Return (None, None) if the input has no prevout data.
+   """
+
+   if 'prevout' not in input:
+      return (None, None)
+
+   return get_sender_and_amount_in_from_output( input['prevout'] )
+
+
+def has_prevouts( tx ):
+   """
+   Does this transaction carry the outputs its inputs spend 
+   (i.e. did it come from getblock verbosity 3)?
+   Coinbase inputs don't spend anything, so they don't count.
+   """
+   if 'vin' not in tx:
+      return False
+
+   for input in tx['vin']:
+      if 'txid' in input and 'vout' in input and 'prevout' not in input:
+         return False
+
+   return True
+
+
+def find_input_sender( input, sender_cache, known_outputs, prevout_index=None ):
+   """
+   Try to find the sender and amount paid by a transaction input
+   without fetching its transaction.  Look in (in order):
+   * the prevout bitcoind annotated the input with (if any)
+   * the cache of outputs we've already resolved (if given)
+   * known_outputs, a dict mapping the txids of transactions we have
+     already fetched (e.g. earlier in the same block) to their outputs
+   * the local index of transaction outputs (if given)
+
+   Return (sender, amount_in) on success ((None, None) if the spent output is not valid).
+   Return None if the input's transaction must be fetched.
+   """
+
+   if 'prevout' in input:
+      return get_sender_and_amount_in_from_prevout( input )
+
+   txid = input['txid']
+   tx_output_index = input['vout']
+
+   if sender_cache is not None:
+      sender_and_amount = sender_cache.get( txid, tx_output_index )
+      if sender_and_amount is not None:
+         return sender_and_amount
+
+   if known_outputs is not None and known_outputs.has_key( txid ):
+
+      outputs = known_outputs[txid]
+      if tx_output_index < 0 or tx_output_index >= len(outputs):
+         return None
+
+      if sender_cache is not None:
+         sender_cache.in_block += 1
+
+      return get_sender_and_amount_in_from_output( outputs[tx_output_index] )
+
+   if prevout_index is not None:
+      sender_and_amount = prevout_index.get_sender_and_amount( txid, tx_output_index )
+      if sender_and_amount is not None:
+         if sender_cache is not None:
+            sender_cache.put( txid, tx_output_index, sender_and_amount[0], sender_and_amount[1] )
+
+         return sender_and_amount
+
+   return None
+
+
+def get_senders_and_fee( input_senders, total_out ):
+   """
+   Given the (sender, amount paid) of each of a transaction's inputs
+   (as {input index: (sender, amount_in)}), and the total amount it
+   sends, get its list of senders (in the same order as its inputs)
+   and its fee.  Inputs whose senders aren't valid are left out.
+
+   Return (senders, fee)
+   """
+
+   total_in = 0   # total input paid
+   ordered_senders = []
+
+   for input_idx, (sender, amount_in) in input_senders.items():
+
+      if sender is None or amount_in is None:
+         continue
+
+      total_in += amount_in
+
+      # preserve sender order...
+      ordered_senders.append( (input_idx, sender) )
+
+   # sort on input_idx, so the list of senders matches the given transaction's list of inputs
+   ordered_senders.sort()
+   senders = [sender for (_, sender) in ordered_senders]
+
+   return (senders, total_in - total_out)
+
+
+class SenderResolver( object ):
+   """
+   Handle to a nulldata transaction's senders and fee, for the
+   opcodes whose senders and fee aren't needed up front (see
+   get_nulldata_txs_in_blocks()).  The inputs that could be resolved
+   without an RPC already are; resolve() fetches the rest from bitcoind,
+   the first time it is called.
+
+   NOTE: resolving does not use (or fill) the caches of resolved outputs,
+   since it can happen in another thread from the one fetching blocks.
+   """
+
+   def __init__( self, bitcoind_opts, input_senders, missing_inputs, total_out, deserialize=False ):
+      self.bitcoind_opts = bitcoind_opts
+      self.input_senders = input_senders        # {input_idx: (sender, amount_in)}
+      self.missing_inputs = missing_inputs      # [(input_idx, txid, vout)] still to be fetched
+      self.total_out = total_out
+      self.deserialize = deserialize            # fetch raw transactions and decode them ourselves
+      self.senders = None
+      self.fee = None
+
+      if len(missing_inputs) == 0:
+         self.senders, self.fee = get_senders_and_fee( input_senders, total_out )
+
+
+   def is_resolved( self ):
+      """
+      Are the senders and fee known yet?
+      """
+      return self.senders is not None
+
+
+   def resolve( self ):
+      """
+      Get the transaction's senders and fee, fetching
+      the transactions its inputs spend if need be.
+
+      Return (senders, fee), just like get_nulldata_txs_in_blocks() would have.
+      """
+      if self.senders is not None:
+         return (self.senders, self.fee)
+
+      txids = []
+      for (_, txid, _) in self.missing_inputs:
+         if txid not in txids:
+            txids.append( txid )
+
+      rpc_batch_size = configure_rpc_batching( self.bitcoind_opts )
+      input_txs = {}
+
+      for j in xrange(0, len(txids), rpc_batch_size):
+         if self.deserialize:
+            fetched = getrawtransaction_batch_deserialized( self.bitcoind_opts, txids[j:j+rpc_batch_size] )
+         else:
+            fetched = getrawtransaction_batch( self.bitcoind_opts, txids[j:j+rpc_batch_size], 1 )
+
+         input_txs.update( zip( txids[j:j+rpc_batch_size], fetched ) )
+
+      input_senders = dict( self.input_senders )
+      for (input_idx, txid, tx_output_index) in self.missing_inputs:
+         input_senders[input_idx] = get_sender_and_amount_in_from_txn( input_txs[txid], tx_output_index )
+
+      self.senders, self.fee = get_senders_and_fee( input_senders, self.total_out )
+      self.input_senders = None
+      self.missing_inputs = []
+      return (self.senders, self.fee)
+
+
+   def get_senders( self ):
+      return self.resolve()[0]
+
+
+   def get_fee( self ):
+      return self.resolve()[1]
+
+
+   def __repr__( self ):
+      if self.senders is not None:
+         return "SenderResolver(senders=%r, fee=%r)" % (self.senders, self.fee)
+
+      return "SenderResolver(unresolved inputs=%r)" % ([(txid, vout) for (_, txid, vout) in self.missing_inputs],)
+
+
 def get_total_out(outputs):
     total_out = 0
     # analyze the outputs for the total amount out
@@ -303,7 +820,7 @@ def get_total_out(outputs):
     return total_out
  
 
-def process_nulldata_tx_async( workpool, bitcoind_opts, tx ):
+def process_nulldata_tx_async( workpool, bitcoind_opts, tx, batch_size=1 ):
     """
     Given a transaction and a block hash, begin fetching each 
     of the transaction's vin's transactions.  The reason being,
@@ -312,22 +829,28 @@ def process_nulldata_tx_async( workpool, bitcoind_opts, tx ):
     
     However, in order to identify a primary sender, we need to 
     preserve the order in which the input transactions occurred.
-    To do so, we tag each future with the index into the transaction's 
+    To do so, we tag each future with the indexes into the transaction's 
     vin list, so once the futures have been finalized, we'll have an 
     ordered list of input transactions that is in the same order as 
     they are in the given transaction's vin.
+
+    Input transactions are fetched in batches of up to batch_size,
+    so each future resolves to a list of input transactions.
+    Inputs that already carry the output they spend (i.e. a "prevout"
+    from getblock verbosity 3) are not fetched at all.
     
-    Returns: [(input_idx, tx_fut, tx_output_index)]
+    Returns: [(input_idxs, tx_fut, tx_output_indexes)]
     """
     
     tx_futs = []
-    senders = []
-    total_in = 0
     
     if not ('vin' in tx and 'vout' in tx and 'txid' in tx):
         return None
 
     inputs = tx['vin']
+    input_idxs = []
+    tx_hashes = []
+    tx_output_indexes = []
     
     for i in xrange(0, len(inputs)):
       input = inputs[i]
@@ -336,59 +859,68 @@ def process_nulldata_tx_async( workpool, bitcoind_opts, tx ):
       if not ('txid' in input and 'vout' in input):
          continue
       
+      # no need to fetch it if bitcoind told us what it spends 
+      if 'prevout' in input:
+         continue
+      
       # get the tx data for the specified input
-      tx_hash = input['txid']
-      tx_output_index = input['vout']
+      input_idxs.append( i )
+      tx_hashes.append( input['txid'] )
+      tx_output_indexes.append( input['vout'] )
+    
+    for j in xrange(0, len(tx_hashes), batch_size):
       
-      tx_fut = getrawtransaction_async( workpool, bitcoind_opts, tx_hash, 1 )
-      tx_futs.append( (i, tx_fut, tx_output_index) )
+      tx_fut = getrawtransaction_batch_async( workpool, bitcoind_opts, tx_hashes[j:j+batch_size], 1 )
+      tx_futs.append( (input_idxs[j:j+batch_size], tx_fut, tx_output_indexes[j:j+batch_size]) )
     
     return tx_futs 
 
 
-def future_next( fut_records, fut_inspector ):
-   
+def get_block_goodput( block_data ):
    """
-   Find and return a record in a list of records, whose 
-   contained future (obtained by the callable fut_inspector)
-   is ready and has data to be gathered.
-   
-   If no such record exists, then select one and block on it
-   until its future has data.
+   Find out how much goodput data is present in a block's data,
+   i.e. the number of bytes of its transactions that we kept
+   (given as decoded transactions, or as hex strings).
    """
+   if block_data is None:
+      return 0
    
-   if len(fut_records) == 0:
-      return None 
-   
-   for fut_record in fut_records:
-      fut = fut_inspector( fut_record )
-      if fut is not None:
-         if fut.ready():
-            fut_records.remove( fut_record )
-            return fut_record 
-      
-   # no ready futures.  wait for one 
-   for fut_record in fut_records:
-      fut = fut_inspector( fut_record )
-      if fut is not None:
-         
-         # NOTE: interruptable
-         fut.wait( 10000000000000000L )
+   size = 0
+   for tx in block_data:
+      if isinstance( tx, NulldataTx ):
+         if tx.size is not None:
+            size += tx.size
+
+      elif type(tx) == types.DictType:
+         if tx.get('size', None) is not None:
+            size += tx['size']
+         elif tx.get('hex', None) is not None:
+            size += len(tx['hex']) / 2
+            
+      else:
+         size += len(tx)
          
-         fut_records.remove( fut_record )
-         return fut_record
-   
+   return size
    
 
-def get_block_goodput( block_data ):
+def get_block_size( block_data ):
    """
-   Find out how much goodput data is present in a block's data
+   Find out how big a block is, in bytes (as serialized), given its
+   data.  If bitcoind didn't say, add up the sizes of its transactions
+   (the ones we know the sizes of, if it sent them along).
    """
-   if block_data is None:
-      return 0
+   if block_data.get('size', None) is not None:
+      return block_data['size']
    
-   sum( [len(h) for h in block_data] )
+   size = 0
+   txs = block_data.get('tx', [])
+   if type(txs) == types.ListType:
+      for tx in txs:
+         if type(tx) == types.DictType:
+            size += get_tx_size( tx ) or 0
    
+   return size
+
 
 def bandwidth_record( total_time, block_data ):
    return {
@@ -397,183 +929,534 @@ def bandwidth_record( total_time, block_data ):
    }
 
 
-def get_nulldata_txs_in_blocks( workpool, bitcoind_opts, blocks_ids ):
+def fetch_shared( shm_dir, reader_pid, func, *args ):
+   """
+   Call func(*args) in a pool worker, and hand the transactions
+   it returns (either a list of them, or a block with them in "tx")
+   back to process reader_pid through shared memory (see sharedmem.py).
+   The transactions are replaced with a SharedTxs descriptor.
+   """
+   result = func( *args )
+
+   if type(result) == types.ListType:
+      return share_txs( result, shm_dir, reader_pid )
+
+   if type(result) == types.DictType and len(result.get('tx', [])) > 0 and type(result['tx'][0]) == types.DictType:
+      # don't modify it in place; it might be cached
+      result = dict(result)
+      result['tx'] = share_txs( result['tx'], shm_dir, reader_pid )
+
+   return result
+
+
+def fetch_filtered( keep_all, prefilter, compact, func, *args ):
+   """
+   Call func(*args) in a pool worker, and filter the transactions
+   it returns (either a list of them, or a block with them in "tx")
+   down to the ones the indexing process needs (see filter_nulldata_txs()).
+   The transactions are replaced with a FilteredTxs.
+   """
+   result = func( *args )
+
+   if type(result) == types.ListType:
+      return filter_nulldata_txs( result, keep_all=keep_all, prefilter=prefilter, compact=compact )
+
+   if type(result) == types.DictType and len(result.get('tx', [])) > 0 and type(result['tx'][0]) == types.DictType:
+      # don't modify it in place; it might be cached
+      result = dict(result)
+      result['tx'] = filter_nulldata_txs( result['tx'], keep_all=keep_all, prefilter=prefilter, compact=compact )
+
+   return result
+
+
+def get_nulldata_txs_in_blocks( workpool, bitcoind_opts, blocks_ids, magic_bytes=None, opcodes=None, sender_opcodes=None, stop=None ):
    """
    Obtain the set of transactions over a range of blocks that have an OP_RETURN with nulldata.
-   Each returned transaction record will contain:
-   * vin (list of inputs from bitcoind)
-   * vout (list of outputs from bitcoind)
+   Each returned transaction record is a NulldataTx (see txrecord.py), which
+   can be read like a dict with:
+   * vin (list of inputs from bitcoind; only the outpoints they spend, if
+     configured to keep them compactly (see configure_compact_tx_records()))
+   * vout (list of outputs from bitcoind; only their values, scripts, and
+     addresses, if configured to keep them compactly)
    * txid (transaction ID, as a hex string)
    * txindex (transaction index in the block)
    * senders (a list of {"script_pubkey":, "amount":, and "addresses":} dicts; the "script_pubkey" field is the hex-encoded op script).
    * fee (total amount sent)
    * nulldata (input data to the transaction's script; encodes virtual chain operations)
+   * nulldata_bin (the same data, as raw bytes)
    
    Farm out the requisite RPCs to a workpool of processes, each 
-   of which have their own bitcoind RPC client.
+   of which have their own bitcoind RPC client.  If bitcoind supports it,
+   each block's transactions are fetched along with the block itself
+   (getblock verbosity 2); otherwise, they are fetched by txid.
+   With getblock verbosity 0, raw blocks are fetched and decoded in 
+   the workers instead of having bitcoind decode them.
+   If bitcoind's block files are available (the "bitcoind_blocks_dir" 
+   option), the workers read and decode blocks straight from them instead,
+   and bitcoind is only asked for the best chain's block hashes (and 
+   for any input transactions that can't be resolved locally).
+   Each RPC's follow-up work is started as soon as its result comes back,
+   regardless of the order in which the RPCs were issued.
+
+   Each input transaction is fetched at most once per slice of blocks, and 
+   not at all if it is already in the slice or in the (shared) cache of 
+   resolved outputs.
+
+   Workers filter out the transactions without nulldata before handing
+   back what they fetch, if configured to (see configure_worker_filtering()).
+   They keep only the outputs that the rest spend, so inputs that spend
+   outputs from other blocks in the slice are then looked up like any
+   other (unless the prevout index is on, in which case workers hand back
+   every transaction's inputs and outputs for it).  Otherwise, workers in
+   a process pool hand back the transactions they fetch through shared
+   memory, if configured to (see configure_result_transfer()), and only
+   the ones we need are decoded.
+   
+   If magic_bytes is given, transactions whose nulldata doesn't start with
+   it (followed by one of the opcodes, if given) are dropped before any of
+   their inputs are looked up, since the state engine would ignore them anyway.
+   
+   If a memory ceiling or transaction budget is configured (see
+   configure_fetch_budget()), each slice gets only as many blocks as are
+   expected to fit it, given the sizes and transaction counts of the
+   blocks fetched so far (see tuning.SliceBudget).  Within a slice, blocks
+   are then fetched in order, and the slice ends early if the next one
+   would not fit.  Either way, the most block data a slice held at once
+   is reported in the fetch metrics (see get_fetch_metrics()).
+   
+   If sender_opcodes is given (along with magic_bytes), only transactions
+   with those opcodes have their senders and fee resolved up front.  The
+   rest get a SenderResolver in place of their senders (and None for their
+   fee); inputs that can be resolved without an RPC are, and the others
+   are fetched only if and when its resolve() is called.
+   
+   If stop is given, it is called while we wait on the workpool (and
+   between slices); once it returns True, we give up and raise
+   CompletionQueueStopped (i.e. because the workpool is being terminated,
+   and its outstanding results will never arrive).
    
    Returns [(block_number, [txs])], where each tx contains the above.
    """
    
    nulldata_tx_map = {}    # {block_number: {"tx": [tx]}}
+   address_strings = {}    # interned addresses of the nulldata transactions' outputs
+   prefiltered_txs = {}    # {block_number: number of nulldata transactions that aren't virtual chain operations}
    block_bandwidth = {}    # {block_number: {"time": time taken to process, "size": number of bytes}}
    nulldata_txs = []
    
-   # break work up into slices of blocks, so we don't run out of memory 
-   slice_len = multiprocess_batch_size( bitcoind_opts )
-   slice_count = 0
+   # break work up into slices of blocks, so we don't run out of memory.
+   # with adaptive concurrency, the slice length can change from one slice to the next.
+   slice_start = 0
+   concurrency_controller = get_concurrency_controller( bitcoind_opts )
+   
+   # keep each slice's blocks within a memory ceiling and transaction budget, if we're configured to
+   max_slice_bytes, max_slice_txs = configure_fetch_budget( bitcoind_opts )
+   slice_budget = SliceBudget( max_slice_bytes, max_slice_txs )
+
+   # pack RPCs into batches, so we don't pay a round trip for each one
+   _, worker_batch_size = configure_multiprocessing( bitcoind_opts )
+   rpc_batch_size = configure_rpc_batching( bitcoind_opts )
+   getblock_verbosity = configure_getblock_verbosity( bitcoind_opts )
+   hash_batch_size = max(1, min( worker_batch_size, rpc_batch_size ))
+
+   # remember resolved inputs across slices
+   sender_cache = get_sender_cache( bitcoind_opts )
+   prevout_index = get_prevout_index( bitcoind_opts )
+
+   # read blocks from bitcoind's block files, if we can
+   block_file_index = get_block_file_index( bitcoind_opts )
+   
+   # have workers hand back transactions through shared memory, if we can
+   _, shm_dir = configure_result_transfer( bitcoind_opts )
+   if shm_dir is not None:
+      register_shared_segment_cleanup( shm_dir )
+   
+   # have workers drop the transactions we don't need, if we can
+   filter_txs = configure_worker_filtering( bitcoind_opts )
+   
+   # keep only what sender lookups need from nulldata transactions, if we're configured to
+   compact_txs = configure_compact_tx_records( bitcoind_opts )
+   
+   # only look at the transactions that could be virtual chain operations
+   prefilter = None
+   if magic_bytes is not None:
+      prefilter = (magic_bytes, opcodes)
+   
+   def submit_fetch( func, args, tag, filtered=False ):
+      if filtered and filter_txs:
+         completions.submit( fetch_filtered, (prevout_index is not None, prefilter, compact_txs, func) + args, tag )
+      elif shm_dir is not None:
+         completions.submit( fetch_shared, (shm_dir, os.getpid(), func) + args, tag )
+      else:
+         completions.submit( func, args, tag )
+   
+   def fetch_block( block_number, block_hash ):
+      slice_budget.fetch_started()
+      
+      if block_file_index is not None:
+          location = block_file_index.locate( block_hash )
+          if location is not None:
+              log.debug("getblock_from_file %s %s %s" % (block_number, block_hash, location))
+              submit_fetch( getblock_from_file, (bitcoind_opts, block_hash, location), ("block", block_number), filtered=True )
+              
+          else:
+              # not written yet, or pruned
+              log.warning("Block %s (%s) is not in %s; fetching it from bitcoind" % (block_number, block_hash, block_file_index.blocks_dir))
+              submit_fetch( getblock_deserialized, (bitcoind_opts, block_hash), ("block", block_number), filtered=True )
+          
+      else:
+          log.debug("getblock_txs %s %s" % (block_number, block_hash))
+          submit_fetch( getblock_txs, (bitcoind_opts, block_hash, getblock_verbosity), ("block", block_number), filtered=True )
+   
+   def fetch_blocks_in_budget( next_block ):
+      # fetch the slice's blocks in order, for as long as the ones fetched and in flight fit the budget.
+      # return the index (in the slice) of the next block to fetch.
+      while next_block < len(block_slice) and pending_hashes.has_key( block_slice[next_block] ):
+         
+         block_number = block_slice[next_block]
+         if pending_hashes[ block_number ] is not None:
+            if not slice_budget.can_fetch():
+               break
+            
+            fetch_block( block_number, pending_hashes[ block_number ] )
+         
+         next_block += 1
+      
+      return next_block
    
-   while slice_count * slice_len < len(blocks_ids):
+   def needs_senders( tx ):
+      if sender_opcodes is None or magic_bytes is None:
+         return True
+      
+      nulldata_bin = tx.get('nulldata_bin', None)
+      if nulldata_bin is None:
+         try:
+            nulldata_bin = binascii.unhexlify( get_nulldata( tx ) )
+         except Exception:
+            return True
       
-      block_hash_futures = []
-      block_data_futures = []
-      tx_futures = []
-      nulldata_tx_futures = []
-      all_nulldata_tx_futures = []
+      if len(nulldata_bin) <= len(magic_bytes):
+         return True
+      
+      return nulldata_bin[ len(magic_bytes) ] in sender_opcodes
+   
+   def passes_prefilter( block_number, tx ):
+      if prefilter is None or is_virtualchain_nulldata( get_nulldata( tx ), magic_bytes, opcodes ):
+         return True
+      
+      prefiltered_txs[block_number] = prefiltered_txs.get( block_number, 0 ) + 1
+      return False
+   
+   while slice_start < len(blocks_ids):
+      
+      if stop is not None and stop():
+         raise CompletionQueueStopped("Stopped at block %s" % blocks_ids[slice_start])
+      
+      nulldata_tx_senders = []
+      nulldata_tx_records = []  # [(block_number, tx_index, tx)]
+      slice_outputs = SharedOutputs()   # {txid: [outputs]} for each tx in this slice
+      slice_block_txs = []      # [(block_number, [txs])], for the local prevout index
       block_times = {}          # {block_number: time taken to process}
       
-      block_slice = blocks_ids[ (slice_count * slice_len) : min((slice_count+1) * slice_len, len(blocks_ids)) ]
+      # results of every stage land here, in the order in which they finish
+      completions = CompletionQueue( workpool, controller=concurrency_controller, stop=stop )
+      
+      slice_len = slice_budget.get_slice_len( multiprocess_batch_size( bitcoind_opts ) )
+      block_slice = blocks_ids[ slice_start : min(slice_start + slice_len, len(blocks_ids)) ]
       if len(block_slice) == 0:
          break
       
+      slice_budget.start_slice()
+      pending_hashes = {}       # {block_number: block hash} of blocks not yet fetched, if they're fetched within the budget
+      next_block = 0            # index (in the slice) of the next block to fetch, if they're fetched within the budget
+      
       start_slice_time = time.time()
       
-      # get all block hashes 
+      # get all block hashes, a batch at a time
       for block_number in block_slice:
-         
          block_times[block_number] = time.time() 
-         
-         # NOTE: force re-connect, since the previous connection will have expired if we take a while to process all nulldata 
-         block_hash_fut = getblockhash_async( workpool, bitcoind_opts, block_number, reset=True )
-         block_hash_futures.append( (block_number, block_hash_fut) )
-   
-   
-      # coalesce all block hashes, and start getting each block's data
+
       block_hash_time_start = time.time()
       block_hash_time_end = 0
-      
-      for i in xrange(0, len(block_hash_futures)):
-         
-         block_number, block_hash_fut = future_next( block_hash_futures, lambda f: f[1] )
-         
-         # NOTE: interruptable blocking get(), but should not block since future_next found one that's ready
-         block_hash = block_hash_fut.get( 10000000000000000L )
-        
-         if block_hash is not None:
-             log.debug("getblock_async %s %s" % (block_number, block_hash))
-             block_data_fut = getblock_async( workpool, bitcoind_opts, block_hash )
-             block_data_futures.append( (block_number, block_data_fut) )
-
-         else:
-             log.warning("Block %s: no block hash" % block_number)
-      
-      
-      block_data_time_start = time.time()
+      block_data_time_start = 0
       block_data_time_end = 0
+      block_tx_time_start = 0
+      block_tx_time_end = 0
       
-      # coalesce block data, and get tx hashes 
-      for i in xrange(0, len(block_data_futures)):
-         
-         block_number, block_data_fut = future_next( block_data_futures, lambda f: f[1] )
-         block_hash_time_end = time.time()
+      for j in xrange(0, len(block_slice), hash_batch_size):
          
-         # NOTE: interruptable blocking get(), but should not block since future_next found one that's ready
-         block_data = block_data_fut.get( 10000000000000000L )
+         block_numbers = block_slice[j:j+hash_batch_size]
          
-         if 'tx' not in block_data:
-            log.error("tx not in block data of %s" % block_number)
-            return nulldata_txs
-         
-         tx_hashes = block_data['tx']
+         # NOTE: no need to force a re-connect; idle connections get checked (and replaced if need be) before they're reused
+         completions.submit( getblockhash_batch, (bitcoind_opts, block_numbers, False), ("hash", block_numbers) )
+   
+      # as each block hash arrives, start getting its block's data;
+      # as each block arrives, start getting its transactions (if bitcoind didn't send them along);
+      # as each batch of transactions arrives, find the ones with nulldata.
+      while len(completions) > 0:
          
-         log.debug("Get %s transactions from block %d" % (len(tx_hashes), block_number))
+         tag, result = completions.next()
+         stage = tag[0]
          
-         # can get transactions asynchronously with a workpool
-         # NOTE: tx order matters! remember the order we saw them in
-         if len(tx_hashes) > 0:
+         if stage == "hash":
+            
+            block_numbers = tag[1]
+            block_hashes = result
+            block_hash_time_end = time.time()
+            
+            if block_data_time_start == 0:
+               block_data_time_start = time.time()
             
-            for j in xrange(0, len(tx_hashes)):
+            for block_number, block_hash in zip( block_numbers, block_hashes ):
                
-               tx_hash = tx_hashes[j]
-               tx_fut = getrawtransaction_async( workpool, bitcoind_opts, tx_hash, 1 )
-               tx_futures.append( (block_number, j, tx_fut) )
+               if block_hash is None:
+                   log.warning("Block %s: no block hash" % block_number)
+                   
+               if slice_budget.is_limited():
+                   # fetched in order, as the budget allows
+                   pending_hashes[ block_number ] = block_hash
+                   
+               elif block_hash is not None:
+                   fetch_block( block_number, block_hash )
+                   
+            if slice_budget.is_limited():
+               next_block = fetch_blocks_in_budget( next_block )
+                   
+         elif stage == "block":
             
-         else:
+            block_number = tag[1]
+            block_data = result
+            block_data_time_end = time.time()
             
-            raise Exception("Zero-transaction block %s" % block_number)
+            if block_tx_time_start == 0:
+               block_tx_time_start = time.time()
+               
+            if 'tx' not in block_data:
+               log.error("tx not in block data of %s" % block_number)
+               return nulldata_txs
             
-      block_tx_time_start = time.time()
-      block_tx_time_end = 0
-      
-      # coalesce raw transaction queries...
-      for i in xrange(0, len(tx_futures)):
-         
-         block_number, tx_index, tx_fut = future_next( tx_futures, lambda f: f[2] )
-         block_data_time_end = time.time()
-         
-         # NOTE: interruptable blocking get(), but should not block since future_next found one that's ready
-         tx = tx_fut.get( 10000000000000000L )
-         
-         if tx and has_nulldata(tx):
+            tx_hashes = block_data['tx']
             
-            # go get input transactions for this transaction (since it's the one with nulldata, i.e., a virtual chain operation),
-            # but tag each future with the hash of the current tx, so we can reassemble the in-flight inputs back into it. 
-            nulldata_tx_futs_and_output_idxs = process_nulldata_tx_async( workpool, bitcoind_opts, tx )
-            nulldata_tx_futures.append( (block_number, tx_index, tx, nulldata_tx_futs_and_output_idxs) )
+            # this slice holds on to the block's transactions until it's done
+            slice_budget.record_block( get_block_size( block_data ), len(tx_hashes) )
+            if slice_budget.is_limited():
+               next_block = fetch_blocks_in_budget( next_block )
             
-         else:
+            log.debug("Get %s transactions from block %d" % (len(tx_hashes), block_number))
             
-            # maybe done with this block
-            # NOTE will be called multiple times; we expect the last write to be the total time taken by this block
-            total_time = time.time() - block_times[ block_number ]
-            block_bandwidth[ block_number ] = bandwidth_record( total_time, None )
+            # can get transactions asynchronously with a workpool
+            # NOTE: tx order matters! remember the order we saw them in
+            if isinstance( tx_hashes, SharedTxs ) or isinstance( tx_hashes, FilteredTxs ):
+               
+               # bitcoind already gave us the transactions, and the worker filtered them or put them in shared memory
+               completions.put_completed( tx_hashes, ("txs", block_number, 0) )
+               
+            elif len(tx_hashes) > 0 and type(tx_hashes[0]) == types.DictType:
+               
+               # bitcoind already gave us the transactions
+               completions.put_completed( tx_hashes, ("txs", block_number, 0) )
+               
+            elif len(tx_hashes) > 0:
+               
+               for j in xrange(0, len(tx_hashes), rpc_batch_size):
+                  
+                  submit_fetch( getrawtransaction_batch, (bitcoind_opts, tx_hashes[j:j+rpc_batch_size], 1), ("txs", block_number, j), filtered=True )
+               
+            else:
+               
+               raise Exception("Zero-transaction block %s" % block_number)
+            
+         elif stage == "txs":
+            
+            block_number, first_tx_index = tag[1], tag[2]
+            txs = result
+            block_tx_time_end = time.time()
+            
+            if isinstance( txs, FilteredTxs ):
+               
+               # the worker already dropped the transactions we don't need
+               for (txid, _, outputs) in txs.others:
+                  slice_outputs.put_compact( txid, outputs )
+               
+               for (k, tx) in txs.nulldata_txs:
+                  slice_outputs[ tx['txid'] ] = tx['vout']
+                  nulldata_tx_records.append( (block_number, first_tx_index + k, tx) )
+               
+               if txs.dropped > 0:
+                  prefiltered_txs[block_number] = prefiltered_txs.get( block_number, 0 ) + txs.dropped
+               
+               if prevout_index is not None:
+                  slice_block_txs.append( (block_number, txs.get_index_txs()) )
+               
+               total_time = time.time() - block_times[ block_number ]
+               block_bandwidth[ block_number ] = bandwidth_record( total_time, None )
+               continue
             
+            if isinstance( txs, SharedTxs ):
+               txs = txs.load()
+            
+            if prevout_index is not None:
+               slice_block_txs.append( (block_number, txs) )
+            
+            if isinstance( txs, SharedTxList ):
+               
+               # only decode the transactions with nulldata, and the outputs that get spent in this slice
+               for k in xrange(0, len(txs)):
+                  
+                  txid = txs.get_txid( k )
+                  if txid is not None:
+                     slice_outputs.put_shared( txid, txs, k )
+                  
+                  if txs.has_nulldata( k ) and passes_prefilter( block_number, txs[k] ):
+                     nulldata_tx_records.append( (block_number, first_tx_index + k, txs[k]) )
+               
+               total_time = time.time() - block_times[ block_number ]
+               block_bandwidth[ block_number ] = bandwidth_record( total_time, None )
+               continue
+            
+            for k in xrange(0, len(txs)):
+               
+               tx = txs[k]
+               tx_index = first_tx_index + k
+               
+               if tx and 'txid' in tx and 'vout' in tx:
+                  # nulldata txs in this slice might spend this tx's outputs
+                  slice_outputs[ tx['txid'] ] = tx['vout']
+               
+               if tx and has_nulldata(tx) and passes_prefilter( block_number, tx ):
+                  
+                  # we'll need this tx's input transactions (since it's the one with nulldata, i.e., a virtual chain operation)
+                  nulldata_tx_records.append( (block_number, tx_index, tx) )
+                  
+               else:
+                  
+                  # maybe done with this block
+                  # NOTE will be called multiple times; we expect the last write to be the total time taken by this block
+                  total_time = time.time() - block_times[ block_number ]
+                  block_bandwidth[ block_number ] = bandwidth_record( total_time, None )
+      
+      # if the slice reached its budget, then the blocks we didn't get to go in the next one
+      ended_early = False
+      if slice_budget.is_limited() and next_block < len(block_slice):
+         log.debug("Blocks %s-%s: ending the slice at block %s, since it holds %s bytes and %s transactions (budget: %s bytes, %s transactions)" % \
+               (block_slice[0], block_slice[-1], block_slice[next_block - 1], slice_budget.slice_bytes, slice_budget.slice_txs, slice_budget.max_bytes, slice_budget.max_txs))
+         
+         block_slice = block_slice[:next_block]
+         ended_early = True
+      
+      slice_budget.end_slice( ended_early )
       
       block_nulldata_tx_time_start = time.time()
       block_nulldata_tx_time_end = 0
       
-      # coalesce queries on the inputs to each nulldata transaction from this block...
-      for (block_number, tx_index, tx, nulldata_tx_futs_and_output_idxs) in nulldata_tx_futures:
+      if prevout_index is not None:
+         prevout_index.record_blocks( slice_block_txs )
+         slice_block_txs = None
+      
+      # find the sender of each input to each nulldata transaction from this slice.
+      # resolve what we can without an RPC, and go get the rest, fetching
+      # each input transaction only once (no matter how many inputs spend it).
+      # NOTE: this waits for all of the slice's transactions, so inputs 
+      # that spend outputs from within the slice are never fetched.
+      input_waiters = {}        # {txid: [(input_senders, input_idx, tx_output_index)]}
+      input_txids = []          # txids to fetch, in the order we first needed them
+      
+      for (block_number, tx_index, tx) in nulldata_tx_records:
          
          if ('vin' not in tx) or ('vout' not in tx) or ('txid' not in tx):
             continue 
          
-         outputs = tx['vout']
+         inputs = tx['vin']
+         input_senders = {}     # {input_idx: (sender, amount_in)}
          
-         total_in = 0   # total input paid
-         senders = []
-         ordered_senders = []
+         # if the implementation doesn't need this one's senders up front, don't fetch anything for it yet
+         missing_inputs = None
+         if not needs_senders( tx ):
+            missing_inputs = []     # [(input_idx, txid, vout)]
          
-         # gather this tx's nulldata queries
-         for i in xrange(0, len(nulldata_tx_futs_and_output_idxs)):
+         for input_idx in xrange(0, len(inputs)):
+            
+            input = inputs[input_idx]
             
-            input_idx, input_tx_fut, tx_output_index = future_next( nulldata_tx_futs_and_output_idxs, lambda f: f[1] )
+            # make sure the input is valid
+            if not ('txid' in input and 'vout' in input):
+               continue
             
-            # NOTE: interruptable blocking get(), but should not block since future_next found one that's ready
-            input_tx = input_tx_fut.get( 10000000000000000L )
-            sender, amount_in = get_sender_and_amount_in_from_txn( input_tx, tx_output_index )
+            sender_and_amount = find_input_sender( input, sender_cache, slice_outputs, prevout_index=prevout_index )
+            if sender_and_amount is not None:
+               input_senders[input_idx] = sender_and_amount
+               continue
             
-            if sender is None or amount_in is None:
+            if missing_inputs is not None:
+               missing_inputs.append( (input_idx, input['txid'], input['vout']) )
                continue
             
-            total_in += amount_in 
+            # have to go get it
+            if input_waiters.has_key( input['txid'] ):
+               if sender_cache is not None:
+                  sender_cache.coalesced += 1
+               
+               input_waiters[ input['txid'] ].append( (input_senders, input_idx, input['vout']) )
+               
+            else:
+               input_waiters[ input['txid'] ] = [(input_senders, input_idx, input['vout'])]
+               input_txids.append( input['txid'] )
+         
+         nulldata_tx_senders.append( (block_number, tx_index, tx, input_senders, missing_inputs) )
+      
+      # don't need these anymore
+      slice_outputs = None
+      nulldata_tx_records = None
+      
+      for j in xrange(0, len(input_txids), rpc_batch_size):
+         
+         if getblock_verbosity == 0 or block_file_index is not None:
+            # decode these ourselves too
+            submit_fetch( getrawtransaction_batch_deserialized, (bitcoind_opts, input_txids[j:j+rpc_batch_size]), ("inputs", input_txids[j:j+rpc_batch_size]) )
             
-            # preserve sender order...
-            ordered_senders.append( (input_idx, sender) )
+         else:
+            submit_fetch( getrawtransaction_batch, (bitcoind_opts, input_txids[j:j+rpc_batch_size], 1), ("inputs", input_txids[j:j+rpc_batch_size]) )
+      
+      # resolve inputs to each nulldata transaction from this slice as their transactions arrive...
+      while len(completions) > 0:
          
-         # sort on input_idx, so the list of senders matches the given transaction's list of inputs
-         ordered_senders.sort()
-         senders = [sender for (_, sender) in ordered_senders]
+         tag, input_txs = completions.next()
+         txids = tag[1]
+         
+         if isinstance( input_txs, SharedTxs ):
+            input_txs = input_txs.load()
+         
+         for txid, input_tx in zip( txids, input_txs ):
+            for (input_senders, input_idx, tx_output_index) in input_waiters[txid]:
+               
+               sender, amount_in = get_sender_and_amount_in_from_txn( input_tx, tx_output_index )
+               input_senders[input_idx] = (sender, amount_in)
+               
+               if sender_cache is not None:
+                  sender_cache.put( txid, tx_output_index, sender, amount_in )
+      
+      input_waiters = None
+      
+      # assemble each nulldata transaction's senders and fee
+      for (block_number, tx_index, tx, input_senders, missing_inputs) in nulldata_tx_senders:
+         
+         total_out = get_total_out( tx['vout'] )
+         
+         if missing_inputs is None:
+            senders, fee = get_senders_and_fee( input_senders, total_out )
+            
+         else:
+            # resolved on demand
+            senders = SenderResolver( bitcoind_opts, input_senders, missing_inputs, total_out, deserialize=(getblock_verbosity == 0 or block_file_index is not None) )
+            fee = None
          
-         total_out = get_total_out( outputs )
          nulldata = get_nulldata( tx )
+         nulldata_bin = binascii.unhexlify( nulldata ) if nulldata is not None else None
       
-         # extend tx to explicitly record its nulldata (i.e. the virtual chain op),
+         # record the transaction's nulldata (i.e. the virtual chain op),
          # the list of senders (i.e. their script hexs),
-         # and the total amount paid
-         tx['nulldata'] = nulldata
-         tx['senders'] = senders
-         tx['fee'] = total_in - total_out
+         # and the total amount paid, and keep only what the state engine needs from it
+         tx = NulldataTx( tx, nulldata, nulldata_bin, senders, fee, txindex=tx_index, strings=address_strings, compact=compact_txs )
          
          # track the order of nulldata-containing transactions in this block
          if not nulldata_tx_map.has_key( block_number ):
@@ -606,8 +1489,12 @@ def get_nulldata_txs_in_blocks( workpool, bitcoind_opts, blocks_ids ):
             total_time = time.time() - block_times[ block_number ]
             block_bandwidth[ block_number ] = bandwidth_record( total_time, block_data )
          
+         elif block_data is not None:
+            
+            # it was done when its last nulldata transaction was assembled, but count its data too
+            block_bandwidth[ block_number ] = bandwidth_record( block_bandwidth[ block_number ]["time"], block_data )
+         
          
-      block_tx_time_end = time.time()
       block_nulldata_tx_time_end = time.time()
    
       end_slice_time = time.time()
@@ -629,9 +1516,44 @@ def get_nulldata_txs_in_blocks( workpool, bitcoind_opts, blocks_ids ):
       log.debug("  block data time:        %s" % block_data_time)
       log.debug("  block tx time:          %s" % block_tx_time)
       log.debug("  block nulldata tx time: %s" % block_nulldata_tx_time)
+      log.debug("  blocks held:            %s bytes, %s transactions" % (slice_budget.slice_bytes, slice_budget.slice_txs))
+      log.debug("  bitcoind connections (this process): %s" % get_connection_stats())
+      
+      stage_times = {
+         "hash": block_hash_time,
+         "block": block_data_time,
+         "tx": block_tx_time,
+         "nulldata": block_nulldata_tx_time
+      }
+      
+      slice_data = sum( [block_bandwidth[block_number]["size"] for block_number in block_slice if block_bandwidth.has_key( block_number )] )
+      slice_prefiltered = 0
+      
+      if prefilter is not None:
+         for block_number in block_slice:
+            
+            kept = len( nulldata_tx_map.get( block_number, [] ) )
+            dropped = prefiltered_txs.get( block_number, 0 )
+            slice_prefiltered += dropped
+            
+            if dropped > 0:
+               log.debug("Block %s: kept %s of %s transactions with nulldata (the rest are not virtual chain operations)" % (block_number, kept, kept + dropped))
+      
+      record_fetch_slice( len(block_slice), end_slice_time - start_slice_time, stage_times, len(nulldata_tx_senders), slice_data, num_prefiltered_txs=slice_prefiltered, \
+                          slice_bytes=slice_budget.slice_bytes, slice_txs=slice_budget.slice_txs )
+      
+      # forget outputs whose spends can no longer be reorganized away
+      if prevout_index is not None:
+         prevout_index.prune( block_slice[-1] - PREVOUT_INDEX_PRUNE_DEPTH )
+      
+      if concurrency_controller is not None:
+         concurrency_controller.record_slice( len(block_slice), end_slice_time - start_slice_time )
       
       # next slice
-      slice_count += 1
+      slice_start += len(block_slice)
+   
+   log.debug("Fetched %s blocks in %s slices (%s ended early); at most %s bytes and %s transactions held at once (budget: %s bytes, %s transactions)" % \
+         (slice_budget.blocks, slice_budget.slices, slice_budget.early_ends, slice_budget.peak_bytes, slice_budget.peak_txs, slice_budget.max_bytes, slice_budget.max_txs))
    
    # get the blockchain-ordered list of nulldata-containing transactions.
    # this is the blockchain-agreed list of all virtual chain operations, as well as the amount paid per transaction and the 
@@ -644,14 +1566,42 @@ def get_nulldata_txs_in_blocks( workpool, bitcoind_opts, blocks_ids ):
       if block_number in nulldata_tx_map.keys():
          tx_list = nulldata_tx_map[ block_number ]     # [(tx_index, tx)]
          tx_list.sort()                                # sorts on tx_index--preserves order in the block
-         
-         # preserve index
-         for (tx_index, tx) in tx_list:
-             tx['txindex'] = tx_index
-
          txs = [ tx for (_, tx) in tx_list ]
 
       nulldata_txs.append( (block_number, txs) )
       
    return nulldata_txs
 
+
+def get_nulldata_txs_in_blocks_pooled( bitcoind_opts, blocks_ids, max_concurrency=None, magic_bytes=None, opcodes=None, sender_opcodes=None ):
+   """
+   Like get_nulldata_txs_in_blocks(), but drive all of the RPCs from
+   this process:  up to max_concurrency threads share one pool of 
+   persistent bitcoind connections, so there are no worker processes
+   to fork and no results to pickle across processes.
+   
+   max_concurrency defaults to the "bitcoind_rpc_pool_size" option,
+   or RPC_POOL_SIZE if it is not set.  magic_bytes, opcodes, and
+   sender_opcodes are as in get_nulldata_txs_in_blocks().
+   
+   Returns [(block_number, [txs])], just like get_nulldata_txs_in_blocks().
+   """
+   
+   from multiprocessing.pool import ThreadPool
+   
+   if max_concurrency is None:
+      max_concurrency = configure_rpc_pool( bitcoind_opts )
+      if max_concurrency <= 0:
+         max_concurrency = RPC_POOL_SIZE
+   
+   pooled_opts = {}
+   pooled_opts.update( bitcoind_opts )
+   pooled_opts['bitcoind_rpc_pool_size'] = max_concurrency
+   
+   threadpool = ThreadPool( max_concurrency )
+   try:
+      return get_nulldata_txs_in_blocks( threadpool, pooled_opts, blocks_ids, magic_bytes=magic_bytes, opcodes=opcodes, sender_opcodes=sender_opcodes )
+   
+   finally:
+      threadpool.terminate()
+      threadpool.join()
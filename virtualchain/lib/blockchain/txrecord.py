@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+"""
+Records of the nulldata transactions that get_nulldata_txs_in_blocks()
+hands to the state engine, and compact encodings of transactions'
+inputs and outputs.
+
+A NulldataTx keeps a transaction's txid, txindex, nulldata, senders,
+fee, size, inputs, and outputs, and can be read like the dict it
+replaces (i.e. tx['vin'], tx['vout'], tx['senders']).  Its inputs and
+outputs are bitcoind's, exactly as they came back, since they are handed
+to db_parse() and stored in each operation's virtualchain_outputs.
+
+bitcoind's verbose transactions carry a lot that sender lookups never
+look at (every input's scriptSig and witness, every output's asm, and
+so on), and a range of blocks can hold thousands of them at once.  So
+the transactions that are only needed for their outputs are kept
+compactly inside the fetch pipeline:
+
+* the outpoint each input spends (or the coinbase, if it is one);
+* each output's value, number, script, script type, and address(es).
+
+A NulldataTx can keep its inputs and outputs that way too, if configured
+to (see configure_compact_tx_records()).  It then hands db_parse() only
+those fields, so this is only for implementations that don't read
+(or serialize) any others.  Script types and addresses are interned, so
+transactions that pay to the same addresses share one copy of each string.
+
+Pool workers can also trim what they hand back before it ever reaches
+the indexing process:  filter_nulldata_txs() drops the transactions
+without nulldata, and trims the ones with it.
+"""
+
+import types
+import decimal
+import binascii
+
+from .nulldata import get_nulldata, is_virtualchain_nulldata
+
+SATOSHIS_PER_COIN = decimal.Decimal(10**8)
+COIN_PRECISION = decimal.Decimal("0.00000001")    # bitcoind writes values with 8 decimal places
+
+# script types are few, so they can be interned for the life of the process
+script_types = {}
+
+
+def intern_string( s, strings ):
+   """
+   Get the copy of s in strings (adding it if there isn't one).
+   Works for unicode strings too (unlike intern()).
+   """
+   if s is None:
+      return None
+
+   return strings.setdefault( s, s )
+
+
+def satoshis_to_value( satoshis ):
+   """
+   Get an amount in satoshis as bitcoind writes it (i.e. Decimal("50.00000000")).
+   """
+   return (decimal.Decimal(satoshis) / SATOSHIS_PER_COIN).quantize( COIN_PRECISION )
+
+
+def compact_outputs( outputs, strings=None ):
+   """
+   Get a bitcoind transaction's outputs as a tuple of
+   (value in satoshis, n, (script hex, script type, addresses)) tuples.
+   The value, or the script, is None if the output doesn't have one.
+   The addresses are a tuple if bitcoind gave a list of them, and a
+   string if it gave a single address (as newer versions do).
+   If strings is given, addresses are interned in it.
+   """
+   compact = []
+   for i in xrange(0, len(outputs)):
+      output = outputs[i]
+      script_pubkey = output.get('scriptPubKey', None)
+      value = int(output['value'] * 10**8) if 'value' in output else None
+
+      if script_pubkey is None:
+         compact.append( (value, output.get('n', i), None) )
+         continue
+
+      # newer versions of bitcoind give a single address instead of a list
+      addresses = script_pubkey.get('addresses', None)
+      if addresses is not None:
+         if strings is not None:
+            addresses = tuple( [intern_string( address, strings ) for address in addresses] )
+         else:
+            addresses = tuple( addresses )
+
+      elif script_pubkey.get('address', None) is not None:
+         addresses = script_pubkey['address']
+         if strings is not None:
+            addresses = intern_string( addresses, strings )
+
+      script_type = intern_string( script_pubkey.get('type', None), script_types )
+      compact.append( (value, output.get('n', i), (script_pubkey.get('hex', None), script_type, addresses)) )
+
+   return tuple( compact )
+
+
+def expand_outputs( compact ):
+   """
+   Get outputs encoded with compact_outputs() back in bitcoind's form
+   (but with only the encoded fields).
+   """
+   outputs = []
+   for (value, n, script) in compact:
+      output = {"n": n}
+      if value is not None:
+         output['value'] = satoshis_to_value( value )
+
+      if script is not None:
+         script_hex, script_type, addresses = script
+         output['scriptPubKey'] = {"hex": script_hex, "type": script_type}
+         if type(addresses) == types.TupleType:
+            output['scriptPubKey']['addresses'] = list(addresses)
+         elif addresses is not None:
+            output['scriptPubKey']['address'] = addresses
+
+      outputs.append( output )
+
+   return outputs
+
+
+def compact_inputs( inputs ):
+   """
+   Get a bitcoind transaction's inputs as a tuple of the
+   (txid, vout) outpoints they spend.  A coinbase input is
+   given by its coinbase (a hex string) instead.
+   """
+   compact = []
+   for input in inputs:
+      if 'txid' in input and 'vout' in input:
+         compact.append( (input['txid'], input['vout']) )
+      else:
+         compact.append( input.get('coinbase', "") )
+
+   return tuple( compact )
+
+
+def expand_inputs( compact ):
+   """
+   Get inputs encoded with compact_inputs() back in bitcoind's form
+   (but with only the encoded fields).
+   """
+   inputs = []
+   for outpoint in compact:
+      if type(outpoint) == types.TupleType:
+         inputs.append( {"txid": outpoint[0], "vout": outpoint[1]} )
+      else:
+         inputs.append( {"coinbase": outpoint} )
+
+   return inputs
+
+
+def get_tx_size( tx ):
+   """
+   Get the size of a bitcoind transaction in bytes,
+   if bitcoind told us (None if not).
+   """
+   if tx.get('size', None) is not None:
+      return tx['size']
+
+   if tx.get('hex', None) is not None:
+      return len(tx['hex']) / 2
+
+   return None
+
+
+def trim_output( output ):
+   """
+   Get a copy of a bitcoind transaction output with only
+   its value, number, script hex, script type, and addresses.
+   """
+   trimmed = {}
+   for key in ('value', 'n'):
+      if key in output:
+         trimmed[key] = output[key]
+
+   if 'scriptPubKey' in output:
+      script_pubkey = output['scriptPubKey']
+      trimmed['scriptPubKey'] = dict( [(key, script_pubkey[key]) for key in ('hex', 'type', 'addresses', 'address') if key in script_pubkey] )
+
+   return trimmed
+
+
+def trim_input( input ):
+   """
+   Get a copy of a bitcoind transaction input with only the
+   outpoint it spends (and the output itself, trimmed, if
+   bitcoind gave it), or its coinbase.
+   """
+   if 'txid' in input and 'vout' in input:
+      trimmed = {"txid": input['txid'], "vout": input['vout']}
+      if 'prevout' in input:
+         trimmed['prevout'] = trim_output( input['prevout'] )
+
+      return trimmed
+
+   return {"coinbase": input.get('coinbase', "")}
+
+
+def trim_nulldata_tx( tx, nulldata, compact=False ):
+   """
+   Get a copy of a bitcoind transaction (with nulldata) with only
+   what sender lookups and NulldataTx need:  its txid, size, nulldata,
+   inputs, and outputs.
+
+   If compact is True, its inputs are trimmed down to the outpoints
+   they spend (and the outputs themselves, if bitcoind gave them), and
+   its outputs as trim_output() does.  Otherwise, they are left alone.
+   """
+   if not compact:
+      inputs = tx.get('vin', [])
+      outputs = tx.get('vout', [])
+
+   else:
+      inputs = [trim_input( input ) for input in tx.get('vin', [])]
+      outputs = [trim_output( output ) for output in tx.get('vout', [])]
+
+   try:
+      nulldata_bin = binascii.unhexlify( nulldata )
+   except Exception:
+      # not hex; leave it to the indexing process to complain about
+      nulldata_bin = None
+
+   return {
+      "txid": tx['txid'],
+      "size": get_tx_size( tx ),
+      "vin": inputs,
+      "vout": outputs,
+      "nulldata": nulldata,
+      "nulldata_bin": nulldata_bin
+   }
+
+
+class FilteredTxs( object ):
+   """
+   What a pool worker hands back for a list of transactions
+   once it has filtered out the ones without nulldata
+   (see filter_nulldata_txs()).
+   """
+
+   def __init__( self, count, nulldata_txs, others, dropped=0 ):
+      self.count = count                   # number of transactions (including the ones filtered out)
+      self.nulldata_txs = nulldata_txs     # [(index in the list, trimmed transaction)]
+      self.others = others                 # [(txid, compact inputs or None, compact outputs)] of the ones kept for their outputs
+      self.dropped = dropped               # number of transactions with nulldata that didn't match the prefilter
+
+
+   def __len__( self ):
+      return self.count
+
+
+   def get_index_txs( self ):
+      """
+      Get all of the transactions that were kept, in the form
+      the prevout index records them in.
+      """
+      txs = [tx for (_, tx) in self.nulldata_txs]
+      for (txid, inputs, outputs) in self.others:
+         txs.append( {"txid": txid, "vin": expand_inputs( inputs or () ), "vout": expand_outputs( outputs )} )
+
+      return txs
+
+
+def filter_nulldata_txs( txs, keep_all=False, prefilter=None, compact=False ):
+   """
+   Filter a list of transactions from bitcoind (some may be None)
+   down to the ones with nulldata, trimmed (see trim_nulldata_tx();
+   compact says whether to trim their inputs and outputs too).
+   If prefilter is given, it is (magic bytes, opcodes), and only the
+   ones whose nulldata could be a virtual chain operation are kept
+   (see is_virtualchain_nulldata()).
+   Meant to be called in a pool worker.
+
+   Of the others, keep the outputs of the ones that the nulldata
+   transactions spend, so their senders can be found without
+   fetching them again.  If keep_all is True, keep the inputs and
+   outputs of all of them (i.e. for the prevout index).
+
+   Return a FilteredTxs.
+   """
+   nulldata_txs = []
+   spent_txids = set()
+   others = []
+   dropped = 0
+
+   for k in xrange(0, len(txs)):
+      tx = txs[k]
+      if tx is None:
+         continue
+
+      nulldata = get_nulldata( tx )
+      if nulldata is None:
+         continue
+
+      if prefilter is not None and not is_virtualchain_nulldata( nulldata, prefilter[0], prefilter[1] ):
+         dropped += 1
+         continue
+
+      nulldata_txs.append( (k, trim_nulldata_tx( tx, nulldata, compact=compact )) )
+      for input in tx.get('vin', []):
+         if 'txid' in input and 'prevout' not in input:
+            spent_txids.add( input['txid'] )
+
+   nulldata_indexes = set( [k for (k, _) in nulldata_txs] )
+   for k in xrange(0, len(txs)):
+      tx = txs[k]
+      if tx is None or k in nulldata_indexes or 'txid' not in tx:
+         continue
+
+      if keep_all:
+         others.append( (tx['txid'], compact_inputs( tx.get('vin', []) ), compact_outputs( tx.get('vout', []) )) )
+
+      elif tx['txid'] in spent_txids:
+         others.append( (tx['txid'], None, compact_outputs( tx.get('vout', []) )) )
+
+   return FilteredTxs( len(txs), nulldata_txs, others, dropped=dropped )
+
+
+class NulldataTx( object ):
+   """
+   A nulldata transaction, as handed to the state engine.
+   """
+
+   __slots__ = ('txid', 'txindex', 'nulldata', 'nulldata_bin', 'senders', 'fee', 'size', 'vin', 'vout', 'compact')
+
+   # keys the dict view has, besides "vin" and "vout"
+   FIELDS = ('txid', 'txindex', 'nulldata', 'nulldata_bin', 'senders', 'fee', 'size')
+
+   def __init__( self, tx, nulldata, nulldata_bin, senders, fee, txindex=None, strings=None, compact=False ):
+      """
+      Make a record of the bitcoind transaction tx.  If compact is True,
+      keep its inputs and outputs compactly (see compact_inputs() and
+      compact_outputs()), and intern its outputs' addresses in strings,
+      if given.  Otherwise, keep them as they are.
+      """
+      self.txid = tx['txid']
+      self.txindex = txindex
+      self.nulldata = nulldata
+      self.nulldata_bin = nulldata_bin
+      self.senders = senders
+      self.fee = fee
+      self.size = get_tx_size( tx )
+      self.compact = compact
+
+      if compact:
+         self.vin = compact_inputs( tx.get('vin', []) )
+         self.vout = compact_outputs( tx.get('vout', []), strings=strings )
+      else:
+         self.vin = tx.get('vin', [])
+         self.vout = tx.get('vout', [])
+
+
+   @property
+   def inputs( self ):
+      """
+      The inputs, in bitcoind's form.  If they are kept
+      compactly, this is a new list each time.
+      """
+      if self.compact:
+         return expand_inputs( self.vin )
+
+      return self.vin
+
+
+   @property
+   def outputs( self ):
+      """
+      The outputs, in bitcoind's form.  If they are kept
+      compactly, this is a new list each time.
+      """
+      if self.compact:
+         return expand_outputs( self.vout )
+
+      return self.vout
+
+
+   def __getitem__( self, key ):
+      if key == 'vin':
+         return self.inputs
+
+      if key == 'vout':
+         return self.outputs
+
+      if key in NulldataTx.FIELDS:
+         return getattr( self, key )
+
+      raise KeyError(key)
+
+
+   def __setitem__( self, key, value ):
+      if key not in NulldataTx.FIELDS:
+         raise KeyError(key)
+
+      setattr( self, key, value )
+
+
+   def __contains__( self, key ):
+      return key in ('vin', 'vout') or key in NulldataTx.FIELDS
+
+
+   def has_key( self, key ):
+      return key in self
+
+
+   def get( self, key, default=None ):
+      if key not in self:
+         return default
+
+      return self[key]
+
+
+   def keys( self ):
+      return list(NulldataTx.FIELDS) + ['vin', 'vout']
+
+
+   def to_dict( self ):
+      """
+      Get the whole record as a dict, in the form it replaces.
+      """
+      return dict( [(key, self[key]) for key in self.keys()] )
+
+
+   def __getstate__( self ):
+      return [getattr( self, field ) for field in NulldataTx.__slots__]
+
+
+   def __setstate__( self, state ):
+      for (field, value) in zip( NulldataTx.__slots__, state ):
+         setattr( self, field, value )
+
+
+   def __eq__( self, other ):
+      if not isinstance( other, NulldataTx ):
+         return NotImplemented
+
+      return self.__getstate__() == other.__getstate__()
+
+
+   def __ne__( self, other ):
+      eq = self.__eq__( other )
+      if eq is NotImplemented:
+         return eq
+
+      return not eq
+
+
+   def __repr__( self ):
+      return "NulldataTx(%r)" % self.to_dict()
@@ -37,8 +37,63 @@ RPC_TIMEOUT = 5  # seconds
 
 MULTIPROCESS_RPC_RETRY = 10
 
+RPC_DEADLINE = 300              # give up on a bitcoind query (including its retries) after this many seconds
+RPC_RETRY_BASE_DELAY = 0.5      # wait up to this long before the first retry; the limit doubles with each retry
+RPC_RETRY_MAX_DELAY = 30        # never wait longer than this between retries
+
+RPC_HEDGE_PERCENTILE = 95       # re-issue a query that has taken longer than this percentile of recent ones of its kind (0 to disable)
+RPC_HEDGE_MIN_DELAY = 0.5       # ...but never sooner than this many seconds after issuing it
+
+RPC_BREAKER_FAILURES = 5        # stop querying a bitcoind that has failed this many times in a row...
+RPC_BREAKER_TIMEOUT = 5         # ...for this many seconds (doubling each time it is still down, up to RPC_BREAKER_MAX_TIMEOUT)
+RPC_BREAKER_MAX_TIMEOUT = 60
+
+RPC_BATCH_SIZE = 100     # maximum number of RPCs to send to bitcoind in one JSON-RPC batch request
+
+RPC_CACHE_MAX_SIZE = 0                      # maximum size of the on-disk cache of blocks and transactions, in bytes (0 to disable; worth enabling when reindexing)
+RPC_CACHE_MIN_CONFIRMATIONS = 6             # only cache a height's block hash once it has this many confirmations
+
+SENDER_CACHE_SIZE = 100000                  # maximum number of resolved transaction outputs to remember in RAM (0 to disable)
+
+PREVOUT_INDEX = False                       # keep a local index of transaction outputs, so senders can be found without bitcoind's txindex
+PREVOUT_INDEX_PRUNE_DEPTH = 100             # forget spent outputs once the spending block has this many confirmations
+
+WORKPOOL_BACKEND = "process"      # how to run bitcoind queries in parallel:  "process", "thread", or "inline" (no parallelism)
+WORKPOOL_BACKENDS = ["process", "thread", "inline"]
+
+WORKPOOL_RESULT_TRANSFER = "auto"     # how process pool workers hand back fetched transactions:  "pickle" (through the pool), "shm" (through shared memory), or "auto" ("shm" if we have somewhere to put it)
+WORKPOOL_RESULT_TRANSFERS = ["auto", "pickle", "shm"]
+WORKPOOL_SHM_DIR = "/dev/shm"         # memory-backed directory to put shared memory segments in
+WORKPOOL_FILTER_TXS = True            # have pool workers drop the transactions without nulldata, instead of handing them all back
+
+COMPACT_TX_RECORDS = False     # keep only the outpoints, values, scripts and addresses of nulldata transactions' inputs and outputs (less memory, but db_parse() and virtualchain_outputs see only those fields)
+
+RPC_PROBE_INTERVAL = 10     # check that a bitcoind connection is still alive if it has been idle for this many seconds
+RPC_IDLE_TIMEOUT = 300      # replace a bitcoind connection if it has been idle for this many seconds
+
+RPC_POOL_SIZE = 64       # maximum number of concurrent RPCs (and persistent bitcoind connections) when fetching with a pooled RPC client
+
+ADAPTIVE_CONCURRENCY = False       # tune concurrency and slice length to bitcoind's observed latency and error rate while building
+ADAPTIVE_CONCURRENCY_MAX = 32      # most bitcoind queries to have in flight at once, when tuning (and the size of the workpool)
+ADAPTIVE_SLICE_LEN_MAX = 1024      # most blocks to fetch per slice, when tuning
+
+FETCH_MEMORY_CEILING = None    # most bytes of blocks (as serialized) to hold at once while fetching a slice of them (None for no ceiling)
+FETCH_TX_BUDGET = None         # most transactions to hold at once while fetching a slice of blocks (None for no limit)
+
+BUILD_PIPELINE_DEPTH = 2    # number of fetched ranges of blocks that can wait to be processed (0 to fetch and process in strict alternation)
+
+GETBLOCK_VERBOSITY = 3   # ask bitcoind for decoded transactions (and the outputs they spend) inline with each block, if it can (0 to fetch raw blocks and decode them ourselves)
+BITCOIND_USE_REST = False   # when fetching raw blocks, get them in binary over bitcoind's REST interface (needs bitcoind -rest), falling back to RPC
+BITCOIN_NETWORK = "mainnet"     # which network's address formats to use when decoding raw transactions ("mainnet", "testnet", or "regtest")
+BITCOIND_BLOCKS_DIR = None      # read blocks straight out of bitcoind's blk*.dat files in this directory (only if bitcoind is on this host)
+
 REINDEX_FREQUENCY = 10  # in seconds
 
+BLOCK_NOTIFY = "auto"           # how to find out about new blocks:  "zmq", "longpoll" (waitforblockheight), "poll", or "auto" (the first one that works)
+BLOCK_NOTIFY_METHODS = ["auto", "zmq", "longpoll", "poll"]
+BITCOIND_ZMQ_HASHBLOCK = None   # bitcoind's -zmqpubhashblock address (i.e. "tcp://127.0.0.1:28332"), for "zmq"
+BLOCK_NOTIFY_TIMEOUT = 20       # when notified of new blocks, check for them anyway this often, in seconds (keep it below the RPC HTTP timeout)
+
 AVERAGE_MINUTES_PER_BLOCK = 10
 DAYS_PER_YEAR = 365.2424
 HOURS_PER_DAY = 24
@@ -157,8 +212,473 @@ def configure_multiprocessing( bitcoind_opts ):
    else:
       # running remotely 
       return (8, 8)
+
+
+def configure_adaptive_concurrency( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not
+   to tune concurrency and slice length as we build, within
+   what bounds, and where to save the tuned settings.
+
+   Return (enabled?, max concurrency, max slice length, path to saved settings)
+   The path is None if there is no working directory, or if tuning is disabled.
+   """
+
+   enabled = ADAPTIVE_CONCURRENCY
+   max_concurrency = ADAPTIVE_CONCURRENCY_MAX
+   max_slice_len = ADAPTIVE_SLICE_LEN_MAX
+   path = None
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("adaptive_concurrency", None) is not None:
+         enabled = bool(bitcoind_opts["adaptive_concurrency"])
+
+      if bitcoind_opts.get("adaptive_concurrency_max", None) is not None:
+         max_concurrency = int(bitcoind_opts["adaptive_concurrency_max"])
+
+      if bitcoind_opts.get("adaptive_slice_len_max", None) is not None:
+         max_slice_len = int(bitcoind_opts["adaptive_slice_len_max"])
+
+      path = bitcoind_opts.get("adaptive_concurrency_state", None)
+
+   if enabled and path is None and IMPL is not None:
+      path = os.path.join( get_working_dir(), IMPL.get_virtual_chain_name(testset=TESTSET) + ".tuning" )
+
+   return (enabled, max_concurrency, max_slice_len, path)
+
+
+def configure_fetch_budget( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how much block data
+   to hold at once while fetching a slice of blocks (see
+   FETCH_MEMORY_CEILING and FETCH_TX_BUDGET).  Slices end
+   early rather than go over either limit.
+
+   Return (most bytes, most transactions); either is None if there is no limit.
+   """
+
+   max_bytes = FETCH_MEMORY_CEILING
+   max_txs = FETCH_TX_BUDGET
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("fetch_memory_ceiling", None) is not None:
+         max_bytes = int(bitcoind_opts["fetch_memory_ceiling"])
+
+      if bitcoind_opts.get("fetch_tx_budget", None) is not None:
+         max_txs = int(bitcoind_opts["fetch_tx_budget"])
+
+   if max_bytes is not None and max_bytes <= 0:
+      max_bytes = None
+
+   if max_txs is not None and max_txs <= 0:
+      max_txs = None
+
+   return (max_bytes, max_txs)
+
+
+def configure_workpool_backend( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how to 
+   run bitcoind queries in parallel (see WORKPOOL_BACKENDS).
+   """
+
+   if bitcoind_opts is None or bitcoind_opts.get("workpool_backend", None) is None:
+      return WORKPOOL_BACKEND
+
+   backend = bitcoind_opts["workpool_backend"]
+   if backend not in WORKPOOL_BACKENDS:
+      raise Exception("Invalid workpool backend '%s' (expected one of %s)" % (backend, ", ".join(WORKPOOL_BACKENDS)))
+
+   return backend
+
+
+def configure_result_transfer( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how pool workers
+   should hand fetched transactions back (see WORKPOOL_RESULT_TRANSFERS
+   and blockchain/sharedmem.py).  Only process pools use shared memory;
+   threads can hand back their results as they are.
+
+   Return (method, shared memory directory), where the method is 
+   "pickle" or "shm", and the directory is None unless it is "shm".
+   """
+
+   method = WORKPOOL_RESULT_TRANSFER
+   shm_dir = WORKPOOL_SHM_DIR
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("workpool_result_transfer", None) is not None:
+         method = bitcoind_opts["workpool_result_transfer"]
+
+      if bitcoind_opts.get("workpool_shm_dir", None) is not None:
+         shm_dir = bitcoind_opts["workpool_shm_dir"]
+
+   if method not in WORKPOOL_RESULT_TRANSFERS:
+      raise Exception("Invalid workpool result transfer method '%s' (expected one of %s)" % (method, ", ".join(WORKPOOL_RESULT_TRANSFERS)))
+
+   if configure_workpool_backend( bitcoind_opts ) != "process":
+      return ("pickle", None)
+
+   if method == "auto":
+      if os.path.isdir( shm_dir ) and os.access( shm_dir, os.W_OK ):
+         method = "shm"
+      else:
+         method = "pickle"
+
+   elif method == "shm" and not os.path.isdir( shm_dir ):
+      raise Exception("No such shared memory directory '%s'" % shm_dir)
+
+   if method == "pickle":
+      return ("pickle", None)
+
+   return (method, shm_dir)
+
+
+def configure_rpc_batching( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how many RPCs
+   to pack into a single JSON-RPC batch request.
+
+   Return 1 if batching is disabled.
+   """
+
+   if bitcoind_opts is None:
+      return RPC_BATCH_SIZE
+
+   batch_size = bitcoind_opts.get("bitcoind_rpc_batch_size", None)
+   if batch_size is None:
+      return RPC_BATCH_SIZE
+
+   return max(1, int(batch_size))
+
+
+def configure_getblock_verbosity( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide which getblock
+   verbosity to ask for.  1 means fetch the block's txids and then
+   each transaction separately; 2 means get decoded transactions
+   inline with the block; 3 means also get each input's previous 
+   output inline, so senders and fees can be found without fetching
+   input transactions (bitcoind falls back to lower verbosities if it can't).
+   0 means get the serialized block, and decode it in-process.
+   """
+
+   if bitcoind_opts is None:
+      return GETBLOCK_VERBOSITY
+
+   verbosity = bitcoind_opts.get("bitcoind_getblock_verbosity", None)
+   if verbosity is None:
+      return GETBLOCK_VERBOSITY
+
+   return max(0, int(verbosity))
+
+
+def configure_worker_filtering( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not pool
+   workers should filter out the transactions without nulldata
+   before handing fetched transactions back (see WORKPOOL_FILTER_TXS).
+
+   Return True if so.
+   """
+
+   filter_txs = WORKPOOL_FILTER_TXS
+   if bitcoind_opts is not None and bitcoind_opts.get("workpool_filter_txs", None) is not None:
+      filter_txs = bool(bitcoind_opts["workpool_filter_txs"])
+
+   return filter_txs
+
+
+def configure_compact_tx_records( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not to keep
+   nulldata transactions' inputs and outputs compactly (see COMPACT_TX_RECORDS).
+   Only for implementations whose db_parse() reads no other input or
+   output fields, and that don't serialize virtualchain_outputs whole.
+
+   Return True if so.
+   """
+
+   compact = COMPACT_TX_RECORDS
+   if bitcoind_opts is not None and bitcoind_opts.get("compact_tx_records", None) is not None:
+      compact = bool(bitcoind_opts["compact_tx_records"])
+
+   return compact
+
+
+def configure_raw_blocks( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how to fetch
+   and decode raw blocks (i.e. with getblock verbosity 0).
+
+   Return (use REST?, bitcoin network name)
+   """
+
+   use_rest = BITCOIND_USE_REST
+   network = BITCOIN_NETWORK
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("bitcoind_use_rest", None) is not None:
+         use_rest = bool(bitcoind_opts["bitcoind_use_rest"])
+
+      if bitcoind_opts.get("bitcoind_network", None) is not None:
+         network = bitcoind_opts["bitcoind_network"]
+
+   if network not in ["mainnet", "testnet", "regtest"]:
+      raise Exception("Invalid bitcoin network '%s'" % network)
+
+   return (use_rest, network)
    
 
+def configure_block_files( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not
+   to read blocks directly from bitcoind's block files
+   (i.e. its "blocks" directory, with the blk*.dat files).
+
+   Return the path to the blocks directory.
+   Return None if blocks should be fetched from bitcoind instead.
+   """
+
+   blocks_dir = BITCOIND_BLOCKS_DIR
+   if bitcoind_opts is not None and bitcoind_opts.get("bitcoind_blocks_dir", None) is not None:
+      blocks_dir = bitcoind_opts["bitcoind_blocks_dir"]
+
+   if not blocks_dir:
+      return None
+
+   return os.path.expanduser( blocks_dir )
+
+
+def configure_rpc_cache( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide where to cache
+   bitcoind's blocks and transactions on disk, and how much to cache.
+
+   The cache is off unless rpc_cache_max_size is set.  It only pays for
+   itself when the same blocks get fetched again, e.g. when reindexing
+   from scratch (set it to a few GB for that); during an ordinary sync,
+   each block is fetched once, so caching it only costs disk I/O.
+
+   Return (cache directory, maximum size in bytes)
+   Return (None, 0) if caching is disabled, or if there is no working directory.
+   """
+
+   max_size = RPC_CACHE_MAX_SIZE
+   cache_dir = None
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("rpc_cache_max_size", None) is not None:
+         max_size = int(bitcoind_opts["rpc_cache_max_size"])
+
+      cache_dir = bitcoind_opts.get("rpc_cache_dir", None)
+
+   if max_size <= 0:
+      return (None, 0)
+
+   if cache_dir is None:
+      if IMPL is None:
+         return (None, 0)
+
+      cache_dir = os.path.join( get_working_dir(), "rpc_cache" )
+
+   return (cache_dir, max_size)
+
+
+def configure_sender_cache( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how many resolved
+   transaction outputs (i.e. senders and amounts) to remember.
+
+   Return 0 if the cache is disabled.
+   """
+
+   if bitcoind_opts is None or bitcoind_opts.get("sender_cache_size", None) is None:
+      return SENDER_CACHE_SIZE
+
+   return max(0, int(bitcoind_opts["sender_cache_size"]))
+
+
+def configure_prevout_index( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not
+   to keep a local index of transaction outputs, and where.
+   The "prevout_index" option can be a boolean or a path.
+
+   Return the path to the index.
+   Return None if it is disabled, or if there is no working directory.
+   """
+
+   prevout_index = PREVOUT_INDEX
+   if bitcoind_opts is not None and bitcoind_opts.get("prevout_index", None) is not None:
+      prevout_index = bitcoind_opts["prevout_index"]
+
+   if not prevout_index:
+      return None
+
+   if type(prevout_index) in [str, unicode]:
+      return prevout_index
+
+   if IMPL is None:
+      return None
+
+   return os.path.join( get_working_dir(), IMPL.get_virtual_chain_name(testset=TESTSET) + ".prevouts" )
+
+
+def configure_rpc_connection_lifecycle( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide when to check
+   an idle bitcoind connection before reusing it, and when 
+   to give up on it and reconnect.
+
+   Return (probe interval, idle timeout), in seconds.
+   """
+
+   probe_interval = RPC_PROBE_INTERVAL
+   idle_timeout = RPC_IDLE_TIMEOUT
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("bitcoind_rpc_probe_interval", None) is not None:
+         probe_interval = float(bitcoind_opts["bitcoind_rpc_probe_interval"])
+
+      if bitcoind_opts.get("bitcoind_rpc_idle_timeout", None) is not None:
+         idle_timeout = float(bitcoind_opts["bitcoind_rpc_idle_timeout"])
+
+   return (probe_interval, idle_timeout)
+
+
+def configure_rpc_retry( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how hard to 
+   try to get an answer to a bitcoind query.
+
+   Return (max attempts, deadline, base delay, max delay), in seconds.
+   """
+
+   max_attempts = MULTIPROCESS_RPC_RETRY
+   deadline = RPC_DEADLINE
+   base_delay = RPC_RETRY_BASE_DELAY
+   max_delay = RPC_RETRY_MAX_DELAY
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("bitcoind_rpc_max_attempts", None) is not None:
+         max_attempts = max(1, int(bitcoind_opts["bitcoind_rpc_max_attempts"]))
+
+      if bitcoind_opts.get("bitcoind_rpc_deadline", None) is not None:
+         deadline = float(bitcoind_opts["bitcoind_rpc_deadline"])
+
+      if bitcoind_opts.get("bitcoind_rpc_retry_delay", None) is not None:
+         base_delay = float(bitcoind_opts["bitcoind_rpc_retry_delay"])
+
+      if bitcoind_opts.get("bitcoind_rpc_retry_max_delay", None) is not None:
+         max_delay = float(bitcoind_opts["bitcoind_rpc_retry_max_delay"])
+
+   return (max_attempts, deadline, base_delay, max_delay)
+
+
+def configure_rpc_hedging( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide when to re-issue
+   a bitcoind query that is taking longer than usual.
+
+   Return (latency percentile, minimum delay in seconds).
+   The percentile is 0 if queries should not be re-issued.
+   """
+
+   percentile = RPC_HEDGE_PERCENTILE
+   min_delay = RPC_HEDGE_MIN_DELAY
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("bitcoind_rpc_hedge_percentile", None) is not None:
+         percentile = max(0, min( 100, float(bitcoind_opts["bitcoind_rpc_hedge_percentile"]) ))
+
+      if bitcoind_opts.get("bitcoind_rpc_hedge_min_delay", None) is not None:
+         min_delay = float(bitcoind_opts["bitcoind_rpc_hedge_min_delay"])
+
+   return (percentile, min_delay)
+
+
+def configure_rpc_breaker( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide when to stop 
+   querying a bitcoind that appears to be down.
+
+   Return (consecutive failures, timeout, max timeout), in seconds.
+   The number of failures is 0 if we should never stop.
+   """
+
+   failures = RPC_BREAKER_FAILURES
+   timeout = RPC_BREAKER_TIMEOUT
+   max_timeout = RPC_BREAKER_MAX_TIMEOUT
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("bitcoind_rpc_breaker_failures", None) is not None:
+         failures = max(0, int(bitcoind_opts["bitcoind_rpc_breaker_failures"]))
+
+      if bitcoind_opts.get("bitcoind_rpc_breaker_timeout", None) is not None:
+         timeout = float(bitcoind_opts["bitcoind_rpc_breaker_timeout"])
+         max_timeout = max( timeout, max_timeout )
+
+   return (failures, timeout, max_timeout)
+
+
+def configure_rpc_pool( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide whether or not
+   each process should share one pool of persistent bitcoind 
+   connections between its threads, and how big it should be.
+
+   Return 0 if each process should use a single connection.
+   """
+
+   if bitcoind_opts is None or bitcoind_opts.get("bitcoind_rpc_pool_size", None) is None:
+      return 0
+
+   return max(0, int(bitcoind_opts["bitcoind_rpc_pool_size"]))
+
+
+def configure_build_pipeline( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how many ranges of
+   blocks to fetch ahead of the one being processed.
+
+   Return 0 if fetching and processing should not overlap.
+   """
+
+   if bitcoind_opts is None or bitcoind_opts.get("build_pipeline_depth", None) is None:
+      return BUILD_PIPELINE_DEPTH
+
+   return max(0, int(bitcoind_opts["build_pipeline_depth"]))
+
+
+def configure_block_notify( bitcoind_opts ):
+   """
+   Given the set of bitcoind options, decide how to find out
+   about new blocks while running.
+
+   Return (method, ZMQ hashblock address, timeout in seconds).
+   """
+
+   method = BLOCK_NOTIFY
+   zmq_address = BITCOIND_ZMQ_HASHBLOCK
+   timeout = BLOCK_NOTIFY_TIMEOUT
+
+   if bitcoind_opts is not None:
+      if bitcoind_opts.get("block_notify", None) is not None:
+         method = bitcoind_opts["block_notify"]
+
+      if bitcoind_opts.get("bitcoind_zmq_hashblock", None) is not None:
+         zmq_address = bitcoind_opts["bitcoind_zmq_hashblock"]
+
+      if bitcoind_opts.get("block_notify_timeout", None) is not None:
+         timeout = float(bitcoind_opts["block_notify_timeout"])
+
+   if method not in BLOCK_NOTIFY_METHODS:
+      raise Exception("Invalid block notification method '%s' (expected one of %s)" % (method, ", ".join(BLOCK_NOTIFY_METHODS)))
+
+   return (method, zmq_address, timeout)
+
+
 def get_bitcoind_config( config_file=None ):
    """
    Set bitcoind options globally.
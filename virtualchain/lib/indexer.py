@@ -42,6 +42,7 @@ import pybitcoin
 import copy
 import shutil
 import time
+import Queue
 
 from collections import defaultdict 
 
@@ -66,6 +67,9 @@ RESERVED_KEYS = [
    'virtualchain_txindex'
 ]
 
+# how long to wait for the background fetcher to notice that a build is over
+FETCH_THREAD_JOIN_TIMEOUT = 30      # seconds
+
 class StateEngine( object ):
     """
     Client to the virtual chain's database of operations, constructed and  
@@ -151,11 +155,18 @@ class StateEngine( object ):
         self.lastblock = self.impl.get_first_block_id() - 1
         self.pool = None
         self.rejected = {}
+        self.fetch_stop = None     # set to stop the build in progress (a threading.Event), if there is one
 
         if self.op_order is None:
             self.op_order = self.impl.get_op_processing_order()[:]
             if self.op_order is None:
                 self.op_order = opcodes
+        
+        # the opcodes whose senders and fee the implementation needs up front (None for all of them).
+        # the rest get a SenderResolver that they can resolve() on demand.
+        self.sender_opcodes = None
+        if hasattr( self.impl, "get_opcodes_needing_senders" ):
+            self.sender_opcodes = self.impl.get_opcodes_needing_senders()
        
         # there's always a 'final' operation type, to be processed last
         self.op_order.append('virtualchain_final')
@@ -470,8 +481,9 @@ class StateEngine( object ):
         Set the following fields in op:
         * virtualchain_opcode:   the operation code 
         * virtualchain_outputs:  the list of transaction outputs
-        * virtualchain_senders:  the list of transaction senders 
-        * virtualchain_fee:      the total amount of money sent
+        * virtualchain_senders:  the list of transaction senders (or a SenderResolver;
+                                 see get_opcodes_needing_senders() in the reference implementation)
+        * virtualchain_fee:      the total amount of money sent (None, if given a SenderResolver)
         * virtualchain_block_number:  the block ID in which this transaction occurred
         
         Return a dict representing the data on success.
@@ -479,10 +491,6 @@ class StateEngine( object ):
         """
         
         op_return_hex = tx['nulldata']
-        inputs = tx['vin']
-        outputs = tx['vout']
-        senders = tx['senders']
-        fee = tx['fee']
         
         if not is_hex(op_return_hex):
             # not a valid hex string 
@@ -509,6 +517,12 @@ class StateEngine( object ):
         # looks like a valid op.  Try to parse it.
         op_payload = op_return_bin[ len(self.magic_bytes)+1: ]
         
+        # (only now, since a compact transaction record builds these on demand)
+        inputs = tx['vin']
+        outputs = tx['vout']
+        senders = tx['senders']
+        fee = tx['fee']
+        
         op = self.impl.db_parse( block_id, op_code, op_payload, senders, inputs, outputs, fee, db_state=self.state )
         
         if op is None:
@@ -680,6 +694,205 @@ class StateEngine( object ):
     def __delete_me( cls, s ):
         del s
 
+    def process_blocks( self, block_id, block_ids_and_txs ):
+        """
+        Process a range of fetched blocks, in order by block ID.
+        block_id is the first block in the range, and block_ids_and_txs 
+        is the [(block_id, txs)] list from get_nulldata_txs_in_blocks().
+        
+        Return True on success
+        Return False on error
+        Raise an exception if we've already processed one of the blocks.
+        """
+        
+        # process in order by block ID
+        block_ids_and_txs.sort()
+       
+        for processed_block_id, txs in block_ids_and_txs:
+
+            if self.get_consensus_at( processed_block_id ) is not None:
+                raise Exception("Already processed block %s (%s)" % (processed_block_id, self.get_consensus_at( processed_block_id )) )
+
+            ops = self.parse_block( block_id, txs )
+            consensus_hash = self.process_block( processed_block_id, ops )
+            
+            log.debug("CONSENSUS(%s): %s" % (processed_block_id, self.get_consensus_at( processed_block_id )))
+            
+            if consensus_hash is None:
+                
+                # fatal error 
+                log.error("Failed to process block %d" % processed_block_id )
+                return False
+        
+        return True
+    
+    
+    def fetch_block_ranges( self, bitcoind_opts, block_ranges, fetch_queue, fetch_stop ):
+        """
+        Fetch the nulldata transactions for each range of blocks in block_ranges
+        (a list of (start, end) pairs), in order, and put the results into 
+        fetch_queue as (block_ids, block_ids_and_txs, exception) tuples.
+        Put None once all ranges have been fetched.
+        
+        Stops early on error, or once fetch_stop (a threading.Event) gets set,
+        even if it's waiting on the workpool at the time.
+        Meant to run in its own thread, while build() processes what it fetched.
+        """
+        
+        def enqueue( item ):
+            # don't block forever if the consumer goes away
+            while not fetch_stop.is_set():
+                try:
+                    fetch_queue.put( item, True, 1.0 )
+                    return True
+                except Queue.Full:
+                    continue
+                
+            return False
+        
+        for range_group in self.group_block_ranges( bitcoind_opts, block_ranges ):
+            
+            if fetch_stop.is_set() or self.pool is None:
+                return 
+            
+            try:
+                items = [(block_ids, block_ids_and_txs, None) for (block_ids, block_ids_and_txs) in self.fetch_block_range_group( bitcoind_opts, range_group, fetch_stop=fetch_stop )]
+                
+            except workpool.CompletionQueueStopped:
+                log.debug("Stopped fetching blocks at %s" % range_group[0][0])
+                return
+                
+            except Exception, e:
+                log.exception(e)
+                items = [(range( range_group[0][0], range_group[0][1] ), None, e)]
+                
+            for item in items:
+                if not enqueue( item ) or item[2] is not None:
+                    return 
+            
+        enqueue( None )
+            
+    
+    def group_block_ranges( self, bitcoind_opts, block_ranges ):
+        """
+        Group consecutive ranges of blocks in block_ranges (a list of (start, end) pairs)
+        into lists of ranges to fetch together, each with about as many blocks as
+        get_nulldata_txs_in_blocks() fetches per slice.  The number of blocks per 
+        group is decided when the group is needed, since it may get tuned as we go
+        (see tuning.py).  The ranges themselves are left alone.
+        """
+        
+        i = 0
+        while i < len(block_ranges):
+            
+            fetch_len = workpool.multiprocess_batch_size( bitcoind_opts )
+            range_group = [block_ranges[i]]
+            group_len = block_ranges[i][1] - block_ranges[i][0]
+            i += 1
+            
+            while i < len(block_ranges) and group_len + (block_ranges[i][1] - block_ranges[i][0]) <= fetch_len:
+                range_group.append( block_ranges[i] )
+                group_len += block_ranges[i][1] - block_ranges[i][0]
+                i += 1
+                
+            yield range_group
+            
+    
+    def fetch_block_range_group( self, bitcoind_opts, range_group, fetch_stop=None ):
+        """
+        Fetch the nulldata transactions for a list of consecutive ranges of blocks,
+        all at once.  Return them split up by range, as [(block_ids, block_ids_and_txs)].
+        Raise workpool.CompletionQueueStopped if fetch_stop (a threading.Event) gets set first.
+        """
+        
+        block_ids = range( range_group[0][0], range_group[-1][1] )
+        
+        stop = None
+        if fetch_stop is not None:
+            stop = fetch_stop.is_set
+        
+        # returns: [(block_id, txs)]
+        # (skip the transactions that can't be ours before looking up their senders)
+        block_ids_and_txs = transactions.get_nulldata_txs_in_blocks( self.pool, bitcoind_opts, block_ids, magic_bytes=self.magic_bytes, opcodes=self.opcodes, sender_opcodes=self.sender_opcodes, stop=stop )
+        
+        ret = []
+        for (start_block_id, end_block_id) in range_group:
+            ret.append( (range( start_block_id, end_block_id ), [(block_id, txs) for (block_id, txs) in block_ids_and_txs if block_id >= start_block_id and block_id < end_block_id]) )
+            
+        return ret
+        
+    
+    def build_pipelined( self, bitcoind_opts, block_ranges, pipeline_depth, fetch_stop ):
+        """
+        Process each range of blocks in block_ranges (a list of (start, end) pairs),
+        while fetching the next ranges in the background.  At most pipeline_depth
+        fetched ranges will be waiting to be processed at once.
+        
+        The fetcher stops once fetch_stop (a threading.Event) gets set.
+        It gets set when we're done, one way or another, and we wait for
+        the fetcher to exit before returning (so the caller can terminate
+        the workpool).
+        
+        Return True on success
+        Return False on error or interruption
+        Raise an exception if fetching or processing a range raised one.
+        """
+        
+        fetch_queue = Queue.Queue( maxsize=pipeline_depth )
+        
+        fetch_thread = threading.Thread( target=self.fetch_block_ranges, args=(bitcoind_opts, block_ranges, fetch_queue, fetch_stop) )
+        
+        # NOTE: don't let a fetcher that's stuck in an RPC keep the process alive
+        fetch_thread.daemon = True
+        fetch_thread.start()
+        
+        rc = True
+        
+        try:
+            while True:
+                
+                if self.pool is None:
+                    # interrupted 
+                    log.debug("Build interrupted")
+                    rc = False
+                    break
+                
+                try:
+                    item = fetch_queue.get( True, 1.0 )
+                except Queue.Empty:
+                    continue
+                
+                if item is None:
+                    # fetched everything 
+                    break 
+                
+                block_ids, block_ids_and_txs, exc = item 
+                if exc is not None:
+                    raise exc 
+                
+                rc = self.process_blocks( block_ids[0], block_ids_and_txs )
+                if not rc:
+                    break
+                
+        finally:
+            
+            # tell the fetcher to stop, and unblock it if it's waiting on us
+            fetch_stop.set()
+            
+            while True:
+                try:
+                    fetch_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                
+            # it notices within a second or so, unless it's in the middle of an RPC
+            fetch_thread.join( FETCH_THREAD_JOIN_TIMEOUT )
+            if fetch_thread.is_alive():
+                log.warning("Block fetcher did not stop within %s seconds" % FETCH_THREAD_JOIN_TIMEOUT)
+                
+        return rc
+        
+
     def build( self, bitcoind_opts, end_block_id ):
         """
         Top-level call to process all blocks in the blockchain.
@@ -691,6 +904,9 @@ class StateEngine( object ):
         Note that this method can take some time (hours, days) to complete 
         when called from the first block.
         
+        Unless the build pipeline depth is 0, the next ranges of blocks 
+        are fetched in the background while the current range is processed.
+        
         This method is *NOT* thread-safe.  However, it can be interrupted 
         with the "stop_build" method.
         
@@ -701,67 +917,78 @@ class StateEngine( object ):
         
         first_block_id = self.lastblock + 1 
         num_workers, worker_batch_size = config.configure_multiprocessing( bitcoind_opts )
+        pipeline_depth = config.configure_build_pipeline( bitcoind_opts )
 
         rc = True
 
         # the state can be big.  don't pass it to the slave processes
+        # (the "workpool_backend" option decides whether we use processes, threads, or neither)
         free_memory = self.__delete_me
         self.pool = workpool.multiprocess_pool( bitcoind_opts, initializer=free_memory, initargs=[self.state] )
         
+        # each build gets its own, so a fetcher left over from the last one can't be restarted by accident
+        fetch_stop = threading.Event()
+        self.fetch_stop = fetch_stop
+        
         try:
             
             log.debug("Process blocks %s to %s" % (first_block_id, end_block_id) )
             
+            # NOTE: the range a block falls into decides the block ID its operations are 
+            # parsed with (see process_blocks()), so these must not change from one run to the next
+            block_ranges = []
             for block_id in xrange( first_block_id, end_block_id, worker_batch_size * num_workers ):
+                block_ranges.append( (block_id, min(block_id + worker_batch_size * num_workers, end_block_id)) )
                 
-                if not rc:
-                    break 
-                
-                if self.pool is None:
-                    # interrupted 
-                    log.debug("Build interrupted")
-                    rc = False
-                    break 
-                
-                block_ids = range( block_id, min(block_id + worker_batch_size * num_workers, end_block_id) )
-               
-                # returns: [(block_id, txs)]
-                block_ids_and_txs = transactions.get_nulldata_txs_in_blocks( self.pool, bitcoind_opts, block_ids )
+            if pipeline_depth > 0:
+                rc = self.build_pipelined( bitcoind_opts, block_ranges, pipeline_depth, fetch_stop )
                 
-                # process in order by block ID
-                block_ids_and_txs.sort()
-               
-                for processed_block_id, txs in block_ids_and_txs:
-
-                    if self.get_consensus_at( processed_block_id ) is not None:
-                        raise Exception("Already processed block %s (%s)" % (processed_block_id, self.get_consensus_at( processed_block_id )) )
-
-                    ops = self.parse_block( block_id, txs )
-                    consensus_hash = self.process_block( processed_block_id, ops )
+            else:
+                for range_group in self.group_block_ranges( bitcoind_opts, block_ranges ):
                     
-                    log.debug("CONSENSUS(%s): %s" % (processed_block_id, self.get_consensus_at( processed_block_id )))
+                    if self.pool is None:
+                        # interrupted 
+                        log.debug("Build interrupted")
+                        rc = False
+                        break 
                     
-                    if consensus_hash is None:
+                    try:
+                        # returns: [(block_ids, [(block_id, txs)])]
+                        fetched = self.fetch_block_range_group( bitcoind_opts, range_group, fetch_stop=fetch_stop )
                         
-                        # fatal error 
+                    except workpool.CompletionQueueStopped:
+                        # interrupted while fetching
+                        log.debug("Build interrupted")
                         rc = False
-                        log.error("Failed to process block %d" % processed_block_id )
+                        break
+                    
+                    for block_ids, block_ids_and_txs in fetched:
+                        
+                        rc = self.process_blocks( block_ids[0], block_ids_and_txs )
+                        if not rc:
+                            break 
+                        
+                    if not rc:
                         break
             
             log.debug("Last block is %s" % self.lastblock )
 
         except:
             
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+                
+            raise
+        
+        if self.pool is not None:
             self.pool.close()
             self.pool.terminate()
             self.pool.join()
             self.pool = None
-            raise
-        
-        self.pool.close()
-        self.pool.terminate()
-        self.pool.join()
-        self.pool = None
+            
         return rc
     
     
@@ -776,6 +1003,10 @@ class StateEngine( object ):
         
         log.debug("Stop building")
         
+        fetch_stop = self.fetch_stop
+        if fetch_stop is not None:
+            fetch_stop.set()
+        
         if self.pool is not None:
             try:
                 # NOTE: a bit racy--self.pool might be None 
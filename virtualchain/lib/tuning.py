@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Virtualchain
+    ~~~~~
+    copyright: (c) 2014 by Halfmoon Labs, Inc.
+    copyright: (c) 2015 by Blockstack.org
+
+    This file is part of Virtualchain
+
+    Virtualchain is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Virtualchain is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+    You should have received a copy of the GNU General Public License
+    along with Virtualchain.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+import collections
+
+import config
+
+log = logging.getLogger()
+
+# back off when a window's tasks take this many times longer than they do when bitcoind is not loaded
+LATENCY_TOLERANCE = 1.5
+
+# how much each kind of task's unloaded latency estimate can rise per minute
+# (so it can follow slow changes, like blocks getting bigger)
+BASELINE_DRIFT = 0.02
+
+# latencies below this are noise (i.e. cache hits), as far as backing off goes
+MIN_BASELINE_LATENCY = 0.001    # seconds
+
+# how much to cut concurrency by when latency rises, or when tasks fail
+LATENCY_BACKOFF = 0.75
+ERROR_BACKOFF = 0.5
+
+# aim for slices of blocks that take about this long to fetch
+SLICE_TARGET_TIME = 10.0    # seconds
+MIN_SLICE_LEN = 8
+
+# expect blocks to be as big as the biggest of this many of the last ones fetched
+BLOCK_ESTIMATE_WINDOW = 64
+
+# process-local controller
+process_local_concurrency_controller = None
+
+
+class ConcurrencyController( object ):
+   """
+   Tune how many bitcoind queries we have in flight, and
+   how many blocks we fetch per slice, while we build.
+
+   Concurrency is tuned AIMD-style, a window of tasks at a time
+   (a window being as many tasks as we allow in flight):
+   * if any task in the window failed, cut concurrency in half;
+   * if the window's tasks took much longer than they do when bitcoind 
+   is not loaded (i.e. the lowest average latency seen for each kind of 
+   task, or the latest one with only one task in flight), cut it by a quarter;
+   * otherwise, add one (or double it, until the first cut).
+
+   Slices are resized so each one takes about SLICE_TARGET_TIME:  large
+   enough that slice boundaries (where the workpool drains) are rare, and
+   small enough that we don't hold too many blocks' transactions in RAM.
+
+   The tuned settings are saved to path (if given), so the next
+   start picks up where this one left off.
+   """
+
+   def __init__( self, path, concurrency, slice_len, max_concurrency, max_slice_len ):
+      self.path = path
+      self.lock = threading.Lock()
+
+      self.max_concurrency = max(1, max_concurrency)
+      self.max_slice_len = max(MIN_SLICE_LEN, max_slice_len)
+      self.concurrency = max(1, min( concurrency, self.max_concurrency ))
+      self.slice_len = max(MIN_SLICE_LEN, min( slice_len, self.max_slice_len ))
+      self.slow_start = True
+
+      self.latencies = {}            # {task kind: unloaded latency estimate}
+
+      # current window
+      self.window_tasks = 0
+      self.window_errors = 0
+      self.window_latencies = {}     # {task kind: (count, total latency)}
+      self.window_start = time.time()
+
+      # measurements
+      self.last_latency_ratio = None
+      self.last_task_throughput = None
+      self.last_block_throughput = None
+      self.tasks = 0
+      self.errors = 0
+
+      self.load()
+
+
+   def get_concurrency( self ):
+      """
+      How many tasks may be in flight at once?
+      """
+      return self.concurrency
+
+
+   def get_slice_len( self ):
+      """
+      How many blocks should the next slice have?
+      """
+      return self.slice_len
+
+
+   def record_task( self, kind, latency, success ):
+      """
+      Record how long a task of a given kind (i.e. a kind of query) took,
+      and whether or not it succeeded.  Adjust concurrency at the end of
+      each window.
+      """
+      with self.lock:
+
+         self.tasks += 1
+         self.window_tasks += 1
+
+         if not success:
+            self.errors += 1
+            self.window_errors += 1
+
+         else:
+            count, total = self.window_latencies.get( kind, (0, 0.0) )
+            self.window_latencies[kind] = (count + 1, total + latency)
+
+         if self.window_tasks >= self.concurrency:
+            self.end_window()
+
+
+   def end_window( self ):
+      """
+      Adjust concurrency, given the window of tasks that just finished.
+      Call with the lock held.
+      """
+      now = time.time()
+      old_concurrency = self.concurrency
+      drift = 1 + BASELINE_DRIFT * (now - self.window_start) / 60.0
+
+      self.last_task_throughput = self.window_tasks / max(now - self.window_start, 1e-6)
+
+      # how much slower than unloaded was this window, on average over its tasks?
+      successes = 0
+      weighted_ratio = 0.0
+      for kind, (count, total) in self.window_latencies.items():
+
+         average = total / count
+         baseline = self.latencies.get( kind, None )
+         if baseline is None:
+            baseline = average
+
+         weighted_ratio += count * max(average, MIN_BASELINE_LATENCY) / max(baseline, MIN_BASELINE_LATENCY)
+         successes += count
+
+         if self.concurrency == 1:
+            # nothing else was in flight, so this is as unloaded as it gets
+            self.latencies[kind] = average
+         else:
+            self.latencies[kind] = min( average, baseline * drift )
+
+      if successes > 0:
+         self.last_latency_ratio = weighted_ratio / successes
+
+      if self.window_errors > 0:
+         self.concurrency = max(1, int(self.concurrency * ERROR_BACKOFF))
+         self.slow_start = False
+
+      elif self.last_latency_ratio is not None and self.last_latency_ratio > LATENCY_TOLERANCE:
+         self.concurrency = max(1, int(self.concurrency * LATENCY_BACKOFF))
+         self.slow_start = False
+
+      elif self.slow_start:
+         self.concurrency = min( self.max_concurrency, self.concurrency * 2 )
+
+      else:
+         self.concurrency = min( self.max_concurrency, self.concurrency + 1 )
+
+      if self.concurrency != old_concurrency:
+         log.debug("Concurrency %s --> %s (latency ratio %s, %s errors, %.1f tasks/s)" % (old_concurrency, self.concurrency, self.last_latency_ratio, self.window_errors, self.last_task_throughput))
+
+      self.window_tasks = 0
+      self.window_errors = 0
+      self.window_latencies = {}
+      self.window_start = now
+
+
+   def record_slice( self, num_blocks, elapsed ):
+      """
+      Record how long a slice of blocks took to fetch, and
+      resize the next slice accordingly.  Save the settings.
+      """
+      with self.lock:
+
+         elapsed = max(elapsed, 1e-3)
+         self.last_block_throughput = num_blocks / elapsed
+
+         if num_blocks >= self.slice_len:
+            # (a short slice, i.e. at the end of a range, says nothing about the slice length)
+            target = int(self.slice_len * SLICE_TARGET_TIME / elapsed)
+            target = max(self.slice_len / 2, min( target, self.slice_len * 2 ))
+            self.slice_len = max(MIN_SLICE_LEN, min( target, self.max_slice_len ))
+
+         log.debug("Concurrency settings: %s" % self.get_settings_locked())
+         self.save_locked()
+
+
+   def get_settings_locked( self ):
+      """
+      Get the current settings and measurements.
+      Call with the lock held.
+      """
+      return {
+         "concurrency": self.concurrency,
+         "slice_len": self.slice_len,
+         "max_concurrency": self.max_concurrency,
+         "max_slice_len": self.max_slice_len,
+         "slow_start": self.slow_start,
+         "latencies": dict(self.latencies),
+         "latency_ratio": self.last_latency_ratio,
+         "task_throughput": self.last_task_throughput,
+         "block_throughput": self.last_block_throughput,
+         "tasks": self.tasks,
+         "errors": self.errors
+      }
+
+
+   def get_settings( self ):
+      """
+      Get the current settings and measurements, as a dict.
+      """
+      with self.lock:
+         return self.get_settings_locked()
+
+
+   def load( self ):
+      """
+      Pick up the settings saved by the last run, if there are any.
+      """
+      if self.path is None or not os.path.exists( self.path ):
+         return
+
+      try:
+         with open( self.path, "r" ) as f:
+            saved = json.loads( f.read() )
+
+         self.concurrency = max(1, min( int(saved['concurrency']), self.max_concurrency ))
+         self.slice_len = max(MIN_SLICE_LEN, min( int(saved['slice_len']), self.max_slice_len ))
+         self.latencies = dict( [(str(k), float(v)) for (k, v) in saved.get('latencies', {}).items()] )
+
+         # we already know roughly where the limit is
+         self.slow_start = False
+
+      except Exception, e:
+         log.error("Failed to load concurrency settings from %s: %s" % (self.path, e))
+         return
+
+      log.debug("Loaded concurrency settings from %s: concurrency %s, slice length %s" % (self.path, self.concurrency, self.slice_len))
+
+
+   def save_locked( self ):
+      """
+      Save the settings, so the next run can pick them up.
+      Call with the lock held.
+      """
+      if self.path is None:
+         return
+
+      saved = {
+         "concurrency": self.concurrency,
+         "slice_len": self.slice_len,
+         "latencies": self.latencies
+      }
+
+      try:
+         tmp_path = self.path + ".tmp"
+         with open( tmp_path, "w" ) as f:
+            f.write( json.dumps( saved ) )
+
+         os.rename( tmp_path, self.path )
+
+      except Exception, e:
+         log.error("Failed to save concurrency settings to %s: %s" % (self.path, e))
+
+
+class SliceBudget( object ):
+   """
+   Size slices of blocks by how much data they hold, and
+   not just by how many blocks they have.
+
+   A slice's blocks (and their transactions) are held until the whole
+   slice has been fetched, so with a fixed number of blocks per slice,
+   memory use follows block size:  slices of early, nearly-empty blocks
+   hold almost nothing, and slices of full blocks hold a lot.  Instead,
+   each slice gets as many blocks as we expect to fit in max_bytes
+   (of blocks, as serialized) and max_txs (transactions), going by
+   recent blocks' sizes and transaction counts.  Each block is expected
+   to be as big as the biggest of the last BLOCK_ESTIMATE_WINDOW blocks,
+   since block sizes vary a lot from one block to the next, and an
+   average would let in too many big ones.
+
+   Within a slice, blocks are fetched in order, and only while the ones
+   fetched so far, plus the ones in flight (at their expected size), fit
+   the budget; once they don't, the slice ends early.  Each slice has
+   at least one block, even if it doesn't fit.  Until enough blocks have
+   been measured, fewer are let in flight at once, since the estimates
+   are no good yet.
+
+   Either limit can be None, in which case it isn't enforced (but
+   what the slices hold is still measured).
+   """
+
+   def __init__( self, max_bytes, max_txs ):
+      self.max_bytes = max_bytes
+      self.max_txs = max_txs
+
+      # estimates, from recent blocks
+      self.recent_bytes = collections.deque( maxlen=BLOCK_ESTIMATE_WINDOW )
+      self.recent_txs = collections.deque( maxlen=BLOCK_ESTIMATE_WINDOW )
+      self.bytes_per_block = None
+      self.txs_per_block = None
+
+      # current slice
+      self.slice_bytes = 0
+      self.slice_txs = 0
+      self.slice_blocks = 0
+      self.in_flight = 0
+
+      # measurements
+      self.peak_bytes = 0
+      self.peak_txs = 0
+      self.blocks = 0
+      self.slices = 0
+      self.early_ends = 0
+
+
+   def is_limited( self ):
+      """
+      Is there a limit to enforce?
+      """
+      return self.max_bytes is not None or self.max_txs is not None
+
+
+   def get_slice_len( self, slice_len ):
+      """
+      How many blocks should the next slice have, if
+      it can have no more than slice_len of them?
+      """
+      if self.max_bytes is not None and self.bytes_per_block:
+         slice_len = min( slice_len, int(self.max_bytes / self.bytes_per_block) )
+
+      if self.max_txs is not None and self.txs_per_block:
+         slice_len = min( slice_len, int(self.max_txs / self.txs_per_block) )
+
+      return max(1, slice_len)
+
+
+   def start_slice( self ):
+      """
+      Start measuring a new slice.
+      """
+      self.slice_bytes = 0
+      self.slice_txs = 0
+      self.slice_blocks = 0
+      self.in_flight = 0
+
+
+   def can_fetch( self ):
+      """
+      Can we start fetching another block in this slice,
+      without (as far as we can tell) going over budget?
+      """
+      if self.slice_blocks == 0 and self.in_flight == 0:
+         return True
+
+      if self.in_flight >= self.blocks:
+         # don't bet on more blocks than we've measured (so a few small ones don't let in a lot of big ones)
+         return False
+
+      pending = self.in_flight + 1
+      if self.max_bytes is not None and self.slice_bytes + pending * self.bytes_per_block > self.max_bytes:
+         return False
+
+      if self.max_txs is not None and self.slice_txs + pending * self.txs_per_block > self.max_txs:
+         return False
+
+      return True
+
+
+   def fetch_started( self ):
+      """
+      Record that we started fetching a block.
+      """
+      self.in_flight += 1
+
+
+   def record_block( self, num_bytes, num_txs ):
+      """
+      Record that we fetched a block of num_bytes bytes
+      (as serialized) and num_txs transactions, and that
+      this slice holds it until it ends.
+      """
+      self.in_flight = max(0, self.in_flight - 1)
+      self.slice_bytes += num_bytes
+      self.slice_txs += num_txs
+      self.slice_blocks += 1
+      self.blocks += 1
+
+      self.peak_bytes = max( self.peak_bytes, self.slice_bytes )
+      self.peak_txs = max( self.peak_txs, self.slice_txs )
+
+      self.recent_bytes.append( num_bytes )
+      self.recent_txs.append( num_txs )
+      self.bytes_per_block = max( self.recent_bytes )
+      self.txs_per_block = max( self.recent_txs )
+
+
+   def end_slice( self, ended_early ):
+      """
+      Record that the current slice is done, and whether or
+      not it ended early (i.e. before it ran out of blocks)
+      because it reached its budget.
+      """
+      self.slices += 1
+      if ended_early:
+         self.early_ends += 1
+
+
+def get_concurrency_controller( bitcoind_opts ):
+   """
+   Get this process's concurrency controller.
+   Return None if adaptive concurrency is disabled.
+   """
+
+   global process_local_concurrency_controller
+
+   enabled, max_concurrency, max_slice_len, path = config.configure_adaptive_concurrency( bitcoind_opts )
+   if not enabled:
+      return None
+
+   if process_local_concurrency_controller is None or process_local_concurrency_controller.path != path:
+
+      # start from the static heuristic
+      num_workers, worker_batch_size = config.configure_multiprocessing( bitcoind_opts )
+      if num_workers is None or worker_batch_size is None:
+         num_workers, worker_batch_size = (1, MIN_SLICE_LEN)
+
+      process_local_concurrency_controller = ConcurrencyController( path, num_workers, num_workers * worker_batch_size, max_concurrency, max_slice_len )
+
+   return process_local_concurrency_controller
+
+
+def get_concurrency_settings():
+   """
+   Get the current concurrency settings and measurements
+   of this process's concurrency controller, as a dict.
+   Return None if there is no controller (i.e. adaptive
+   concurrency is disabled, or we haven't started building).
+   """
+   if process_local_concurrency_controller is None:
+      return None
+
+   return process_local_concurrency_controller.get_settings()
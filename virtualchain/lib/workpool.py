@@ -24,50 +24,402 @@
 
 from multiprocessing import Pool
 
-from config import DEBUG, configure_multiprocessing
+from config import DEBUG, configure_multiprocessing, configure_rpc_pool, configure_workpool_backend, configure_rpc_connection_lifecycle
+from tuning import get_concurrency_controller
 
 import logging
 import os
 import sys
 import signal
+import time
+import traceback
+import threading
+import Queue
+import types
+import collections
 import blockchain
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
-# bitcoind just for this process
-process_local_bitcoind = None
+log = logging.getLogger()
+
+# bitcoind just for this thread (i.e. this process, if it's a worker process)
+thread_local_bitcoind = threading.local()
+
+# pooled bitcoind client shared by this process's threads (and the process it belongs to)
+process_local_bitcoind_pool = None
+process_local_bitcoind_pool_pid = None
+process_local_bitcoind_pool_lock = threading.Lock()
 
 def multiprocess_bitcoind( bitcoind_opts, reset=False ):
    """
-   Get a per-process bitcoind client.
+   Get a per-process (per-thread, in a thread pool) bitcoind client.
+   If the options ask for a pool of bitcoind connections,
+   then get the (thread-safe) pooled client instead.
+   Either way, its RPCs are counted in the fetch metrics.
    """
    
-   global process_local_bitcoind
+   global process_local_bitcoind_pool, process_local_bitcoind_pool_pid
+   
+   pool_size = configure_rpc_pool( bitcoind_opts )
+   if pool_size > 0:
+      
+      with process_local_bitcoind_pool_lock:
+         
+         if process_local_bitcoind_pool is not None and process_local_bitcoind_pool_pid != os.getpid():
+            # inherited from the process that forked us; its connections are that process's to use
+            process_local_bitcoind_pool = None
+         
+         if process_local_bitcoind_pool is not None and process_local_bitcoind_pool.max_connections != pool_size:
+            process_local_bitcoind_pool.reset()
+            process_local_bitcoind_pool = None
+         
+         if process_local_bitcoind_pool is None:
+            process_local_bitcoind_pool = blockchain.session.create_bitcoind_rpc_pool( bitcoind_opts, pool_size )
+            process_local_bitcoind_pool_pid = os.getpid()
+         
+         elif reset:
+            # other threads may be using it, so don't replace it.  Just drop its idle connections.
+            process_local_bitcoind_pool.reset()
+            
+         return blockchain.metrics.MeteredBitcoind( process_local_bitcoind_pool )
+   
+   bitcoind = getattr( thread_local_bitcoind, "bitcoind", None )
+   idle_time = time.time() - getattr( thread_local_bitcoind, "last_used", 0 )
    
-   if reset: 
-      process_local_bitcoind = None 
+   if bitcoind is not None and getattr( thread_local_bitcoind, "pid", None ) != os.getpid():
+      # inherited from the process that forked us (i.e. we're a new worker).
+      # its connection is that process's to use (and close), so just forget it.
+      bitcoind = None
+      thread_local_bitcoind.bitcoind = None
+   probe_interval, idle_timeout = configure_rpc_connection_lifecycle( bitcoind_opts )
    
-   if process_local_bitcoind is None:
-      # this proces does not yet have a bitcoind client.
+   if bitcoind is not None:
+      
+      if reset: 
+         # something went wrong with it 
+         blockchain.session.count_connection_event( "reset" )
+         bitcoind = None
+      
+      elif idle_time > idle_timeout:
+         blockchain.session.count_connection_event( "expired" )
+         bitcoind = None
+         
+      elif idle_time > probe_interval:
+         blockchain.session.count_connection_event( "probed" )
+         if not blockchain.session.bitcoind_is_alive( bitcoind ):
+            blockchain.session.count_connection_event( "probe_failures" )
+            bitcoind = None
+      
+      if bitcoind is None:
+         conn = getattr( thread_local_bitcoind.bitcoind, "__dict__", {} ).get( "connection", None )
+         if conn is not None:
+            conn.close()
+            
+      else:
+         blockchain.session.count_connection_event( "reused" )
+   
+   if bitcoind is None:
+      # this thread does not yet have a (usable) bitcoind client.
       # make one.
       from ..virtualchain import connect_bitcoind
-      process_local_bitcoind = connect_bitcoind( bitcoind_opts )
+      bitcoind = connect_bitcoind( bitcoind_opts )
+      thread_local_bitcoind.bitcoind = bitcoind
+      thread_local_bitcoind.pid = os.getpid()
+      blockchain.session.count_connection_event( "created" )
+      
+   thread_local_bitcoind.last_used = time.time()
+   return blockchain.metrics.MeteredBitcoind( bitcoind )
+
+
+class CompletedResult( object ):
+   """
+   Stand-in for a multiprocessing AsyncResult whose 
+   value is already available (i.e. there's nothing to wait for).
+   """
+   
+   def __init__( self, value ):
+      self.value = value 
+      
+   def ready( self ):
+      return True 
+   
+   def successful( self ):
+      return True 
+   
+   def wait( self, timeout=None ):
+      return 
+   
+   def get( self, timeout=None ):
+      return self.value 
+   
+
+class FailedResult( object ):
+   """
+   Stand-in for a multiprocessing AsyncResult whose 
+   task has already failed.
+   """
+   
+   def __init__( self, exc ):
+      self.exc = exc 
+      
+   def ready( self ):
+      return True 
+   
+   def successful( self ):
+      return False 
+   
+   def wait( self, timeout=None ):
+      return 
+   
+   def get( self, timeout=None ):
+      raise self.exc 
+   
+
+class InlinePool( object ):
+   """
+   Workpool that runs each task synchronously, in the calling thread,
+   as soon as it is submitted.  Has the subset of the multiprocessing 
+   Pool interface that the indexer uses.
+   
+   Useful for tests, debugging, and small ranges of blocks, where 
+   starting workers costs more than it saves.
+   """
+   
+   def apply_async( self, func, args=(), kwds={}, callback=None ):
+      try:
+         value = func( *args, **kwds )
+      except Exception, e:
+         log.exception(e)
+         return FailedResult( e )
       
-   return process_local_bitcoind
+      if callback is not None:
+         callback( value )
+         
+      return CompletedResult( value )
+   
+   def close( self ):
+      pass 
+   
+   def terminate( self ):
+      pass 
+   
+   def join( self ):
+      pass
+   
 
+def completion_task( func, args ):
+   """
+   Run func(*args) in a worker, and return (True, result) on success
+   or (False, (exception, traceback string)) on failure, so the 
+   completion callback fires either way.
+   """
+   try:
+      return (True, func( *args ))
+   except Exception, e:
+      return (False, (e, traceback.format_exc()))
+   
+
+class CompletionQueueStopped( Exception ):
+   """
+   A CompletionQueue's caller gave up on its outstanding tasks.
+   """
+   pass
+
+
+class CompletionQueue( object ):
+   """
+   Completion-driven view of a workpool.
+
+   Tasks are submitted with a caller-chosen tag, and next() hands
+   back (tag, result) for whichever task finishes first, so the 
+   caller can start follow-up work the moment a result lands 
+   (instead of polling a list of futures, or blocking on an 
+   arbitrary one while others are done).
+
+   If given a concurrency controller (see tuning.py), at most
+   controller.get_concurrency() tasks are in the workpool at once;
+   the rest wait their turn here.  Each task's latency and outcome
+   is reported to the controller, by kind (the tag's first item,
+   if the tag is a tuple).
+
+   If given a stop function, next() raises CompletionQueueStopped 
+   once stop() returns True, instead of waiting for results that 
+   may never come (i.e. because the workpool was terminated).
+
+   Works with anything that has a multiprocessing-style 
+   apply_async( func, args, callback=... ).
+   """
+   
+   def __init__( self, workpool, controller=None, stop=None ):
+      self.workpool = workpool 
+      self.controller = controller
+      self.stop = stop
+      self.results = Queue.Queue()
+      self.pending = {}     # {task_id: async result}, for finding tasks that failed without a callback
+      self.deferred = collections.deque()   # [(task_id, func, args, tag)] waiting for a free slot
+      self.started = {}     # {task_id: (kind, start time)} for tasks in the workpool
+      self.task_count = 0
+   
+   
+   def __len__( self ):
+      """
+      How many results have yet to be handed back?
+      """
+      return len(self.pending) + len(self.deferred)
+   
+   
+   def submit( self, func, args, tag ):
+      """
+      Run func(*args) in the workpool.  Its result will 
+      be handed back by next() along with tag.
+      Return the task's async result, or None if it has to 
+      wait for a free slot first.
+      """
+      task_id = self.task_count
+      self.task_count += 1
+      
+      if self.controller is not None and len(self.started) >= self.controller.get_concurrency():
+         self.deferred.append( (task_id, func, args, tag) )
+         return None
+      
+      return self.dispatch( task_id, func, args, tag )
+   
+   
+   def dispatch( self, task_id, func, args, tag ):
+      """
+      Send a task to the workpool.
+      """
+      def on_complete( result ):
+         self.results.put( (task_id, tag, result) )
+         
+      if type(tag) == types.TupleType:
+         kind = tag[0]
+      else:
+         kind = tag
+         
+      self.started[task_id] = (kind, time.time())
+      fut = self.workpool.apply_async( completion_task, (func, args), callback=on_complete )
+      self.pending[task_id] = fut
+      return fut 
+   
+   
+   def finish( self, task_id, success ):
+      """
+      A task is out of the workpool.  Report it to the controller,
+      and let waiting tasks into the workpool.
+      """
+      del self.pending[task_id]
+      
+      if not self.started.has_key( task_id ):
+         # put_completed()
+         return 
+      
+      kind, start_time = self.started.pop( task_id )
+      if self.controller is None:
+         return 
+      
+      self.controller.record_task( kind, time.time() - start_time, success )
+      
+      while len(self.deferred) > 0 and len(self.started) < self.controller.get_concurrency():
+         self.dispatch( *self.deferred.popleft() )
+   
+   
+   def put_completed( self, value, tag ):
+      """
+      Hand back a result that is already available.
+      """
+      task_id = self.task_count
+      self.task_count += 1
+      
+      self.pending[task_id] = CompletedResult( value )
+      self.results.put( (task_id, tag, (True, value)) )
+   
+   
+   def next( self ):
+      """
+      Wait for the next task to finish, and return (tag, result).
+      Raise the task's exception if it failed.
+      Raise CompletionQueueStopped if the caller gave up.
+      Return None if there are no outstanding tasks.
+      """
+      
+      if len(self.pending) == 0:
+         return None
+      
+      while True:
+         try:
+            # NOTE: a timeout keeps this interruptable
+            task_id, tag, (success, result) = self.results.get( True, 1.0 )
+            break
+         
+         except Queue.Empty:
+            if self.stop is not None and self.stop():
+               raise CompletionQueueStopped("Stopped with %s tasks outstanding" % len(self))
+            
+            # a task whose result could not be sent back never calls back.
+            # find it and raise its error.
+            for task_id, fut in self.pending.items():
+               if fut.ready() and not fut.successful():
+                  self.finish( task_id, False )
+                  fut.get()
+      
+      self.finish( task_id, success )
+      
+      if not success:
+         exc, tb = result
+         log.error("Task failed:\n%s" % tb)
+         raise exc
+      
+      return (tag, result)
+   
 
 def multiprocess_batch_size( bitcoind_opts ):
    """
    How many blocks can we be querying at once?
    """
+   controller = get_concurrency_controller( bitcoind_opts )
+   if controller is not None:
+      return controller.get_slice_len()
+   
    num_workers, worker_batch_size = configure_multiprocessing( bitcoind_opts )
    return num_workers * worker_batch_size
 
 
-def multiprocess_pool( bitcoind_opts, initializer=None, initargs=None ):
+def multiprocess_pool( bitcoind_opts, initializer=None, initargs=None, backend=None ):
    """
-   Given bitcoind options, create a multiprocess pool 
-   for querying it.
+   Given bitcoind options, create a workpool 
+   for querying it.  The backend is one of:
+   * "process":  a pool of worker processes, each with its own bitcoind client.
+   * "thread":  a pool of worker threads in this process, each with its own bitcoind client
+   (or sharing a pooled client, if "bitcoind_rpc_pool_size" is set).
+   * "inline":  no workers; each query runs synchronously, when it is issued.
+   
+   If not given, the backend comes from the "workpool_backend" option.
+   initializer and initargs only apply to worker processes, since 
+   threads share this process's memory.
+   
+   With adaptive concurrency, the pool gets as many workers as the 
+   controller may ever let into it.
    """
    num_workers, worker_batch_size = configure_multiprocessing( bitcoind_opts )
-   return Pool( processes=num_workers, initializer=initializer, initargs=initargs )
+   
+   controller = get_concurrency_controller( bitcoind_opts )
+   if controller is not None:
+      num_workers = controller.max_concurrency
+   
+   if backend is None:
+      backend = configure_workpool_backend( bitcoind_opts )
+      
+   if backend == "inline":
+      return InlinePool()
+   
+   elif backend == "thread":
+      return ThreadPool( processes=num_workers )
+   
+   elif backend == "process":
+      return Pool( processes=num_workers, initializer=initializer, initargs=initargs )
+   
+   else:
+      raise Exception("Unknown workpool backend '%s'" % backend)
     
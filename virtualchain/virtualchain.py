@@ -38,7 +38,7 @@ from ConfigParser import SafeConfigParser
 from txjsonrpc.netstring import jsonrpc
 
 from .lib import config, workpool, indexer
-from .lib.blockchain import session
+from .lib.blockchain import session, notify
 from pybitcoin import BitcoindClient, ChainComClient
 
 log = session.log
@@ -110,7 +110,8 @@ def stop_virtualchain():
 def run_virtualchain():
 
     """
-    Continuously and periodically feed new blocks into the state engine.
+    Continuously feed new blocks into the state engine, as bitcoind
+    tells us about them (see configure_block_notify()), or periodically.
     This method loops pretty much forever; consider calling
     it from a thread or in a subprocess.  You can stop
     it with stop_virtualchain(), but it only sets a
@@ -133,6 +134,8 @@ def run_virtualchain():
         bitcoin_opts[k] = v
 
     log.debug("multiprocessing config = (%s, %s)" % (config.configure_multiprocessing(bitcoin_opts)))
+    log.debug("adaptive concurrency config = (%s, %s, %s, %s)" % (config.configure_adaptive_concurrency(bitcoin_opts)))
+    log.debug("block notification config = (%s, %s, %s)" % (config.configure_block_notify(bitcoin_opts)))
 
     if connect_bitcoind is None:
         connect_bitcoind = session.connect_bitcoind 
@@ -145,18 +148,33 @@ def run_virtualchain():
         log.exception(e)
         return 1
 
+    try:
+
+        notifier = notify.get_block_notifier(bitcoind, bitcoin_opts)
+
+    except Exception, e:
+        log.exception(e)
+        log.error("Failed to listen for new blocks; polling for them instead")
+        notifier = notify.BlockNotifier()
+
+    log.debug("block notification method = %s" % notifier.name)
+
     _, last_block_id = indexer.get_index_range(bitcoind)
 
     running = True
     while running:
 
         # keep refreshing the index
-        sync_virtualchain(bitcoin_opts, last_block_id)
+        sync_virtualchain(bitcoin_opts, last_block_id, state_engine)
 
-        time.sleep(config.REINDEX_FREQUENCY)
+        # sleep until there's a new block (or we've waited long enough to check anyway)
+        notifier.wait(last_block_id)
 
         _, last_block_id = indexer.get_index_range(bitcoind)
 
+    notifier.close()
+    return 0
+
 
 def setup_virtualchain(impl_module, testset=False, bitcoind_connection_factory=session.connect_bitcoind):
     """